@@ -4,14 +4,15 @@ import re
 import sys
 import time
 import math
+import zipfile
 import datetime as dt
 import pandas as pd
 import requests
 
 from io import StringIO
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
-from bs4 import UnicodeDammit
 from urllib.parse import urlparse, parse_qs, unquote
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -23,53 +24,43 @@ from webdriver_manager.chrome import ChromeDriverManager
 from openpyxl import load_workbook
 from openpyxl.cell.cell import MergedCell
 
+# 共通モジュール（win5_cards_export/ 配下）を読めるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "win5_cards_export"))
+from xlsx_template import load_template
+from xlsx_patch import patch_workbook, patch_sheet_xml, fill_cached_values, sheet_part
+from formula_eval import formula_program
+from sidecar import write_sidecar
+from race_store import write_store, lookup_known_runs, PAST_LABELS
+from entities import id_from_href, id_column, remember_names
+from snapshot_archive import save_snapshot
+from fetch_layer import build_session, decode_html_bytes
+from jra import RaceId, PLACE_RE, known_win5, race_date_of, remember_race, remember_win5
+
 # ===================== 定数 =====================
-HEADERS = {
-    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                   "AppleWebKit/537.36 (KHTML, like Gecko) "
-                   "Chrome/120.0.0.0 Safari/537.36"),
-    "Referer": "https://www.netkeiba.com/",
-    "Accept-Language": "ja,en;q=0.9",
-}
 idx = 0  # 土曜日はidx=0、日曜日はidx=1
 PC_URL = f"https://race.netkeiba.com/top/win5.html?idx={idx}"
 RACE_ID_RE = re.compile(r"race_id=(\d{12})")
+RUN_DATE_RE = re.compile(r"(\d{4})\.(\d{1,2})\.(\d{1,2})")
+PAST_RACE_RE = re.compile(r"(?:race_id=|/race/)(\d{12})")  # 過去走セルのレース名リンク → その走の race_id
+PAST_LINK_RE = re.compile(r'class="Data02"[^>]*>\s*<a[^>]*href="([^"]*)"')  # ページ全体から過去走リンクだけ拾う
+RENDER_WORKERS = min(5, os.cpu_count() or 1)  # シート XML を作るプロセス数（1 なら並列にしない）
 
 # テンプレートファイル（スクリプトと同じフォルダに置く）
 TEMPLATE_XLSX = Path(__file__).resolve().with_name("main_horse_decide_sheets.xlsx")
 # ===================== 定数 =====================
 
 # ===================== 高速化：HTTPセッション =====================
-def build_session() -> requests.Session:
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
-
-    s = requests.Session()
-    s.headers.update(HEADERS)
-    retry = Retry(
-        total=3, backoff_factor=0.3,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=("GET",)
-    )
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
-    return s
-
 SESSION = build_session()
 # ===================== 高速化：HTTPセッション =====================
 
 # ===================== HTMLユーティリティ =====================
 SESSION = build_session()
-def _decode_html_bytes(b: bytes, fallback: str = "utf-8") -> str:
-    dammit = UnicodeDammit(b, is_html=True)
-    if dammit.unicode_markup:
-        return dammit.unicode_markup
-    return b.decode(fallback, errors="replace")
 
 def _get_html(url: str, timeout: int = 15) -> str:
     r = SESSION.get(url, timeout=timeout)
     r.raise_for_status()
-    return _decode_html_bytes(r.content)
+    save_snapshot(url, r.content)
+    return decode_html_bytes(r.content)
 # ===================== HTMLユーティリティ =====================
 
 # ===================== WIN5 race_idとrace_date 抽出 =====================
@@ -87,13 +78,17 @@ def _extract_ids_from_html(html: str) -> list[str]:
     return ids
 
 def _race_date(html: str) -> str:
+    # カレンダーで race_id の開催日が分かればページの日付表示は見ない
+    ids = _extract_ids_from_html(html)
+    if ids and (date := race_date_of(ids[0])):
+        return date
+
     soup = BeautifulSoup(html, "html.parser")
 
     # 年は WIN5ページ中の race_id=YYYY…… から取得
     year = ""
-    ids = _extract_ids_from_html(html)
     if ids:
-        year = ids[0][:4]
+        year = str(RaceId.parse(ids[0]).year)
 
     active_dd = soup.select_one(".RaceList_Date dl.Win5_Date dd.Active")
     if not active_dd:
@@ -122,12 +117,17 @@ def _race_date(html: str) -> str:
 
 def pick_win5_ids(target_url: str | None = None):
     url = target_url or PC_URL
+    # 日付指定でカレンダーに WIN5 があれば取得しない
+    m = re.search(r"date=(\d{8})", url)
+    if m and (ids := known_win5(m.group(1))):
+        return ids, m.group(1)
     try:
         html = _get_html(url)
         ids = _extract_ids_from_html(html)
         date = _race_date(html)
     except Exception:
         return [], ""
+    remember_win5(date, ids)
 
     if len(ids) >= 5:
         return ids[:5], date
@@ -144,6 +144,7 @@ def fetch_html(url: str) -> str:
         )
     }
     resp = requests.get(url, headers=headers)
+    save_snapshot(url, resp.content)
     # netkeiba は EUC-JP ヘッダだが、apparent_encoding に任せた方が楽
     resp.encoding = resp.apparent_encoding
     return resp.text
@@ -222,8 +223,28 @@ def parse_past_cell(td) -> tuple[str, str, str, str, str, str, str]:
 
     return race_name, place, course, finish, margin, passing, last3f
 
+def _past_run_date(td) -> str:
+    """過去走セルの出走日（"2025.09.15 阪神" → "20250915"）。取れなければ空"""
+    span = td.select_one("div.Data01 span:not(.Num)") if td is not None else None
+    m = RUN_DATE_RE.search(span.get_text(strip=True)) if span else None
+    if not m:
+        return ""
+    y, mo, d = map(int, m.groups())
+    return f"{y:04d}{mo:02d}{d:02d}"
+
+def _past_race_id(td) -> int | None:
+    """過去走セルのレース名リンクからその走の race_id（整数キー。取れなければ None）"""
+    a_tag = td.select_one("div.Data02 a") if td is not None else None
+    m = PAST_RACE_RE.search(a_tag.get("href", "")) if a_tag else None
+    return int(m.group(1)) if m else None
+
+def past_race_ids(html: str | None) -> list[int]:
+    """馬柱ページに出てくる過去走の race_id（全馬・全走。重複もそのまま。soup を作らずに拾う）"""
+    return [int(m.group(1)) for href in PAST_LINK_RE.findall(html or "") if (m := PAST_RACE_RE.search(href))]
+
 # ===================== レースメタ情報抽出 =====================
-def _extract_race_meta(html: str) -> tuple[str, str, str, str, str, str]:
+def _extract_race_meta(html: str, race_id: RaceId | None = None) -> tuple[str, str, str, str]:
+    """race_id を渡すと年・場名は race_id から、開催日はページに無ければカレンダーから"""
     soup = BeautifulSoup(html, "html.parser")
 
     name_el = soup.select_one(".RaceName")
@@ -234,11 +255,10 @@ def _extract_race_meta(html: str) -> tuple[str, str, str, str, str, str]:
     d1 = d1_el.get_text(" ", strip=True) if d1_el else ""
     d2 = d2_el.get_text(" ", strip=True) if d2_el else ""
 
-    year = ""
+    year = str(race_id.year) if race_id else ""
     m_id = RACE_ID_RE.search(html)
-    if m_id:
-        rid = m_id.group(1)
-        year = rid[:4]
+    if m_id and not year:
+        year = m_id.group(1)[:4]
 
     race_date = ""
     active_dd = soup.select_one("#RaceList_DateList dd.Active")
@@ -267,10 +287,12 @@ def _extract_race_meta(html: str) -> tuple[str, str, str, str, str, str]:
                 race_date = f"{int(y):04d}{int(mth):02d}{int(d):02d}"
                 break
 
-    place = ""
-    if d2:
-        PLACE_PATTERN = re.compile(r"(札幌|函館|福島|新潟|東京|中山|中京|京都|阪神|小倉)")
-        m = PLACE_PATTERN.search(d2)
+    if not race_date and race_id:
+        race_date = race_date_of(race_id)
+
+    place = race_id.venue_name if race_id else ""
+    if d2 and not place:
+        m = PLACE_RE.search(d2)
         if m:
             place = m.group(1)
 
@@ -290,7 +312,7 @@ def _extract_race_meta(html: str) -> tuple[str, str, str, str, str, str]:
 
 def fetch_shutsuba_with_meta(url: str, timeout_sec: int = 15):
     html = _get_html(url, timeout=timeout_sec)
-    race_date, name,place, rnum = _extract_race_meta(html)
+    race_date, name,place, rnum = _extract_race_meta(html, RaceId.from_url(url))
     return race_date, name,place, rnum
 
 def extract_horse_table(html: str) -> pd.DataFrame:
@@ -300,6 +322,20 @@ def extract_horse_table(html: str) -> pd.DataFrame:
     前走/2走/3走/4走の(レース名, 場所, コース, 着順,3F)
     を DataFrame にして返す
     """
+    return extract_horse_runs(html)[0]
+
+def _horse_id(tr) -> int | None:
+    a_horse = tr.select_one("td.Horse_Info div.Horse02 a")
+    return id_from_href("horse", a_horse.get("href")) if a_horse else None
+
+def extract_horse_runs(html: str, lookup=None) -> tuple[pd.DataFrame, list[tuple], int]:
+    """
+    extract_horse_table と同じ DataFrame（末尾に horse_id・jockey_id と各走の race_id の整数キー列）に加えて、
+    新しくパースした過去走 [(horse_id, 馬名, 出走日, レース名, 場所, コース, 着順, 着差, 通過順, ３F), ...] と
+    既知として再利用した過去走の数を返す。
+    lookup は horse_id の一覧 → {horse_id: {出走日: 過去走の値}}（race_store.lookup_known_runs）。
+    渡すと既知の走（馬ID×出走日）はパースせずに使い、馬柱の 5 走目まで新しい走として返す。
+    """
     soup = BeautifulSoup(html, "html.parser")
 
     table = soup.select_one("table.Shutuba_Past5_Table")
@@ -307,10 +343,14 @@ def extract_horse_table(html: str) -> pd.DataFrame:
         raise ValueError("Shutuba_Past5_Table が見つかりませんでした")
 
     rows = table.select("tbody tr.HorseList")
+    horse_ids = [_horse_id(tr) for tr in rows]
+    known = lookup(horse_ids) if lookup else {}
 
     records = []
+    new_runs: list[tuple] = []
+    reused = 0
 
-    for tr in rows:
+    for tr, horse_id in zip(rows, horse_ids):
         # ───────── 馬番 ─────────
         uma_no = ""
         td_umaban = tr.select_one("td.Waku")
@@ -336,19 +376,36 @@ def extract_horse_table(html: str) -> pd.DataFrame:
 
         # 騎手名
         jockey_name = ""
+        jockey_id = None
         a_jockey = tr.select_one('td.Jockey a[href*="/jockey/"]')
         if a_jockey:
             jockey_name = a_jockey.get_text(strip=True)
+            jockey_id = id_from_href("jockey", a_jockey.get("href"))
 
         # 過去走（前走〜5走まで入っている想定）
         past_tds = tr.select("td.Past")
 
-        # 取りたいのは 前走, 2走, 3走, 4走 の4つ
+        # 取りたいのは 前走, 2走, 3走, 4走 の4つ（ストアに貯める時は 5走目まで）
         labels = ["前走", "2走", "3走", "4走"]
+        horse_known = known.get(horse_id, {})
+        past_vals, past_rids = [], []
+        for td in past_tds[:len(past_tds) if lookup else len(labels)]:
+            past_rids.append(_past_race_id(td))
+            run_date = _past_run_date(td)
+            if run_date and run_date in horse_known:
+                # 既知の走は前回パースした値をそのまま使う
+                past_vals.append(horse_known[run_date])
+                reused += 1
+                continue
+            vals = parse_past_cell(td)
+            past_vals.append(vals)
+            if horse_id is not None and run_date:
+                new_runs.append((horse_id, horse_name, run_date, *vals))
+
         past_data = {}
         for idx, label in enumerate(labels):
-            if idx < len(past_tds):
-                race_name, place, course, finish, margin, passing, last3f = parse_past_cell(past_tds[idx])
+            if idx < len(past_vals):
+                race_name, place, course, finish, margin, passing, last3f = past_vals[idx]
             else:
                 race_name, place, course, finish, margin, passing, last3f = "", "", "", "", "", "", ""
 
@@ -359,6 +416,7 @@ def extract_horse_table(html: str) -> pd.DataFrame:
             past_data[f"{label}_着差"] = margin
             past_data[f"{label}_通過順"] = passing
             past_data[f"{label}_３F"] = last3f
+            past_data[f"{label}_race_id"] = past_rids[idx] if idx < len(past_rids) else None
 
         record = {
             "馬番": uma_no,
@@ -367,6 +425,8 @@ def extract_horse_table(html: str) -> pd.DataFrame:
             "騎手名": jockey_name,
         }
         record.update(past_data)
+        record["horse_id"] = horse_id
+        record["jockey_id"] = jockey_id
         records.append(record)
 
     df = pd.DataFrame(records)
@@ -381,11 +441,20 @@ def extract_horse_table(html: str) -> pd.DataFrame:
         "2走_レース名","2走_場所","2走_コース","2走_着順","2走_着差","2走_通過順","2走_３F",
         "3走_レース名","3走_場所","3走_コース","3走_着順","3走_着差","3走_通過順","3走_３F",
         "4走_レース名","4走_場所","4走_コース","4走_着順","4走_着差","4走_通過順","4走_３F",
+        "horse_id", "jockey_id",
+        "前走_race_id", "2走_race_id", "3走_race_id", "4走_race_id",
     ]
     # 存在する列だけに絞る（念のため）
     cols = [c for c in cols if c in df.columns]
     df = df[cols]
-    return df
+    # ID は整数キー（欠損ありの Int64）。名前は ID → 名前の対応表に分けて持つ
+    for c in cols:
+        if c.endswith("_id"):
+            df[c] = id_column(df[c]).values
+    if len(df):
+        remember_names("horse", df["horse_id"], df["馬名"])
+        remember_names("jockey", df["jockey_id"], df["騎手名"])
+    return df, new_runs, reused
 
 # ===================== サイトからデータ取得 =====================
 
@@ -414,30 +483,184 @@ def safe_sheet_name(name: str, used: set[str]) -> str:
 # ===================== シート名安全化 =====================
 
 # ===================== テンプレートシートへデータ書き込み =====================
-def write_df_to_sheet(ws, df: pd.DataFrame):
-    """テンプレートの列名とDataFrameの列名を突き合わせて正しい列に書き込む"""
-    # テンプレート1行目のヘッダーから 列名→列番号 マッピングを構築
-    col_map: dict[str, int] = {}
-    for cell in ws[1]:
-        if cell.value is not None and not isinstance(cell, MergedCell):
-            col_map[str(cell.value)] = cell.column
-
-    # DataFrameのデータを2行目から書き込む（列名でマッチング）
+def sheet_write_plans(template_path: Path = TEMPLATE_XLSX) -> list[tuple[str, dict[str, int], frozenset]]:
+    """
+    テンプレート各シートの (シート名, 1行目の列名→列番号, 書き込まないセル) を返す。
+    書き込まないセルは数式セルと結合セル（左上以外）。
+    """
+    plans = []
+    for ws in load_template(template_path).worksheets:
+        col_map: dict[str, int] = {}
+        for cell in ws[1]:
+            if cell.value is not None and not isinstance(cell, MergedCell):
+                col_map[str(cell.value)] = cell.column
+        skip = set()
+        for rng in ws.merged_cells.ranges:
+            skip.update(rc for rc in rng.cells if rc != (rng.min_row, rng.min_col))
+        for row in ws.iter_rows():
+            for cell in row:
+                if isinstance(cell.value, str) and cell.value.startswith("="):
+                    skip.add((cell.row, cell.column))
+        plans.append((ws.title, col_map, frozenset(skip)))
+    return plans
+
+def sheet_cells(df: pd.DataFrame, col_map: dict[str, int], skip: frozenset) -> dict[tuple[int, int], object]:
+    """テンプレートの列名とDataFrameの列名を突き合わせ、2行目からの {(行, 列): 値} にする"""
+    cols = [(i, col_map[c]) for i, c in enumerate(df.columns) if c in col_map]
+    cells = {}
     for r_idx, row_data in enumerate(df.itertuples(index=False), start=2):
-        for col_name, value in zip(df.columns, row_data):
-            if col_name not in col_map:
-                continue
-            cell = ws.cell(row=r_idx, column=col_map[col_name])
-            if isinstance(cell, MergedCell):
-                continue
-            if isinstance(cell.value, str) and cell.value.startswith("="):
-                continue
-            cell.value = value
+        for i, c in cols:
+            if (r_idx, c) not in skip:
+                cells[(r_idx, c)] = row_data[i]
+    return cells
+
 # ===================== テンプレートシートへデータ書き込み =====================
 
+# ===================== 過去走の補強（--enrich） =====================
+def enrich_past_runs(race_ids: list[str], pages: dict[str, str], store: bool = True) -> dict[int, dict]:
+    """
+    5 レース分の馬柱に出てくる過去走のレースを重複なく集め、結果ページを 1 レース 1 回だけ取って
+    {過去走の race_id: {horse_id: (上がり順位, 勝ち馬差, 頭数)}} を返す（ストアに結果のあるレースは取らない）。
+    まだ無い馬柱ページもここで取って pages に入れる（ワーカーで取り直さない）
+    """
+    from fetch_layer import FetchLayer
+    from results import past_race_metrics
+
+    with FetchLayer() as layer:
+        urls = {rid: RaceId.parse(rid).past_url for rid in race_ids if rid not in pages}
+        got = layer.get_many(urls.values())
+        pages.update({rid: got[u] for rid, u in urls.items() if not isinstance(got[u], Exception)})
+        runs = [p for rid in race_ids if rid in pages for p in past_race_ids(pages[rid])]
+        metrics, fetched = past_race_metrics(layer, runs, store)
+    print(f"[INFO] 過去走のレース: のべ {len(runs)} 走 → 重複なし {len(set(runs))} レース"
+          f"（結果ページを取得 {fetched} / 補強できた {len(metrics)}）")
+    return metrics
+
+def attach_past_metrics(df: pd.DataFrame, metrics: dict[int, dict]) -> pd.DataFrame:
+    """各走の race_id と horse_id で引いて {label}_上がり順位 / _勝ち馬差 / _頭数 の列を足す（分からない走は空）"""
+    df = df.copy()
+    for label in PAST_LABELS:
+        vals = [metrics.get(rid, {}).get(hid, (None, None, None))
+                for rid, hid in zip(df[f"{label}_race_id"], df["horse_id"])]
+        for name, col, dtype in zip(("上がり順位", "勝ち馬差", "頭数"), zip(*vals) if vals else ((), (), ()),
+                                    ("Int64", "Float64", "Int64")):
+            df[f"{label}_{name}"] = pd.array(list(col), dtype=dtype)
+    return df
+
+# ===================== シート XML の並列生成 =====================
+def _init_render_worker():
+    # fork した子プロセスが親の keep-alive 接続を共有しないようにセッションを作り直す
+    global SESSION
+    SESSION = build_session()
+
+def render_race_sheet(win: int, rid: str, html: str | None, template_name: str, part: str,
+                      col_map: dict[str, int], skip: frozenset, sidecar: bool = False, store: bool = True,
+                      metrics: dict[int, dict] | None = None):
+    """
+    1 レース分の馬柱をテンプレートのシート XML に書き込んで返す（ワーカープロセスで実行）。
+    戻り値は (シート名の元, シート XML, エラーメッセージ)。失敗時は XML が None。
+    metrics（enrich_past_runs の戻り値）を渡すと過去走ごとの上がり順位・勝ち馬差・頭数の列を足す。
+    """
+    try:
+        race_id = RaceId.parse(rid)
+        if html is None:
+            html = fetch_html(race_id.past_url)
+        race_date, name, place, rnum = _extract_race_meta(html, race_id)
+        remember_race(race_date, rid)
+        title = f"{place}{rnum}_{name}" if place and rnum else name
+
+        # ストアを使う時は既知の過去走（馬ID×出走日）を再利用し、新しい走だけをパースして足す
+        df, new_runs, reused = extract_horse_runs(html, lookup_known_runs if store else None)
+        if store:
+            write_store("horse_runs", rid, new_runs)
+            print(f"[INFO] {rid}: 過去走 {len(new_runs)} 件をパース（既知 {reused} 件を再利用）")
+        if metrics is not None:
+            df = attach_past_metrics(df, metrics)
+        if sidecar:
+            write_sidecar("past_runs", df, rid, race_date,
+                          {"win": win, "race_name": name, "place": place, "race_num": rnum})
+        if store:
+            write_store("past_runs", rid, {"race_date": race_date, "race_name": name, "place": place,
+                                           "race_num": rnum}, df)
+        cells = sheet_cells(df, col_map, skip)
+        with zipfile.ZipFile(TEMPLATE_XLSX) as zf:
+            xml = patch_sheet_xml(zf.read(part), cells)
+        try:
+            # 数式（最速・合計・カウント）の計算結果も入れておく。失敗しても値はそのまま
+            xml = fill_cached_values(xml, formula_program(TEMPLATE_XLSX, template_name).evaluate(cells))
+        except Exception as e:
+            print(f"[WARN] 数式の事前計算に失敗: {rid}: {type(e).__name__}: {e}")
+        return title, xml, None
+    except Exception as e:
+        return "", None, f"{rid}: {type(e).__name__}: {e}"
+
+# ===================== シート XML の並列生成 =====================
+
+# ===================== 出力ブック作成 =====================
+def export_past_runs(race_ids: list[str], out_xlsx: Path, sidecar: bool = False,
+                     pages: dict[str, str] | None = None, workers: int | None = None,
+                     store: bool = True, enrich: bool = False, metrics: dict[int, dict] | None = None) -> list[str]:
+    """
+    race_ids（WIN 順）の馬柱をテンプレートの各シートに書き、out_xlsx に保存する。失敗したレースのメッセージを返す。
+    pages = {race_id: shutuba_past の HTML} を渡すとそのページは取得しない（batch_export.py の先読み分）。
+    各シートの XML はレースごとにプロセス並列で作り（workers、既定 RENDER_WORKERS）、最後に zip にまとめる。
+    スタイル・条件付き書式・sharedStrings などはテンプレートのバイト列をそのまま使う。
+    store=True なら馬柱をレースストア（race_store.py）にも書く。
+    enrich=True なら過去走のレースの結果を重複なく取り、各走の上がり順位・勝ち馬差・頭数を足す（enrich_past_runs）。
+    metrics を渡すとその補強結果を使う（batch_export.py が全日分をまとめて取った分）。
+    """
+    plans = sheet_write_plans(TEMPLATE_XLSX)
+    if len(race_ids) > len(plans):
+        print(f"[WARN] テンプレートシートが足りません（{len(plans)+1}枚目なし）")
+        race_ids = race_ids[:len(plans)]
+    with zipfile.ZipFile(TEMPLATE_XLSX) as zf:
+        parts = [sheet_part(zf, name) for name, _, _ in plans]
+
+    pages = dict(pages or {})
+    if enrich and metrics is None:
+        metrics = enrich_past_runs(race_ids, pages, store)
+    # ワーカーにはそのレースの過去走の分だけ渡す
+    tasks = [(i + 1, rid, pages.get(rid), plans[i][0], parts[i], plans[i][1], plans[i][2], sidecar, store,
+              {p: metrics[p] for p in past_race_ids(pages.get(rid)) if p in metrics} if metrics is not None else None)
+             for i, rid in enumerate(race_ids)]
+    workers = min(len(tasks), workers or RENDER_WORKERS)
+    if workers <= 1:
+        results = [render_race_sheet(*t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as ex:
+            results = list(ex.map(render_race_sheet, *zip(*tasks)))
+
+    # シート名は WIN 順に決める（重複回避のため）
+    used_sheet_names: set[str] = set()
+    errors: list[str] = []
+    extra: dict[str, bytes] = {}
+    renames: dict[str, str] = {}
+    written = 0
+    for (title, xml, err), task in zip(results, tasks):
+        if err:
+            print("[SKIP]", err)
+            errors.append(err)
+            continue
+        sheet_title = safe_sheet_name(title, used_sheet_names)
+        extra[task[4]] = xml
+        renames[task[3]] = sheet_title
+        written += 1
+        print(f"[{written}] {sheet_title} に書き込み完了")
+
+    patch_workbook(TEMPLATE_XLSX, out_xlsx, {}, extra=extra, renames=renames)
+    return errors
+
 def main():
     # オプションで WIN5ページのURL上書きも可
-    url_arg = sys.argv[1] if len(sys.argv) >= 2 else None
+    # --sidecar: 抽出した馬柱を Parquet（win5_cards_export/sidecar.py）にも保存
+    # --no-store: レースストア（win5_cards_export/race_store.py の SQLite）に書かない
+    # --enrich: 過去走のレースの結果を取り、各走の上がり順位・勝ち馬差・頭数を足す（サイドカー・ストア向け）
+    flags = {a for a in sys.argv[1:] if a.startswith("--")}
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    url_arg = args[0] if args else None
+    sidecar = "--sidecar" in flags
+    store = "--no-store" not in flags
+    enrich = "--enrich" in flags
 
     # WIN5 対象レースの race_id を取得
     race_ids, race_date = pick_win5_ids(url_arg)
@@ -456,41 +679,7 @@ def main():
         print(f"テンプレートが見つかりません: {TEMPLATE_XLSX}")
         sys.exit(3)
 
-    # テンプレートをベースにワークブックを開く（書式・条件付き書式を引き継ぐ）
-    wb = load_workbook(TEMPLATE_XLSX)
-    template_sheets = wb.worksheets  # 既存5枚シート
-
-    used_sheet_names: set[str] = set()
-    errors: list[str] = []
-    written = 0
-
-    for idx_r, rid in enumerate(race_ids):
-        if idx_r >= len(template_sheets):
-            print(f"[WARN] テンプレートシートが足りません（{idx_r+1}枚目なし）")
-            break
-
-        ws = template_sheets[idx_r]
-        race_url = f"https://race.netkeiba.com/race/shutuba_past.html?race_id={rid}&rf=shutuba_submenu"
-        try:
-            html = fetch_html(race_url)
-            race_date, name, place, rnum = fetch_shutsuba_with_meta(race_url)
-            sheet_title = name
-            if place and rnum:
-                sheet_title = f"{place}{rnum}_{name}"
-            sheet_title = safe_sheet_name(sheet_title, used_sheet_names)
-            print(f"[{written+1}] {sheet_title} に書き込み中…")
-
-            df = extract_horse_table(html)
-            ws.title = sheet_title
-            write_df_to_sheet(ws, df)
-            print(f"[{written+1}] {sheet_title} に書き込み完了")
-            written += 1
-        except Exception as e:
-            msg = f"{rid}: {type(e).__name__}: {e}"
-            print("[SKIP]", msg)
-            errors.append(msg)
-
-    wb.save(out_xlsx)
+    export_past_runs(race_ids, out_xlsx, sidecar=sidecar, store=store, enrich=enrich)
     print(f"出力完了: {out_xlsx}")
 
 
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+過去の WIN5 開催日をさかのぼって出馬表・馬柱を取得し、レースストアに貯める（モデル用のデータ集め）。
+
+    python backfill.py 20230101-20241231              # 期間の全日（古い日から順に）
+    python backfill.py 20240101-20241231 --rate=20    # 1 分あたりの取得ページ数（既定 20。夜通し回す用の控えめな速さ）
+    python backfill.py 20240101-20241231 --cards-only / --past-only
+    python backfill.py --status                       # ジャーナルの集計だけ表示
+
+- 日付ごとに WIN5 ページ（win5.html?date= → SP 版）で race_id を求め（カレンダー jra.py にある日は取得しない）、
+  5 レースの出馬表・馬柱を共有フェッチ層（fetch_layer.py）で一定の間隔で取得
+- 取得したページはスナップショット（snapshot_archive.py）に残り、パースしてレースストア（race_store.py）に書く
+- 進み具合はジャーナル（output/backfill_journal.jsonl）に 1 行ずつ追記する。落ちても Ctrl-C でも、同じコマンドで続きから
+- 失敗したページは次の実行で取り直す（MAX_ATTEMPTS 回まで）
+"""
+import os
+import sys
+import json
+import time
+import datetime as dt
+
+from pathlib import Path
+from collections import Counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "main-horse"))
+import win5_cards_export as cards
+import main_horse_decide as past
+from fetch_layer import FetchLayer
+from batch_export import PC_DATE_URL, parse_targets
+from jra import RaceId, known_win5, race_date_of, remember_race, remember_win5
+from race_store import write_store, lookup_known_runs
+
+# ===================== 定数 =====================
+JOURNAL_FILE   = Path(__file__).resolve().with_name("output") / "backfill_journal.jsonl"
+RATE_PER_MIN   = 20     # 既定の取得ページ数 / 分
+MAX_ATTEMPTS   = 3      # 1 ページを取り直す回数の上限（実行をまたいで数える）
+PROGRESS_SEC   = 60     # 進捗を表示する間隔（秒）
+PAGES_PER_DAY  = 2      # ETA の初期見積り（WIN5 の無い日が大半なので 1 日あたりのページ数は小さい）
+
+# ===================== ジャーナル =====================
+class Journal:
+    """
+    1 行 1 イベントの JSONL。読み込み時に状態を組み立て直す。
+      day  : WIN5 の race_id が分かった日   none : WIN5 の無い日
+      page : 1 ページの取得・取り込み結果    done : その日の全ページが済んだ
+    """
+    def __init__(self, path: Path = JOURNAL_FILE):
+        self.path = Path(path)
+        self.days: dict[str, list[str]] = {}
+        self.finished: set[str] = set()
+        self.no_win5: set[str] = set()
+        self.pages_ok: set[tuple[str, str]] = set()
+        self.attempts: Counter = Counter()
+        self.seen: dict[tuple, str] = {}
+        if self.path.exists():
+            for n, line in enumerate(self.path.read_text(encoding="utf-8").splitlines(), 1):
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    print(f"[WARN] ジャーナル {n} 行目を読めません（書き込み途中で止まった行は無視）")
+        self._f = None
+
+    def _apply(self, rec: dict):
+        ev, date = rec["event"], rec.get("date")
+        if ev == "day":
+            self.days[date] = rec["race_ids"]
+            self.seen[tuple(rec["race_ids"])] = date
+        elif ev == "none":
+            self.no_win5.add(date)
+            self.finished.add(date)
+        elif ev == "page":
+            key = (rec["kind"], rec["race_id"])
+            self.attempts[key] += 1
+            if rec["ok"]:
+                self.pages_ok.add(key)
+        elif ev == "done":
+            self.finished.add(date)
+
+    def log(self, **rec):
+        """1 行追記してすぐディスクに書く（落ちてもそこまでは残る）"""
+        rec = {"at": dt.datetime.now().isoformat(timespec="seconds"), **rec}
+        if self._f is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._f = open(self.path, "a", encoding="utf-8")
+        self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._apply(rec)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def pending(self, kinds: list[str], race_ids: list[str]) -> list[tuple[str, str]]:
+        """まだ済んでいない（かつ上限まで失敗していない）ページ"""
+        return [(k, r) for r in race_ids for k in kinds
+                if (k, r) not in self.pages_ok and self.attempts[(k, r)] < MAX_ATTEMPTS]
+
+# ===================== 取得・取り込み =====================
+def discover_day(layer: FetchLayer, date: str, journal: Journal) -> list[str] | None:
+    """date の WIN5 race_id 5 つ。WIN5 の無い日は []、取得に失敗した時は None（次の実行でやり直す）"""
+    ids = known_win5(date)
+    if ids:
+        return ids
+    failed = False
+    for u in (PC_DATE_URL.format(date=date), cards.SP_URL.format(date=date)):
+        try:
+            html = layer.get(u)
+        except Exception as e:
+            print(f"[WARN] {date}: {type(e).__name__}: {e}")
+            failed = True
+            continue
+        finally:
+            layer.release(u)
+        ids = cards._extract_ids_from_html(html)[:5]
+        page_date = past._race_date(html)
+        if page_date and page_date != date:
+            return []  # 別の日の WIN5 が出ている = この日は WIN5 なし
+        if len(ids) >= 5:
+            if tuple(ids) in journal.seen or (race_date_of(ids[0]) not in ("", date)):
+                return []
+            if page_date == date:
+                remember_win5(date, ids)
+            return ids
+    return None if failed else []
+
+def page_url(kind: str, race_id: str) -> str:
+    rid = RaceId.parse(race_id)
+    return rid.shutuba_url if kind == "cards" else rid.past_url
+
+def ingest(kind: str, race_id: str, html: str, store: bool = True):
+    """取得したページをパースしてレースストアに書く（Selenium は使わない。パースできなければ例外）"""
+    rid = RaceId.parse(race_id)
+    if kind == "cards":
+        df = cards._extract_table(html)
+        race_date, name, d1, d2, place, rnum = cards._extract_race_meta(html, rid)
+        if df is None or not (name and d1 and d2):
+            raise ValueError("出馬表テーブルが見つかりません。")
+        remember_race(race_date, race_id)
+        if store:
+            write_store("card", race_id, {"race_date": race_date, "race_name": name, "data01": d1, "data02": d2,
+                                          "place": place, "race_num": rnum}, df)
+    else:
+        race_date, name, place, rnum = past._extract_race_meta(html, rid)
+        df, new_runs, _ = past.extract_horse_runs(html, lookup_known_runs if store else None)
+        remember_race(race_date, race_id)
+        if store:
+            write_store("horse_runs", race_id, new_runs)
+            write_store("past_runs", race_id, {"race_date": race_date, "race_name": name, "place": place,
+                                               "race_num": rnum}, df)
+
+# ===================== 進捗 =====================
+def _fmt_eta(sec: float) -> str:
+    m = int(sec // 60)
+    return f"{m // 60}時間{m % 60}分" if m >= 60 else f"{m}分"
+
+class Progress:
+    """この実行で取得したページ数から ページ/分 と残り時間を出す"""
+    def __init__(self, layer: FetchLayer, days_total: int, rate: float):
+        self.layer, self.days_total, self.rate = layer, days_total, rate
+        self.t0 = self.last = time.monotonic()
+        self.days_done = 0
+
+    def report(self, date: str, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last < PROGRESS_SEC:
+            return
+        self.last = now
+        pages, minutes = self.layer.requests, max(now - self.t0, 1e-9) / 60
+        per_min = pages / minutes
+        per_day = pages / self.days_done if self.days_done else PAGES_PER_DAY
+        left = (self.days_total - self.days_done) * per_day / max(per_min if pages else self.rate, 1e-9)
+        print(f"[進捗] {date}: {self.days_done}/{self.days_total} 日・{pages} ページ"
+              f"（{per_min:.1f} ページ/分、残り約 {_fmt_eta(left * 60)}）")
+
+# ===================== 実行 =====================
+def backfill(dates: list[str], kinds: list[str], journal: Journal, rate: float = RATE_PER_MIN,
+             store: bool = True) -> Counter:
+    """dates を古い順に取り込む。結果の件数（日・ページ・失敗）を返す"""
+    todo = [d for d in sorted(dates) if d not in journal.finished]
+    stats = Counter()
+    # 1 ホスト 1 本・開始間隔 60/rate 秒で取る（WIN5 ページの SP 版だけ別ホスト）
+    with FetchLayer(max_concurrency=2, per_host=1, min_interval=60 / rate) as layer:
+        progress = Progress(layer, len(todo), rate)
+        for date in todo:
+            ids = journal.days.get(date)
+            if ids is None:
+                ids = discover_day(layer, date, journal)
+                if ids is None:
+                    stats["discover_failed"] += 1
+                    progress.days_done += 1
+                    continue
+                if not ids:
+                    journal.log(event="none", date=date)
+                    progress.days_done += 1
+                    progress.report(date)
+                    continue
+                journal.log(event="day", date=date, race_ids=ids)
+            stats["days"] += 1
+
+            tasks = journal.pending(kinds, ids)
+            for k, r in tasks:
+                layer.submit(page_url(k, r))  # その日の分を並べておく（間隔はフェッチ層が守る）
+            for k, r in tasks:
+                url = page_url(k, r)
+                try:
+                    ingest(k, r, layer.get(url), store)
+                    journal.log(event="page", date=date, kind=k, race_id=r, ok=True)
+                    stats["pages"] += 1
+                except Exception as e:
+                    print(f"[SKIP] {date} {k} {r}: {type(e).__name__}: {e}")
+                    journal.log(event="page", date=date, kind=k, race_id=r, ok=False, error=f"{type(e).__name__}: {e}")
+                    stats["failed"] += 1
+                finally:
+                    layer.release(url)
+                progress.report(date)
+            if not journal.pending(kinds, ids):
+                journal.log(event="done", date=date)
+            progress.days_done += 1
+            progress.report(date, force=True)
+        stats["requests"] = layer.requests
+    return stats
+
+def print_status(journal: Journal):
+    failed = [k for k, n in journal.attempts.items() if k not in journal.pages_ok]
+    print(f"WIN5 のあった日: {len(journal.days)}  WIN5 なし: {len(journal.no_win5)}  済んだ日: {len(journal.finished)}")
+    print(f"取り込んだページ: {len(journal.pages_ok)}  失敗中: {len(failed)}"
+          f"（うち上限 {MAX_ATTEMPTS} 回に達した: {sum(journal.attempts[k] >= MAX_ATTEMPTS for k in failed)}）")
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    journal = Journal(Path(opts["journal"]) if opts.get("journal") else JOURNAL_FILE)
+    if "status" in opts:
+        print_status(journal)
+        return
+    try:
+        dates = [t.split(":", 1)[1] for t in parse_targets(args, None)]
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    if not dates:
+        print("使い方: python backfill.py YYYYMMDD-YYYYMMDD ... [--rate=20] [--cards-only|--past-only] "
+              "[--no-store] [--journal=path] | --status")
+        sys.exit(2)
+    kinds = [k for k in ("cards", "past")
+             if not (k == "cards" and "past-only" in opts) and not (k == "past" and "cards-only" in opts)]
+    rate = float(opts.get("rate") or RATE_PER_MIN)
+
+    t0 = time.perf_counter()
+    print(f"バックフィル開始: {dates[0]}〜{dates[-1]}（{len(dates)} 日、{rate:g} ページ/分）ジャーナル: {journal.path}")
+    try:
+        stats = backfill(dates, kinds, journal, rate=rate, store="no-store" not in opts)
+    except KeyboardInterrupt:
+        print("\n中断しました。同じコマンドで続きから再開できます。")
+        sys.exit(130)
+    finally:
+        journal.close()
+    print(f"バックフィル完了: WIN5 {stats['days']} 日 / 取り込み {stats['pages']} ページ / 失敗 {stats['failed']} / "
+          f"取得 {stats['requests']} リクエスト / {(time.perf_counter() - t0) / 60:.1f} 分")
+    if stats["discover_failed"]:
+        print(f"[WARN] WIN5 ページを取得できなかった日が {stats['discover_failed']} 日あります（再実行で取り直します）")
+
+if __name__ == "__main__":
+    main()
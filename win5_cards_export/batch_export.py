@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+複数日の WIN5 出馬表（win5_cards_export）と軸馬決定シート（main_horse_decide）をまとめて作る。
+
+    python batch_export.py 20250503 20250504          # 日付を並べる
+    python batch_export.py 20250501-20250531          # 範囲（WIN5 の無い日は飛ばす）
+    python batch_export.py --idx=0,1                  # 今週の土日（WIN5 ページの idx）
+    python batch_export.py 20250504 --cards-only --fast --sidecar --workers=4 --fetch=8
+    python batch_export.py 20250504 --no-store                # レースストア（race_store.py）に書かない
+    python batch_export.py 20250501-20250531 --enrich         # 馬柱の過去走に上がり順位・勝ち馬差・頭数を足す
+
+- ページ取得は親プロセスの共有フェッチ層（fetch_layer.py、同時数・間隔を制限）でまとめて先読み
+- HTML のパースとブック作成は 1 日 × 1 種類ずつワーカープロセスに分散
+- 先読みに失敗したページはワーカー側で通常どおり取得（Selenium フォールバックも含む）
+- --enrich は全日分の馬柱に出てくる過去走のレースを親で重複なくまとめ、結果ページを 1 レース 1 回だけ取る
+"""
+import os
+import re
+import sys
+import time
+import datetime as dt
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "main-horse"))
+import win5_cards_export as cards
+import main_horse_decide as past
+from fetch_layer import FetchLayer, MAX_CONCURRENCY
+from jra import SHUTUBA_URL, PAST_URL, known_win5, remember_win5
+from results import past_race_metrics
+
+# ===================== 定数 =====================
+PC_DATE_URL = "https://race.netkeiba.com/top/win5.html?date={date}"
+PC_IDX_URL  = "https://race.netkeiba.com/top/win5.html?idx={idx}"
+DATE_RE     = re.compile(r"^(\d{8})(?:-(\d{8}))?$")
+
+# ===================== 対象日の解釈 =====================
+def parse_targets(args: list[str], idx_opt: str | None) -> list[str]:
+    """日付（YYYYMMDD / YYYYMMDD-YYYYMMDD / カンマ区切り）と idx 指定を "date:…" / "idx:…" の一覧にする"""
+    targets = []
+    for a in args:
+        for part in a.split(","):
+            m = DATE_RE.match(part.strip())
+            if not m:
+                raise ValueError(f"日付の形式が不正です: {part}（YYYYMMDD または YYYYMMDD-YYYYMMDD）")
+            d0 = dt.datetime.strptime(m.group(1), "%Y%m%d").date()
+            d1 = dt.datetime.strptime(m.group(2), "%Y%m%d").date() if m.group(2) else d0
+            while d0 <= d1:
+                targets.append(f"date:{d0:%Y%m%d}")
+                d0 += dt.timedelta(days=1)
+    for i in filter(None, (idx_opt or "").split(",")):
+        targets.append(f"idx:{int(i)}")
+    return list(dict.fromkeys(targets))
+
+def discover(layer: FetchLayer, targets: list[str]) -> list[tuple[str, list[str]]]:
+    """
+    対象ごとに (開催日, WIN5 の race_id 5 つ) を求める。同じ組み合わせ（別日付で同じページ）は 1 回だけ。
+    カレンダー（jra.py）に WIN5 がある日付は WIN5 ページを取得しない。
+    """
+    urls = {}
+    for t in targets:
+        kind, val = t.split(":")
+        if kind == "date" and known_win5(val):
+            urls[t] = []
+        elif kind == "idx":
+            urls[t] = [PC_IDX_URL.format(idx=val)]
+        else:
+            urls[t] = [PC_DATE_URL.format(date=val), cards.SP_URL.format(date=val)]
+        for u in urls[t]:
+            layer.submit(u)  # 全日分を先に並べて並列に取る
+
+    days, seen = [], set()
+    for t in targets:
+        kind, val = t.split(":")
+        ids, date = (known_win5(val), val) if kind == "date" else ([], "")
+        for u in urls[t]:
+            try:
+                html = layer.get(u)
+            except Exception as e:
+                print(f"[WARN] {t}: {type(e).__name__}: {e}")
+                continue
+            ids = cards._extract_ids_from_html(html)
+            page_date = past._race_date(html)
+            if kind == "idx":
+                date = page_date or ""
+            if len(ids) >= 5:
+                if page_date == date:  # WIN5 の無い日付は別の日のページが返るので、ページの日付と一致した時だけ覚える
+                    remember_win5(date, ids)
+                break
+        ids = ids[:5]
+        if not ids:
+            print(f"[SKIP] {t}: WIN5 対象レースなし")
+            continue
+        if not date:  # 開催日はファイル名と出力の読み戻し（retention / output_loader）のキーになる
+            print(f"[WARN] {t}: ページから開催日を読めないのでスキップします")
+            continue
+        if tuple(ids) in seen:
+            print(f"[SKIP] {t}: 他の日と同じ WIN5（{ids[0]}…）")
+            continue
+        seen.add(tuple(ids))
+        days.append((date, ids))
+    return days
+
+# ===================== ワーカー =====================
+def _run_task(kind: str, date: str, race_ids: list[str], pages: dict[str, str], out: str,
+              fast: bool, sidecar: bool, store: bool = True,
+              metrics: dict | None = None) -> tuple[str, str, str, list[str], float]:
+    """1 日分・1 種類のブックを作る（ワーカープロセスで実行）"""
+    t0 = time.perf_counter()
+    try:
+        if kind == "cards":
+            errors = cards.export_cards(race_ids, Path(out), fast=fast, sidecar=sidecar, pages=pages, store=store)
+        else:
+            errors = past.export_past_runs(race_ids, Path(out), sidecar=sidecar, pages=pages, workers=1,
+                                            store=store, metrics=metrics)
+    except Exception as e:
+        errors = [f"{type(e).__name__}: {e}"]
+    finally:
+        cards.BROWSER.close()
+    return kind, date, out, errors, time.perf_counter() - t0
+
+def _pages(layer: FetchLayer, url_fmt: str, race_ids: list[str]) -> dict[str, str]:
+    """先読み済みのページ（失敗分は含めない＝ワーカーで取り直す）"""
+    got = layer.get_many([url_fmt.format(race_id=r) for r in race_ids])
+    return {r: got[url_fmt.format(race_id=r)] for r in race_ids
+            if isinstance(got[url_fmt.format(race_id=r)], str)}
+
+def _past_metrics(layer: FetchLayer, days: list[tuple], store: bool) -> dict:
+    """--enrich: 全日分の馬柱に出てくる過去走のレースを重複なくまとめて結果を取る"""
+    runs = [p for _, _, pages, _ in days for html in pages.values() for p in past.past_race_ids(html)]
+    metrics, fetched = past_race_metrics(layer, runs, store)
+    print(f"過去走のレース: のべ {len(runs)} 走 → 重複なし {len(set(runs))} レース"
+          f"（結果ページを取得 {fetched} / 補強できた {len(metrics)}）")
+    return metrics
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    try:
+        targets = parse_targets(args, opts.get("idx"))
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    if not targets:
+        print("使い方: python batch_export.py YYYYMMDD[-YYYYMMDD] ... [--idx=0,1] [--cards-only|--past-only] "
+              "[--fast] [--sidecar] [--no-store] [--enrich] [--workers=N] [--fetch=N]")
+        sys.exit(2)
+    kinds = [k for k in ("cards", "past")
+             if not (k == "cards" and "past-only" in opts) and not (k == "past" and "cards-only" in opts)]
+    workers = int(opts.get("workers") or os.cpu_count() or 1)
+    fetch_n = int(opts.get("fetch") or MAX_CONCURRENCY)
+    fast, sidecar, store = "fast" in opts, "sidecar" in opts, "no-store" not in opts
+    enrich = "enrich" in opts
+
+    for tpl in (cards.TEMPLATE_XLSX, past.TEMPLATE_XLSX):
+        if not tpl.exists():
+            print(f"テンプレートが見つかりません: {tpl}")
+            sys.exit(3)
+
+    t0 = time.perf_counter()
+    nowstamp = dt.datetime.now()
+    with FetchLayer(max_concurrency=fetch_n) as layer:
+        days = discover(layer, targets)
+        if not days:
+            print("対象の WIN5 がありません。")
+            sys.exit(2)
+        print(f"{len(days)} 日分: " + ", ".join(d for d, _ in days))
+
+        # 全ページの取得を先に並べる（フェッチ層の同時数制限の中で並列に進む）
+        for _, ids in days:
+            for rid in ids:
+                if "cards" in kinds:
+                    layer.submit(SHUTUBA_URL.format(race_id=rid))
+                if "past" in kinds:
+                    layer.submit(PAST_URL.format(race_id=rid))
+
+        results = []
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            futs, deferred = [], []
+            for i, (date, ids) in enumerate(days):
+                # 日付順に、ページが揃った日からワーカーへ渡す。run_ts は日ごとに 1 秒ずらす
+                # （output_loader のキー (run_ts, win, 馬番) と retention の回の並びが日をまたいで重ならないように）
+                stamp = nowstamp + dt.timedelta(seconds=i)
+                if "cards" in kinds:
+                    out = cards.get_output_dir() / f"Win5出馬表_{stamp:%Y%m%d_%H%M%S}_{date}.xlsx"
+                    futs.append(pool.submit(_run_task, "cards", date, ids, _pages(layer, SHUTUBA_URL, ids),
+                                            str(out), fast, sidecar, store))
+                if "past" in kinds:
+                    pages = _pages(layer, PAST_URL, ids)
+                    if enrich:
+                        deferred.append((date, ids, pages, stamp))  # 全日の馬柱が揃ってから過去走をまとめて補強する
+                        continue
+                    out = past.output_dir() / f"Win5軸馬決定_{date}_{stamp:%Y%m%d%H%M%S}.xlsx"
+                    futs.append(pool.submit(_run_task, "past", date, ids, pages, str(out), False, sidecar, store))
+            if deferred:
+                metrics = _past_metrics(layer, deferred, store)
+                for date, ids, pages, stamp in deferred:
+                    out = past.output_dir() / f"Win5軸馬決定_{date}_{stamp:%Y%m%d%H%M%S}.xlsx"
+                    mine = {p: metrics[p] for html in pages.values() for p in past.past_race_ids(html) if p in metrics}
+                    futs.append(pool.submit(_run_task, "past", date, ids, pages, str(out), False, sidecar, store,
+                                            mine))
+            for f in as_completed(futs):
+                kind, date, out, errors, sec = f.result()
+                results.append((kind, date, out, errors))
+                status = f"{len(errors)} 件失敗" if errors else "OK"
+                print(f"[{date} {kind}] {status}（{sec:.1f} 秒）: {out}")
+        fetched, nbytes = layer.requests, layer.bytes
+
+    failed = sum(len(r[3]) for r in results)
+    print(f"バッチ完了: {len(results)} ブック / 取得 {fetched} ページ（{nbytes / 1e6:.1f}MB）/ "
+          f"失敗 {failed} レース / {time.perf_counter() - t0:.1f} 秒")
+    if failed:
+        for kind, date, _, errors in results:
+            for msg in errors:
+                print(f"[SKIP] {date} {kind}: {msg}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+馬・騎手・レースの整数キー。
+
+netkeiba のリンク（/horse/2021105423/、/jockey/result/recent/01167/）の ID を int64 にして
+DataFrame・レースストアで持つ。名前は表記ゆれ（空白・旧名）があるので結合には使わず、
+ID → 名前の対応表（Names、ストアでは horses / jockeys テーブル）に分けて持つ。
+
+- 馬 ID はほとんど 10 桁の数字だが、外国産馬などは英数字（"000a01234b"）。数字以外を含む ID は
+  36 進で読んで ALNUM_FLAG を立てる（数字だけの ID とは重ならない。decode() で元の文字列に戻る）
+- 騎手・調教師の ID は先頭 0 付きの 5 桁（"01167" → 1167。decode() で桁を戻す）
+- race_id は 12 桁の数字なのでそのまま int（jra.RaceId も int() できる）
+
+    python entities.py 2021105423 000a01234b     # ID ⇔ 整数キーの確認
+    python entities.py --kind=jockey 01167
+"""
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+# ===================== 定数 =====================
+ID_RE = {
+    "horse":   re.compile(r"/horse/(?:ped/|result/)?([0-9A-Za-z]+)"),
+    "jockey":  re.compile(r"/jockey/(?:result/recent/|profile/)?([0-9A-Za-z]+)"),
+    "trainer": re.compile(r"/trainer/(?:result/recent/|profile/)?([0-9A-Za-z]+)"),
+}
+WIDTH = {"horse": 10, "jockey": 5, "trainer": 5, "race": 12}  # decode() で桁を戻す幅
+ALNUM_FLAG = 1 << 62  # 英数字 ID の印（36 進 10 桁 ≒ 3.7e15 なので 2^62 と重ならない）
+ID_DTYPE = "Int64"    # DataFrame の ID 列（欠損があるので nullable int64）
+ROW_RE = re.compile(r'<tr[^>]*class="[^"]*HorseList[^"]*"')  # 出馬表・結果の 1 頭分の行の始まり
+
+# ===================== 変換 =====================
+def encode(s) -> int | None:
+    """ID の文字列 → 整数キー（数字だけならそのまま、英数字は 36 進 + ALNUM_FLAG）。読めなければ None"""
+    if s is None or (isinstance(s, float) and s != s) or s is pd.NA:
+        return None
+    if isinstance(s, (int, np.integer)):
+        return int(s)
+    s = str(s).strip()
+    if s.isdigit():
+        return int(s)
+    if s.isalnum() and s.isascii():
+        return int(s, 36) | ALNUM_FLAG
+    return None
+
+def decode(kind: str, n: int) -> str:
+    """整数キー → netkeiba の ID 文字列（桁・先頭 0・英字を戻す）"""
+    n, width = int(n), WIDTH.get(kind, 0)
+    if not n & ALNUM_FLAG:
+        return f"{n:0{width}d}"
+    n &= ~ALNUM_FLAG
+    digits = ""
+    while n:
+        n, r = divmod(n, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[r] + digits
+    return digits.rjust(width, "0")
+
+def id_from_href(kind: str, href: str | None) -> int | None:
+    m = ID_RE[kind].search(href or "")
+    return encode(m.group(1)) if m else None
+
+def row_ids(kind: str, html: str) -> list[int | None]:
+    """
+    HorseList の行ごとに、その行の最初の kind のリンクの ID（無い行は None）。
+    read_html はリンクを捨てるので、表の行と同じ順に並ぶ ID をここで拾って列にする
+    """
+    rows = ROW_RE.split(html or "")[1:]
+    return [id_from_href(kind, r.split("</tr>", 1)[0]) for r in rows]
+
+def id_column(values, n: int | None = None) -> pd.Series:
+    """ID の並び → Int64 の列。n を渡すと n 行に切り詰める・足りない分は欠損にする"""
+    values = list(values)
+    if n is not None:
+        values = values[:n] + [None] * (n - len(values[:n]))
+    return pd.Series(pd.array([encode(v) for v in values], dtype=ID_DTYPE))
+
+# ===================== 名前の対応表 =====================
+class Names:
+    """
+    (kind, 整数キー) → 名前。同じ名前の文字列は 1 つにまとめて持つ（sys.intern）。
+    最後に見た名前を正とする（改名・表記ゆれは ID が同じなら同じ馬・騎手）
+    """
+    def __init__(self):
+        self._names: dict[str, dict[int, str]] = {}
+
+    def add(self, kind: str, key: int | None, name: str | None) -> str:
+        if not isinstance(name, str):
+            return name  # 欠損（NaN）はそのまま
+        name = sys.intern(re.sub(r"\s+", " ", name).strip())
+        if key is not None and name:
+            self._names.setdefault(kind, {})[key] = name
+        return name
+
+    def get(self, kind: str, key: int | None, default: str = "") -> str:
+        return self._names.get(kind, {}).get(key, default) if key is not None else default
+
+    def items(self, kind: str) -> list[tuple[int, str]]:
+        return list(self._names.get(kind, {}).items())
+
+    def frame(self, kind: str) -> pd.DataFrame:
+        """{kind}_id（Int64）と名前の表（DataFrame と merge して名前を付ける用）"""
+        items = self.items(kind)
+        return pd.DataFrame({f"{kind}_id": pd.array([k for k, _ in items], dtype=ID_DTYPE),
+                             "name": [v for _, v in items]})
+
+NAMES = Names()  # プロセスごとに 1 つ
+
+def remember_names(kind: str, keys, names):
+    """DataFrame の ID 列と名前列を対応表（NAMES）に登録する"""
+    for k, n in zip(keys, names):
+        NAMES.add(kind, encode(k), n)
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    kind = opts.get("kind") or "horse"
+    if not args or kind not in WIDTH:
+        print("使い方: python entities.py [--kind=horse|jockey|trainer|race] <ID> ...")
+        sys.exit(2)
+    for a in args:
+        n = encode(a)
+        print(f"{a} → {n}" + (f" → {decode(kind, n)}" if n is not None else "（読めません）"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+同時数を制限した共有フェッチ層。
+
+バッチ処理（batch_export.py）で複数日・複数スクリプト分のページをまとめて取りに行く時に使う。
+- 全体の同時接続数（max_concurrency）とホストごとの同時数（per_host）を制限
+- ホストごとにリクエスト間隔（min_interval 秒）を空ける
+- 同じ URL は 1 回だけ取得（Future を共有。長時間回す時は release() で手放す）
+- requests.Session はスレッドごとに持つ
+
+HEADERS・build_session()・decode_html_bytes() は win5_cards_export.py・main_horse_decide.py もここから使う
+（単体実行とバッチで User-Agent やリトライ設定がずれないように）。
+"""
+import time
+import threading
+import requests
+
+from requests.adapters import DEFAULT_POOLSIZE
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from bs4 import UnicodeDammit
+
+from snapshot_archive import save_snapshot
+
+# ===================== 定数 =====================
+HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                   "AppleWebKit/537.36 (KHTML, like Gecko) "
+                   "Chrome/120.0.0.0 Safari/537.36"),
+    "Referer": "https://www.netkeiba.com/",
+    "Accept-Language": "ja,en;q=0.9",
+}
+MAX_CONCURRENCY = 8     # 全体の同時取得数
+PER_HOST        = 4     # 1 ホストあたりの同時取得数
+MIN_INTERVAL    = 0.2   # 同一ホストへのリクエスト開始間隔（秒）
+TIMEOUT         = 15
+
+# ===================== ユーティリティ =====================
+def build_session(pool_maxsize: int = DEFAULT_POOLSIZE) -> requests.Session:
+    """HEADERS とリトライ（429・5xx を 3 回まで）付きのセッション"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    s = requests.Session()
+    s.headers.update(HEADERS)
+    retry = Retry(
+        total=3, backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",)
+    )
+    s.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize))
+    s.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize))
+    return s
+
+def decode_html_bytes(b: bytes, fallback: str = "utf-8") -> str:
+    dammit = UnicodeDammit(b, is_html=True)
+    if dammit.unicode_markup:
+        return dammit.unicode_markup
+    return b.decode(fallback, errors="replace")
+
+class _HostGate:
+    """1 ホスト分の同時数と開始間隔の制御"""
+    def __init__(self, limit: int, interval: float):
+        self.sem = threading.BoundedSemaphore(limit)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def __enter__(self):
+        self.sem.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self.sem.release()
+
+# ===================== フェッチ層 =====================
+class FetchLayer:
+    """スレッドで並列に HTML を取る。submit() は Future、get_many() は {url: html} を返す"""
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, per_host: int = PER_HOST,
+                 min_interval: float = MIN_INTERVAL, timeout: int = TIMEOUT):
+        self.per_host = per_host
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="fetch")
+        self._gates: dict[str, _HostGate] = {}
+        self._futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = 0
+        self.bytes = 0
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = build_session(PER_HOST)
+        return s
+
+    def _gate(self, url: str) -> _HostGate:
+        host = urlparse(url).netloc
+        with self._lock:
+            gate = self._gates.get(host)
+            if gate is None:
+                gate = self._gates[host] = _HostGate(self.per_host, self.min_interval)
+            return gate
+
+    def _fetch(self, url: str) -> str:
+        with self._gate(url):
+            r = self._session().get(url, timeout=self.timeout)
+        r.raise_for_status()
+        with self._lock:
+            self.requests += 1
+            self.bytes += len(r.content)
+        save_snapshot(url, r.content)
+        return decode_html_bytes(r.content)
+
+    def submit(self, url: str) -> Future:
+        """取得を予約する（同じ URL は同じ Future を返す）"""
+        with self._lock:
+            fut = self._futures.get(url)
+            if fut is None:
+                fut = self._futures[url] = self._pool.submit(self._fetch, url)
+            return fut
+
+    def get(self, url: str) -> str:
+        return self.submit(url).result()
+
+    def release(self, url: str):
+        """取得済みのページを手放す（長時間の取得でページを溜め込まないように。次の submit は取り直す）"""
+        with self._lock:
+            self._futures.pop(url, None)
+
+    def get_many(self, urls) -> dict[str, str | Exception]:
+        """まとめて取得する。失敗した URL は例外オブジェクトを値にする"""
+        futs = {u: self.submit(u) for u in urls}
+        out = {}
+        for u, f in futs.items():
+            try:
+                out[u] = f.result()
+            except Exception as e:
+                out[u] = e
+        return out
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
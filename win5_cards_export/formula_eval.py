@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+"""
+テンプレートで使っている範囲の Excel 数式を Python 側で計算する。
+
+openpyxl で保存した xlsx は数式の計算結果（キャッシュ値）を持たないため、
+pandas / openpyxl(data_only=True) で読むと 差・人気順 などが None になる。
+ここで計算した値を xlsx_patch.patch_workbook(cached=...) で <v> に書き込む。
+
+対応:
+- 参照 A1 / $A$1 / 範囲 A1:B2、数値・文字列・TRUE/FALSE リテラル
+- 演算子 + - * / ^ & = <> < > <= >=、単項マイナス
+- 関数 IF, IFERROR, OR, AND, NOT, SUM, MIN, MAX, AVERAGE, COUNT, COUNTA, COUNTIF, RANK
+NOW() などの揮発関数・未対応関数を含む式は計算しない（キャッシュ値なし）。
+
+同じ形（R1C1 表記で同一）の数式をグループにまとめ、グループ単位で
+NumPy 配列としてまとめて計算する。
+"""
+import re
+import pickle
+import hashlib
+import numbers
+import numpy as np
+
+from collections import defaultdict
+from openpyxl.utils import column_index_from_string
+
+from xlsx_template import CACHE_DIR, template_hash, load_template
+from xlsx_patch import CellError
+
+# ===================== 定数 =====================
+PROGRAM_VERSION = 1
+BLANK, NUM, STR, BOOL, ERR = 0, 1, 2, 3, 4
+
+TOKEN_RE = re.compile(r"""\s*(?:
+     (?P<str>"(?:[^"]|"")*")
+    |(?P<range>\$?[A-Z]{1,3}\$?\d+\s*:\s*\$?[A-Z]{1,3}\$?\d+)
+    |(?P<ref>\$?[A-Z]{1,3}\$?\d+)(?![\w(])
+    |(?P<bool>TRUE|FALSE)(?![\w(])
+    |(?P<func>[A-Z][A-Z0-9.]*)\s*\(
+    |(?P<num>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+    |(?P<op><>|<=|>=|[-+*/^&=<>(),])
+)""", re.X)
+REF_RE = re.compile(r"(\$?)([A-Z]{1,3})(\$?)(\d+)")
+SUPPORTED = {"IF", "IFERROR", "OR", "AND", "NOT", "SUM", "MIN", "MAX", "AVERAGE",
+             "COUNT", "COUNTA", "COUNTIF", "RANK", "RANK.EQ"}
+
+class Unsupported(Exception):
+    pass
+
+# ===================== 構文解析 =====================
+def _tokenize(text: str) -> list[tuple[str, str]]:
+    out, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise Unsupported(f"解析できない数式: {text!r} @ {pos}")
+        kind = m.lastgroup
+        out.append((kind, m.group(kind)))
+        pos = m.end()
+    return out
+
+def _ref_node(token: str, host: tuple[int, int]) -> tuple:
+    """参照を (ref, 行 or 相対行, 列 or 相対列, 行絶対, 列絶対) にする"""
+    m = REF_RE.fullmatch(token.replace(" ", ""))
+    cabs, col, rabs, row = m.group(1) == "$", column_index_from_string(m.group(2)), m.group(3) == "$", int(m.group(4))
+    return ("ref",
+            row if rabs else row - host[0],
+            col if cabs else col - host[1],
+            rabs, cabs)
+
+class _Parser:
+    """再帰下降パーサ。AST はタプルで、相対参照はホストセルからのオフセットで持つ（R1C1 相当）"""
+    PREC = [("=", "<>", "<", ">", "<=", ">="), ("&",), ("+", "-"), ("*", "/"), ("^",)]
+
+    def __init__(self, text: str, host: tuple[int, int]):
+        self.toks = _tokenize(text)
+        self.i = 0
+        self.host = host
+
+    def peek(self):
+        return self.toks[self.i] if self.i < len(self.toks) else (None, None)
+
+    def take(self, value=None):
+        tok = self.peek()
+        if value is not None and tok[1] != value:
+            raise Unsupported(f"{value} が必要: {tok}")
+        self.i += 1
+        return tok
+
+    def parse(self):
+        node = self.expr(0)
+        if self.i != len(self.toks):
+            raise Unsupported(f"余分なトークン: {self.toks[self.i:]}")
+        return node
+
+    def expr(self, level: int):
+        if level == len(self.PREC):
+            return self.unary()
+        node = self.expr(level + 1)
+        while self.peek()[0] == "op" and self.peek()[1] in self.PREC[level]:
+            op = self.take()[1]
+            node = ("bin", op, node, self.expr(level + 1))
+        return node
+
+    def unary(self):
+        if self.peek() == ("op", "-"):
+            self.take()
+            return ("neg", self.unary())
+        if self.peek() == ("op", "+"):
+            self.take()
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        kind, val = self.take()
+        if kind == "num":
+            return ("num", float(val))
+        if kind == "str":
+            return ("str", val[1:-1].replace('""', '"'))
+        if kind == "bool":
+            return ("bool", val == "TRUE")
+        if kind == "ref":
+            return _ref_node(val, self.host)
+        if kind == "range":
+            a, b = val.split(":")
+            return ("range", _ref_node(a, self.host), _ref_node(b, self.host))
+        if kind == "func":
+            name = val.upper()
+            if name not in SUPPORTED:
+                raise Unsupported(f"未対応の関数: {name}")
+            args = []
+            if self.peek() != ("op", ")"):
+                while True:
+                    args.append(self.expr(0))
+                    if self.peek() == ("op", ","):
+                        self.take()
+                        continue
+                    break
+            self.take(")")
+            return ("func", name, tuple(args))
+        if (kind, val) == ("op", "("):
+            node = self.expr(0)
+            self.take(")")
+            return node
+        raise Unsupported(f"予期しないトークン: {kind} {val}")
+
+def parse_formula(text: str, host: tuple[int, int]) -> tuple:
+    """'=...' の数式を AST にする（未対応なら Unsupported）"""
+    return _Parser(text.lstrip("="), host).parse()
+
+# ===================== 値ベクトル =====================
+class Vec:
+    """セル値のベクトル（1 次元 = ホストごと、2 次元 = ホスト × 範囲内セル）"""
+    __slots__ = ("kind", "num", "txt", "is_ref")
+
+    def __init__(self, kind, num, txt, is_ref=False):
+        self.kind, self.num, self.txt, self.is_ref = kind, num, txt, is_ref
+
+    @classmethod
+    def from_values(cls, vals, shape, is_ref=True) -> "Vec":
+        kind = np.zeros(len(vals), dtype=np.int8)
+        num = np.zeros(len(vals), dtype=np.float64)
+        txt = np.empty(len(vals), dtype=object)
+        for i, v in enumerate(vals):
+            if v is None:
+                continue
+            if isinstance(v, CellError):
+                kind[i], txt[i] = ERR, str(v)
+            elif isinstance(v, bool):
+                kind[i], num[i] = BOOL, float(v)
+            elif isinstance(v, numbers.Number):
+                kind[i], num[i] = NUM, float(v)
+            else:
+                kind[i], txt[i] = STR, str(v)
+        return cls(kind.reshape(shape), num.reshape(shape), txt.reshape(shape), is_ref)
+
+    @classmethod
+    def const(cls, n: int, kind: int, num=0.0, txt=None) -> "Vec":
+        t = np.empty(n, dtype=object)
+        t[:] = txt
+        return cls(np.full(n, kind, dtype=np.int8), np.full(n, float(num)), t)
+
+    @classmethod
+    def errors(cls, err: np.ndarray, base: "Vec") -> "Vec":
+        """err（None 以外がエラー）の要素を ERR に置き換える"""
+        mask = err != None  # noqa: E711 (object 配列の要素比較)
+        if not mask.any():
+            return base
+        kind, txt = base.kind.copy(), base.txt.copy()
+        kind[mask], txt[mask] = ERR, err[mask]
+        return cls(kind, base.num, txt)
+
+    def to_values(self) -> list:
+        out = []
+        for k, n, t in zip(self.kind.tolist(), self.num.tolist(), self.txt.tolist()):
+            if k == NUM:
+                out.append(n)
+            elif k == STR:
+                out.append(t)
+            elif k == BOOL:
+                out.append(bool(n))
+            elif k == ERR:
+                out.append(CellError(t))
+            else:
+                out.append(0.0)  # 空セルだけを参照する式は 0
+        return out
+
+def _first_error(*vecs: Vec) -> np.ndarray:
+    err = np.empty(vecs[0].kind.shape, dtype=object)
+    for v in reversed(vecs):
+        m = v.kind == ERR
+        err[m] = v.txt[m]
+    return err
+
+def _to_num(v: Vec) -> tuple[np.ndarray, np.ndarray]:
+    """算術用の数値化（空=0、論理値=0/1、数値文字列は数値、それ以外の文字列は #VALUE!）"""
+    num = np.where(v.kind == BLANK, 0.0, v.num)
+    err = _first_error(v)
+    for idx in zip(*np.nonzero(v.kind == STR)):
+        try:
+            num[idx] = float(v.txt[idx])
+        except (TypeError, ValueError):
+            err[idx] = "#VALUE!"
+    return num, err
+
+def _to_bool(v: Vec) -> tuple[np.ndarray, np.ndarray]:
+    b = (v.num != 0) & ((v.kind == NUM) | (v.kind == BOOL))
+    err = _first_error(v)
+    for idx in zip(*np.nonzero(v.kind == STR)):
+        t = str(v.txt[idx]).upper()
+        if t in ("TRUE", "FALSE"):
+            b[idx] = t == "TRUE"
+        else:
+            err[idx] = "#VALUE!"
+    return b, err
+
+def _num_text(x: float) -> str:
+    return str(int(x)) if float(x).is_integer() and abs(x) < 1e15 else repr(float(x))
+
+def _as_text(v: Vec) -> np.ndarray:
+    out = np.empty(v.kind.shape, dtype=object)
+    for idx in np.ndindex(v.kind.shape):
+        k = v.kind[idx]
+        out[idx] = (v.txt[idx] if k == STR else _num_text(v.num[idx]) if k == NUM
+                    else ("TRUE" if v.num[idx] else "FALSE") if k == BOOL else "")
+    return out
+
+def _where(cond: np.ndarray, a: Vec, b: Vec) -> Vec:
+    return Vec(np.where(cond, a.kind, b.kind), np.where(cond, a.num, b.num), np.where(cond, a.txt, b.txt))
+
+# ===================== 演算 =====================
+def _arith(op: str, a: Vec, b: Vec) -> Vec:
+    x, ex = _to_num(a)
+    y, ey = _to_num(b)
+    with np.errstate(all="ignore"):
+        if op == "+":
+            r = x + y
+        elif op == "-":
+            r = x - y
+        elif op == "*":
+            r = x * y
+        elif op == "/":
+            r = x / y
+        else:
+            r = np.power(x, y)
+    err = np.where(ex != None, ex, ey)  # noqa: E711
+    if op == "/":
+        err = np.where((err == None) & (y == 0), "#DIV/0!", err)  # noqa: E711
+    err = np.where((err == None) & ~np.isfinite(r), "#NUM!", err)  # noqa: E711
+    return Vec.errors(err, Vec(np.full(r.shape, NUM, dtype=np.int8), r, np.empty(r.shape, dtype=object)))
+
+def _compare(op: str, a: Vec, b: Vec) -> Vec:
+    """Excel の比較（空セルは相手が文字列なら ""、それ以外なら 0。型順は 数値 < 文字列 < 論理値）"""
+    def norm(v: Vec, other: Vec):
+        kind = v.kind.copy()
+        txt = v.txt.copy()
+        blank = kind == BLANK
+        to_str = blank & (other.kind == STR)
+        kind[to_str], txt[to_str] = STR, ""
+        kind[blank & (other.kind == BOOL)] = BOOL
+        kind[kind == BLANK] = NUM
+        return kind, np.where(kind == BLANK, 0.0, v.num), txt
+    ka, na, ta = norm(a, b)
+    kb, nb, tb = norm(b, a)
+    rank = {NUM: 0, STR: 1, BOOL: 2}
+    ra = np.vectorize(rank.get, otypes=[np.int8])(ka)
+    rb = np.vectorize(rank.get, otypes=[np.int8])(kb)
+    # 同じ型同士は値で、違う型は型順で比較する（-1/0/1）
+    cmp = np.sign(ra.astype(np.int16) - rb).astype(np.float64)
+    same = ra == rb
+    cmp[same & (ka != STR)] = np.sign(na - nb)[same & (ka != STR)]
+    for idx in zip(*np.nonzero(same & (ka == STR))):
+        x, y = str(ta[idx]).lower(), str(tb[idx]).lower()
+        cmp[idx] = (x > y) - (x < y)
+    res = {"=": cmp == 0, "<>": cmp != 0, "<": cmp < 0, ">": cmp > 0, "<=": cmp <= 0, ">=": cmp >= 0}[op]
+    out = Vec(np.full(res.shape, BOOL, dtype=np.int8), res.astype(np.float64), np.empty(res.shape, dtype=object))
+    return Vec.errors(_first_error(a, b), out)
+
+def _concat(a: Vec, b: Vec) -> Vec:
+    ta, tb = _as_text(a), _as_text(b)
+    txt = np.array([x + y for x, y in zip(ta.ravel(), tb.ravel())], dtype=object).reshape(ta.shape)
+    out = Vec(np.full(txt.shape, STR, dtype=np.int8), np.zeros(txt.shape), txt)
+    return Vec.errors(_first_error(a, b), out)
+
+# ===================== 関数 =====================
+def _numeric_args(args: list[Vec]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """SUM/MIN 系の引数を (値, 有効フラグ, エラー) の 2 次元配列（ホスト × 値）にまとめる"""
+    nums, valid, errs = [], [], []
+    for v in args:
+        kind, num = v.kind, v.num
+        if kind.ndim == 1:
+            kind, num, txt = kind[:, None], num[:, None], v.txt[:, None]
+        else:
+            txt = v.txt
+        if v.is_ref:
+            ok = kind == NUM  # 参照先の文字列・論理値・空は無視
+            n = num
+        else:
+            n, e = _to_num(Vec(kind, num, txt))
+            ok = e == None  # noqa: E711
+            errs.append(e)
+        err = np.where(kind == ERR, txt, None)
+        nums.append(n)
+        valid.append(ok)
+        errs.append(err)
+    num = np.concatenate(nums, axis=1)
+    ok = np.concatenate(valid, axis=1)
+    err_all = np.concatenate([e if e.ndim == 2 else e[:, None] for e in errs], axis=1)
+    first_err = np.array([next((x for x in row if x is not None), None) for row in err_all], dtype=object)
+    return num, ok, first_err
+
+def _num_vec(r: np.ndarray, err: np.ndarray) -> Vec:
+    out = Vec(np.full(r.shape, NUM, dtype=np.int8), r, np.empty(r.shape, dtype=object))
+    return Vec.errors(err, out)
+
+def _criteria_match(rng: Vec, crit: Vec) -> np.ndarray:
+    """COUNTIF の条件一致（ホスト × 範囲内セル の bool）"""
+    n, k = rng.kind.shape
+    out = np.zeros((n, k), dtype=bool)
+    # 範囲内の数値文字列も数値として比較する
+    rnum = rng.num.copy()
+    rnum_ok = rng.kind == NUM
+    for idx in zip(*np.nonzero(rng.kind == STR)):
+        try:
+            rnum[idx] = float(rng.txt[idx])
+            rnum_ok[idx] = True
+        except (TypeError, ValueError):
+            pass
+    rtxt = np.where(rng.kind == STR, rng.txt, None)
+
+    num_crit = crit.kind == NUM
+    out[num_crit] = rnum_ok[num_crit] & (rnum[num_crit] == crit.num[num_crit, None])
+    for i in np.nonzero(~num_crit)[0]:
+        if crit.kind[i] == BOOL:
+            out[i] = (rng.kind[i] == BOOL) & (rng.num[i] == crit.num[i])
+            continue
+        if crit.kind[i] == BLANK:
+            continue
+        c = str(crit.txt[i])
+        m = re.match(r"^(<>|<=|>=|=|<|>)?(.*)$", c, re.S)
+        op, val = m.group(1) or "=", m.group(2)
+        try:
+            x = float(val)
+            if op == "<>":
+                # <> は数値以外（空・文字列）も一致扱い
+                out[i] = ~(rnum_ok[i] & (rnum[i] == x))
+            else:
+                cmp = {"=": rnum[i] == x, "<": rnum[i] < x, ">": rnum[i] > x,
+                       "<=": rnum[i] <= x, ">=": rnum[i] >= x}[op]
+                out[i] = rnum_ok[i] & cmp
+        except ValueError:
+            pat = re.compile("^" + re.escape(val.lower()).replace(r"\*", ".*").replace(r"\?", ".") + "$", re.S)
+            hit = np.array([t is not None and bool(pat.match(str(t).lower())) for t in rtxt[i]], dtype=bool)
+            if op == "=" and val == "":
+                hit = rng.kind[i] == BLANK
+            out[i] = ~hit if op == "<>" else hit
+    return out
+
+def _call(name: str, args: list[Vec], n: int) -> Vec:
+    if name == "IF":
+        cond, err = _to_bool(args[0])
+        a = args[1] if len(args) > 1 else Vec.const(n, BOOL, 1.0)
+        b = args[2] if len(args) > 2 else Vec.const(n, BOOL, 0.0)
+        return Vec.errors(err, _where(cond, a, b))
+    if name == "IFERROR":
+        return _where(args[0].kind == ERR, args[1], args[0])
+    if name in ("OR", "AND"):
+        bools, seen, errs = [], [], []
+        for v in args:
+            b, e = _to_bool(v)
+            usable = (v.kind == NUM) | (v.kind == BOOL) if v.is_ref else np.ones(v.kind.shape, dtype=bool)
+            if b.ndim == 1:
+                b, usable, e = b[:, None], usable[:, None], e[:, None]
+            bools.append(b)
+            seen.append(usable)
+            errs.append(np.where(usable | (v.kind.reshape(b.shape) == ERR), e, None))
+        b, usable = np.concatenate(bools, axis=1), np.concatenate(seen, axis=1)
+        e_all = np.concatenate(errs, axis=1)
+        res = (b & usable).any(axis=1) if name == "OR" else (b | ~usable).all(axis=1)
+        err = np.array([next((x for x in row if x is not None), None) for row in e_all], dtype=object)
+        err = np.where((err == None) & ~usable.any(axis=1), "#VALUE!", err)  # noqa: E711
+        out = Vec(np.full(n, BOOL, dtype=np.int8), res.astype(np.float64), np.empty(n, dtype=object))
+        return Vec.errors(err, out)
+    if name == "NOT":
+        b, err = _to_bool(args[0])
+        return Vec.errors(err, Vec(np.full(n, BOOL, dtype=np.int8), (~b).astype(np.float64), np.empty(n, dtype=object)))
+    if name in ("SUM", "MIN", "MAX", "AVERAGE", "COUNT"):
+        num, ok, err = _numeric_args(args)
+        cnt = ok.sum(axis=1)
+        if name == "SUM":
+            r = np.where(ok, num, 0.0).sum(axis=1)
+        elif name == "MIN":
+            r = np.where(cnt > 0, np.where(ok, num, np.inf).min(axis=1), 0.0)
+        elif name == "MAX":
+            r = np.where(cnt > 0, np.where(ok, num, -np.inf).max(axis=1), 0.0)
+        elif name == "COUNT":
+            r = cnt.astype(np.float64)
+            err = np.full(n, None, dtype=object)  # COUNT はエラーを数えないだけ
+        else:
+            with np.errstate(all="ignore"):
+                r = np.where(ok, num, 0.0).sum(axis=1) / cnt
+            err = np.where((err == None) & (cnt == 0), "#DIV/0!", err)  # noqa: E711
+        return _num_vec(r, err)
+    if name == "COUNTA":
+        r = sum(((v.kind != BLANK).reshape(n, -1)).sum(axis=1) for v in args).astype(np.float64)
+        return _num_vec(r, np.full(n, None, dtype=object))
+    if name == "COUNTIF":
+        rng, crit = args
+        if rng.kind.ndim == 1:
+            rng = Vec(rng.kind[:, None], rng.num[:, None], rng.txt[:, None], True)
+        r = _criteria_match(rng, crit).sum(axis=1).astype(np.float64)
+        return Vec.errors(_first_error(crit), _num_vec(r, np.full(n, None, dtype=object)))
+    if name in ("RANK", "RANK.EQ"):
+        x, err = _to_num(args[0])
+        rng = args[1]
+        if rng.kind.ndim == 1:
+            rng = Vec(rng.kind[:, None], rng.num[:, None], rng.txt[:, None], True)
+        desc = True
+        if len(args) > 2:
+            o, _ = _to_num(args[2])
+            desc = o == 0
+        ok = rng.kind == NUM
+        vals = rng.num
+        found = (ok & (vals == x[:, None])).any(axis=1)
+        greater = (ok & (vals > x[:, None])).sum(axis=1)
+        less = (ok & (vals < x[:, None])).sum(axis=1)
+        r = np.where(desc, greater, less).astype(np.float64) + 1
+        err = np.where((err == None) & ~found, "#N/A", err)  # noqa: E711
+        return _num_vec(r, err)
+    raise Unsupported(name)
+
+# ===================== 数式グループ =====================
+def _targets(node, hosts: list[tuple[int, int]]) -> list:
+    """参照ノードの参照先セルをホストごとに返す（ref: [(r,c)], range: [[(r,c), ...]]）"""
+    def one(ref, h):
+        _, r, c, rabs, cabs = ref
+        return (r if rabs else h[0] + r, c if cabs else h[1] + c)
+    if node[0] == "ref":
+        return [one(node, h) for h in hosts]
+    a, b = node[1], node[2]
+    out = []
+    for h in hosts:
+        (r1, c1), (r2, c2) = one(a, h), one(b, h)
+        out.append([(r, c) for r in range(min(r1, r2), max(r1, r2) + 1)
+                           for c in range(min(c1, c2), max(c1, c2) + 1)])
+    return out
+
+def _walk_refs(node):
+    if node[0] in ("ref", "range"):
+        yield node
+    elif node[0] == "bin":
+        yield from _walk_refs(node[2])
+        yield from _walk_refs(node[3])
+    elif node[0] == "neg":
+        yield from _walk_refs(node[1])
+    elif node[0] == "func":
+        for a in node[2]:
+            yield from _walk_refs(a)
+
+class FormulaProgram:
+    """1 シート分の数式をグループ化・依存順に並べたもの（テンプレートのハッシュ単位でキャッシュ）"""
+    def __init__(self, sheet: str, groups: list[tuple[tuple, list[tuple[int, int]]]],
+                 base: dict[tuple[int, int], object], skipped: int):
+        self.sheet = sheet
+        self.groups = groups    # [(AST, [ホストセル, ...]), ...]（依存順）
+        self.base = base        # 参照される非数式セルのテンプレート値
+        self.skipped = skipped  # 未対応・循環で計算しない数式セルの数
+        self.inputs = set(base)
+
+    @classmethod
+    def compile(cls, ws) -> "FormulaProgram":
+        by_shape: dict[tuple, list] = defaultdict(list)
+        formula_cells = set()
+        skipped = 0
+        for row in ws.iter_rows():
+            for cell in row:
+                v = cell.value
+                if not (isinstance(v, str) and v.startswith("=")):
+                    continue
+                formula_cells.add((cell.row, cell.column))
+                try:
+                    ast = parse_formula(v, (cell.row, cell.column))
+                except Unsupported:
+                    skipped += 1
+                    continue
+                by_shape[ast].append((cell.row, cell.column))
+
+        # 参照先とグループ間の依存を求める
+        owner = {h: gi for gi, (_, hosts) in enumerate(by_shape.items()) for h in hosts}
+        shapes = list(by_shape.items())
+        deps: list[set[int]] = []
+        base = {}
+        for gi, (ast, hosts) in enumerate(shapes):
+            d = set()
+            for ref in _walk_refs(ast):
+                for t in _targets(ref, hosts):
+                    for rc in (t if isinstance(t, list) else [t]):
+                        if rc in owner:
+                            d.add(owner[rc])
+                        elif rc not in formula_cells:
+                            base[rc] = ws.cell(row=rc[0], column=rc[1]).value
+            d.discard(gi)
+            deps.append(d)
+
+        # トポロジカルソート（循環・自己参照するグループは計算しない）
+        order, done = [], set()
+        pending = set(range(len(shapes)))
+        while pending:
+            ready = [g for g in sorted(pending) if deps[g] <= done]
+            if not ready:
+                break
+            for g in ready:
+                order.append(shapes[g])
+                done.add(g)
+                pending.discard(g)
+        skipped += sum(len(shapes[g][1]) for g in pending)
+        self_ref = [g for g, (ast, hosts) in enumerate(shapes)
+                    if g in done and any(rc in set(hosts) for ref in _walk_refs(ast)
+                                         for t in _targets(ref, hosts)
+                                         for rc in (t if isinstance(t, list) else [t]))]
+        if self_ref:
+            bad = {id(shapes[g]) for g in self_ref}
+            skipped += sum(len(shapes[g][1]) for g in self_ref)
+            order = [x for x in order if id(x) not in bad]
+        return cls(ws.title, order, base, skipped)
+
+    def _eval(self, node, hosts, grid) -> Vec:
+        n = len(hosts)
+        t = node[0]
+        if t == "num":
+            return Vec.const(n, NUM, node[1])
+        if t == "str":
+            return Vec.const(n, STR, txt=node[1])
+        if t == "bool":
+            return Vec.const(n, BOOL, float(node[1]))
+        if t == "ref":
+            return Vec.from_values([grid.get(rc) for rc in _targets(node, hosts)], (n,))
+        if t == "range":
+            cells = _targets(node, hosts)
+            k = len(cells[0])
+            return Vec.from_values([grid.get(rc) for row in cells for rc in row], (n, k))
+        if t == "neg":
+            return _arith("-", Vec.const(n, NUM, 0.0), self._eval(node[1], hosts, grid))
+        if t == "bin":
+            a, b = self._eval(node[2], hosts, grid), self._eval(node[3], hosts, grid)
+            if node[1] in ("+", "-", "*", "/", "^"):
+                return _arith(node[1], a, b)
+            if node[1] == "&":
+                return _concat(a, b)
+            return _compare(node[1], a, b)
+        if t == "func":
+            return _call(node[1], [self._eval(a, hosts, grid) for a in node[2]], n)
+        raise Unsupported(t)
+
+    def evaluate(self, values: dict[tuple[int, int], object] | None = None) -> dict[tuple[int, int], object]:
+        """
+        values（書き込んだセル {(行, 列): 値}）をテンプレート値に重ねて全数式を計算し、
+        {(行, 列): 計算結果} を返す。結果が数値なら float、文字列なら str、エラーは CellError。
+        """
+        grid = dict(self.base)
+        if values:
+            grid.update(values)
+        out = {}
+        for ast, hosts in self.groups:
+            try:
+                res = self._eval(ast, hosts, grid).to_values()
+            except (Unsupported, ValueError, IndexError):
+                continue
+            for h, v in zip(hosts, res):
+                grid[h] = v
+                out[h] = v
+        return out
+
+    def evaluate_ws(self, ws) -> dict[tuple[int, int], object]:
+        """書き込み済みのワークシートから入力セルだけを拾って計算する"""
+        return self.evaluate({rc: ws.cell(row=rc[0], column=rc[1]).value for rc in self.inputs})
+
+# ===================== キャッシュ =====================
+_PROGRAMS: dict[str, FormulaProgram] = {}
+
+def formula_program(template_path, sheet: str) -> FormulaProgram:
+    """テンプレートの内容ハッシュ＋シート単位でキャッシュした FormulaProgram を返す"""
+    key = f"{template_hash(template_path)}_{PROGRAM_VERSION}_{sheet}"
+    prog = _PROGRAMS.get(key)
+    if prog is not None:
+        return prog
+    cache_file = CACHE_DIR / f"formulas_{template_hash(template_path)}_{PROGRAM_VERSION}_{hashlib.sha1(sheet.encode('utf-8')).hexdigest()[:8]}.pickle"
+    try:
+        prog = pickle.loads(cache_file.read_bytes())
+        if prog.sheet != sheet:
+            raise ValueError("sheet mismatch")
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError, AttributeError):
+        prog = FormulaProgram.compile(load_template(template_path)[sheet])
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_file.write_bytes(pickle.dumps(prog, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+    _PROGRAMS[key] = prog
+    return prog
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+JRA の race_id（netkeiba の 12 桁）と開催カレンダー。
+
+    race_id = 年(4) 場コード(2) 回(2) 日目(2) レース番号(2)
+    例: 202505021211 = 2025年 東京(05) 2回 12日目 11R
+
+- RaceId: race_id の分解・組み立て、場名、出馬表・馬柱・オッズ API・結果の URL
+- カレンダー（.cache/jra_calendar.json）: 開催日 → その日の開催（場・回・日目）と WIN5 の race_id。
+  WIN5 ページ・出馬表を取得するたびに覚えていくので、一度見た日は WIN5 ページを取得せずに race_id が分かる
+
+    python jra.py 202505021211                  # race_id を分解して URL を表示
+    python jra.py --date=20250504               # カレンダーにあるその日の開催・WIN5
+    python jra.py --sync=20250501-20250531      # netkeiba のレース一覧から開催を取り込む
+"""
+import os
+import re
+import sys
+import json
+import datetime as dt
+
+from pathlib import Path
+from dataclasses import dataclass, replace
+
+# ===================== 定数 =====================
+VENUES = {
+    1: "札幌", 2: "函館", 3: "福島", 4: "新潟", 5: "東京",
+    6: "中山", 7: "中京", 8: "京都", 9: "阪神", 10: "小倉",
+}
+VENUE_CODES = {name: code for code, name in VENUES.items()}
+PLACE_RE = re.compile("(" + "|".join(VENUES.values()) + ")")  # RaceData02 などの文中から場名を拾う
+RACE_ID_RE = re.compile(r"race_id=(\d{12})")
+RACES_PER_DAY = 12
+
+SHUTUBA_URL = "https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
+PAST_URL    = "https://race.netkeiba.com/race/shutuba_past.html?race_id={race_id}&rf=shutuba_submenu"
+ODDS_URL    = "https://race.netkeiba.com/api/api_get_jra_odds.html?race_id={race_id}&type=1&action=update"
+RESULT_URL  = "https://race.netkeiba.com/race/result.html?race_id={race_id}"
+RACE_LIST_URL = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={date}"
+
+CALENDAR_FILE = Path(os.environ.get(
+    "WIN5_CALENDAR_FILE",
+    str(Path(__file__).resolve().with_name(".cache") / "jra_calendar.json"),
+))
+
+# ===================== race_id =====================
+@dataclass(frozen=True, order=True)
+class RaceId:
+    """12 桁の race_id を分解したもの。str() で元の 12 桁に戻る"""
+    year: int
+    venue: int
+    kai: int
+    day: int
+    race: int
+
+    @classmethod
+    def parse(cls, s) -> "RaceId":
+        s = str(s).strip()
+        if not (len(s) == 12 and s.isdigit()):
+            raise ValueError(f"race_id は 12 桁の数字です: {s!r}")
+        return cls(int(s[:4]), int(s[4:6]), int(s[6:8]), int(s[8:10]), int(s[10:12]))
+
+    @classmethod
+    def from_url(cls, url: str) -> "RaceId | None":
+        m = RACE_ID_RE.search(url or "")
+        return cls.parse(m.group(1)) if m else None
+
+    def __str__(self) -> str:
+        return f"{self.year:04d}{self.venue:02d}{self.kai:02d}{self.day:02d}{self.race:02d}"
+
+    def __int__(self) -> int:
+        """DataFrame・レースストアの整数キー（entities.py）"""
+        return int(str(self))
+
+    @property
+    def meeting(self) -> str:
+        """開催（年・場・回・日目）を表す先頭 10 桁"""
+        return str(self)[:10]
+
+    @property
+    def venue_name(self) -> str:
+        return VENUES.get(self.venue, "")
+
+    @property
+    def is_jra(self) -> bool:
+        return self.venue in VENUES
+
+    @property
+    def label(self) -> str:
+        return f"{self.year}年 {self.venue_name or self.venue}{self.kai}回{self.day}日目 {self.race}R"
+
+    def with_race(self, race: int) -> "RaceId":
+        return replace(self, race=race)
+
+    @property
+    def shutuba_url(self) -> str:
+        return SHUTUBA_URL.format(race_id=self)
+
+    @property
+    def past_url(self) -> str:
+        return PAST_URL.format(race_id=self)
+
+    @property
+    def odds_url(self) -> str:
+        return ODDS_URL.format(race_id=self)
+
+    @property
+    def result_url(self) -> str:
+        return RESULT_URL.format(race_id=self)
+
+def race_ids_in(html: str) -> list[str]:
+    """文中の race_id=… を出てきた順に重複なく"""
+    return list(dict.fromkeys(RACE_ID_RE.findall(html or "")))
+
+# ===================== 開催カレンダー =====================
+class Calendar:
+    """
+    開催日（YYYYMMDD）→ 開催（race_id 先頭 10 桁）の一覧と WIN5 の race_id 5 つ。
+    記録するたびに JSON に書き戻す（他プロセスが書いた分は読み直してマージする）。
+    """
+    def __init__(self, path: Path = CALENDAR_FILE):
+        self.path = Path(path)
+        self.meetings, self.win5 = self._read()
+        self._dates = {m: d for d, ms in self.meetings.items() for m in ms}
+
+    def _read(self) -> tuple[dict[str, list[str]], dict[str, list[str]]]:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            return dict(data.get("meetings") or {}), dict(data.get("win5") or {})
+        except FileNotFoundError:
+            return {}, {}
+        except (OSError, ValueError) as e:
+            print(f"[WARN] カレンダーを読めません（空から始めます）: {self.path}: {type(e).__name__}: {e}")
+            return {}, {}
+
+    def save(self):
+        meetings, win5 = self._read()
+        for d, ms in self.meetings.items():
+            meetings[d] = sorted(set(meetings.get(d, [])) | set(ms))
+        win5.update(self.win5)
+        self.meetings, self.win5 = meetings, win5
+        self._dates = {m: d for d, ms in meetings.items() for m in ms}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"meetings": dict(sorted(meetings.items())), "win5": dict(sorted(win5.items()))},
+                                  ensure_ascii=False, indent=1), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def add_race(self, date: str, race_id) -> bool:
+        """race_id が date の開催であることを記録する（新しい情報なら True）"""
+        meeting = RaceId.parse(race_id).meeting
+        if self._dates.get(meeting) == date:
+            return False
+        self.meetings.setdefault(date, [])
+        if meeting not in self.meetings[date]:
+            self.meetings[date] = sorted(self.meetings[date] + [meeting])
+        self._dates[meeting] = date
+        return True
+
+    def add_win5(self, date: str, race_ids: list[str]) -> bool:
+        ids = [str(RaceId.parse(r)) for r in race_ids[:5]]
+        changed = [self.add_race(date, r) for r in ids]  # 各レースの開催も覚える
+        if len(ids) == 5 and self.win5.get(date) != ids:
+            self.win5[date] = ids
+            return True
+        return any(changed)
+
+    def date_of(self, race_id) -> str:
+        """race_id の開催日（知らなければ ""）"""
+        return self._dates.get(RaceId.parse(race_id).meeting, "")
+
+    def meetings_on(self, date: str) -> list[RaceId]:
+        return [RaceId.parse(m + "01") for m in self.meetings.get(date, [])]
+
+    def race_ids_on(self, date: str, races=range(1, RACES_PER_DAY + 1)) -> list[RaceId]:
+        """その日の全レースの race_id（開催 × レース番号。取得せずに組み立てる）"""
+        return [m.with_race(r) for m in self.meetings_on(date) for r in races]
+
+    def win5_on(self, date: str) -> list[str]:
+        return list(self.win5.get(date, []))
+
+_CALENDARS: dict[tuple[str, int], Calendar] = {}
+
+def calendar(path: Path = CALENDAR_FILE) -> Calendar:
+    """プロセスごとに 1 つ使い回す"""
+    key = (str(Path(path).resolve()), os.getpid())
+    cal = _CALENDARS.get(key)
+    if cal is None:
+        cal = _CALENDARS[key] = Calendar(path)
+    return cal
+
+# ===================== 各スクリプトからの入口 =====================
+def known_win5(date: str | None) -> list[str]:
+    """カレンダーにある date の WIN5 race_id（無ければ []）"""
+    return calendar().win5_on(date) if date else []
+
+def race_date_of(race_id) -> str:
+    try:
+        return calendar().date_of(race_id)
+    except ValueError:
+        return ""
+
+def remember_win5(date: str, race_ids: list[str]):
+    """WIN5 の race_id と開催日を覚える。失敗しても呼び出し側は止めない"""
+    if not (date and re.fullmatch(r"\d{8}", date)) or len(race_ids) < 5:
+        return
+    try:
+        cal = calendar()
+        if cal.add_win5(date, race_ids):
+            cal.save()
+    except (OSError, ValueError) as e:
+        print(f"[WARN] カレンダーの更新に失敗: {date}: {type(e).__name__}: {e}")
+
+def remember_race(date: str | None, race_id):
+    if not (date and re.fullmatch(r"\d{8}", date)):
+        return
+    try:
+        cal = calendar()
+        if cal.add_race(date, race_id):
+            cal.save()
+    except (OSError, ValueError) as e:
+        print(f"[WARN] カレンダーの更新に失敗: {race_id}: {type(e).__name__}: {e}")
+
+def sync(dates: list[str], layer=None) -> int:
+    """netkeiba のレース一覧（1 日 1 ページ）から開催を取り込む。取り込んだ日数を返す（layer は fetch_layer.FetchLayer）"""
+    from fetch_layer import FetchLayer
+    cal, n = calendar(), 0
+    urls = [RACE_LIST_URL.format(date=d) for d in dates]
+    if layer is None:
+        with FetchLayer() as own:
+            got = own.get_many(urls)
+    else:
+        got = layer.get_many(urls)
+        for u in urls:
+            layer.release(u)
+    for d in dates:
+        html = got[RACE_LIST_URL.format(date=d)]
+        if isinstance(html, Exception):
+            print(f"[WARN] {d}: {type(html).__name__}: {html}")
+            continue
+        ids = [r for r in race_ids_in(html) if RaceId.parse(r).is_jra]
+        for r in ids:
+            cal.add_race(d, r)
+        n += bool(ids)
+    cal.save()
+    return n
+
+# ===================== メイン =====================
+def _date_range(spec: str) -> list[str]:
+    a, _, b = spec.partition("-")
+    d0 = dt.datetime.strptime(a, "%Y%m%d").date()
+    d1 = dt.datetime.strptime(b or a, "%Y%m%d").date()
+    return [(d0 + dt.timedelta(days=i)).strftime("%Y%m%d") for i in range((d1 - d0).days + 1)]
+
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if opts.get("sync"):
+        dates = _date_range(opts["sync"])
+        print(f"開催を取り込み: {sync(dates)} / {len(dates)} 日")
+    elif opts.get("date"):
+        cal = calendar()
+        for m in cal.meetings_on(opts["date"]):
+            print(f"{m.meeting}  {m.venue_name}{m.kai}回{m.day}日目")
+        win5 = cal.win5_on(opts["date"])
+        print("WIN5: " + (", ".join(f"{r}（{RaceId.parse(r).venue_name}{int(r[10:])}R）" for r in win5) or "不明"))
+    elif args:
+        for a in args:
+            rid = RaceId.parse(a)
+            date = race_date_of(rid)
+            print(f"{rid}  {rid.label}" + (f"  開催日 {date}" if date else ""))
+            print(f"  出馬表: {rid.shutuba_url}\n  馬柱:   {rid.past_url}\n  オッズ: {rid.odds_url}\n  結果:   {rid.result_url}")
+    else:
+        print("使い方: python jra.py <race_id> ... | --date=YYYYMMDD | --sync=YYYYMMDD[-YYYYMMDD]")
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+output/ に溜まった Win5出馬表_*.xlsx をまとめて 1 つの DataFrame に読み込む。
+
+- openpyxl の read_only=True / data_only=True で、オッズデータ入力シートのうち
+  レイアウト（discover_odds_layout）が示す範囲だけを読む（値だけなのでスタイルも読まない）
+- 複数ファイルはプロセス並列で読む
+- 1 ファイルごとの結果を .cache/outputs/ に保存し、ファイルの mtime・サイズが同じなら読み直さない
+
+    python output_loader.py                       # output/ 以下すべて
+    python output_loader.py output/ --out=all.pkl  # 保存（.csv / .pkl / .parquet）
+    python output_loader.py a.xlsx b.xlsx --workers=4 --no-cache
+
+戻り値は (run_ts, win, 馬番) を index にした縦長の DataFrame。
+"""
+import os
+import re
+import sys
+import time
+import pickle
+import hashlib
+import datetime as dt
+import pandas as pd
+
+from pathlib import Path
+from dataclasses import asdict
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import load_workbook
+from openpyxl.reader.excel import ExcelReader
+
+from xlsx_template import CACHE_DIR, HEADER_FIELDS, OddsLayout, discover_odds_layout
+from xlsx_patch import read_custom_props
+
+# ===================== 定数 =====================
+TEMPLATE_XLSX = Path(__file__).resolve().with_name("race_cards.xlsx")
+OUTPUT_DIR    = Path(__file__).resolve().with_name("output")
+ODDS_SHEET    = "オッズデータ入力"
+OUTPUT_GLOB   = "Win5出馬表_*.xlsx"
+RUN_TS_RE     = re.compile(r"(\d{8}_\d{6})")
+RACE_IDS_PROP = "win5_race_ids"   # win5_cards_export.RACE_IDS_PROP と同じ
+LOADER_VERSION = 1
+OUTPUT_CACHE_DIR = CACHE_DIR / "outputs"
+KEY_COLS = ["run_ts", "win", "馬番"]
+
+# ===================== 1 ファイル読み込み =====================
+class _ValuesReader(ExcelReader):
+    """スタイル・テーマを読まない read_only リーダー（load_workbook の時間の大半は styles.xml の解析）"""
+    def read(self):
+        self.read_manifest()
+        self.read_strings()
+        self.read_workbook()
+        self.read_properties()
+        self.read_worksheets()
+
+def _open_values_only(path: Path):
+    try:
+        reader = _ValuesReader(path, read_only=True, data_only=True)
+        reader.read()
+        return reader.wb
+    except Exception:
+        # openpyxl の内部が変わった場合などは通常の読み込み
+        return load_workbook(path, read_only=True, data_only=True)
+
+def _time_text(v):
+    """発走時刻をスタイル無しで読むと時刻シリアル値（1 日 = 1.0）になるので HH:MM に戻す"""
+    if isinstance(v, (int, float)) and 0 <= v < 1:
+        minutes = round(v * 24 * 60)
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+    if isinstance(v, (dt.time, dt.datetime)):
+        return v.strftime("%H:%M")
+    return v
+
+def _run_ts(path: Path) -> dt.datetime:
+    """ファイル名の YYYYMMDD_HHMMSS を実行時刻とする（無ければ mtime）"""
+    m = RUN_TS_RE.search(path.stem)
+    if m:
+        return dt.datetime.strptime(m.group(1), "%Y%m%d_%H%M%S")
+    return dt.datetime.fromtimestamp(path.stat().st_mtime)
+
+def _read_output(path: str, layout: dict) -> pd.DataFrame:
+    """出力ブック 1 冊を区画ごとの行に展開する（プロセス並列のワーカーからも呼ぶ）"""
+    path = Path(path)
+    lay = OddsLayout(**layout)
+    span = max(lay.col_offsets.values()) + 1
+    header_row = lay.start_row - 1
+    top = min([header_row, *lay.meta_rows.values()])
+    first, last = min(lay.section_cols), max(lay.section_cols) + span - 1
+    try:
+        race_ids = read_custom_props(path).get(RACE_IDS_PROP, "").split(",")
+    except Exception:
+        race_ids = []
+
+    wb = _open_values_only(path)
+    try:
+        if ODDS_SHEET not in wb.sheetnames:
+            # 旧形式の出力（空の結果をキャッシュして次回からは開かない）
+            print(f"[SKIP] {path.name}: {ODDS_SHEET} シートがありません")
+            return pd.DataFrame()
+        ws = wb[ODDS_SHEET]
+        # 必要な矩形を 1 回だけ走査する
+        block = {r: row for r, row in enumerate(
+            ws.iter_rows(min_row=top, max_row=lay.end_row, min_col=first, max_col=last, values_only=True),
+            start=top)}
+    finally:
+        wb.close()
+
+    run_ts = _run_ts(path)
+    records = []
+    for win, col in enumerate(lay.section_cols, start=1):
+        base = col - first
+
+        def cell(r: int, off: int):
+            row = block.get(r, ())
+            return row[base + off] if base + off < len(row) else None
+
+        # 列名: レイアウトの書き込み列＋ヘッダー行の数式列（差・人気順 など）
+        names = {off: name for name, off in lay.col_offsets.items()}
+        for off in range(span):
+            h = cell(header_row, off)
+            if off not in names and isinstance(h, str) and h.strip():
+                names[off] = HEADER_FIELDS.get(h.strip(), h.strip())
+        meta = {k: cell(r, 0) for k, r in lay.meta_rows.items()}
+        race_id = race_ids[win - 1] if win - 1 < len(race_ids) and race_ids[win - 1] else None
+
+        for r in range(lay.start_row, lay.end_row + 1):
+            rec = {name: cell(r, off) for off, name in names.items()}
+            if rec.get("馬番") in (None, ""):
+                continue
+            rec.update(run_ts=run_ts, win=win, race_id=race_id,
+                       発走時刻=_time_text(meta.get("time")), レース名=meta.get("name"), コース=meta.get("course"),
+                       file=path.name)
+            records.append(rec)
+    return pd.DataFrame.from_records(records)
+
+# ===================== キャッシュ =====================
+def _cache_file(path: Path) -> Path:
+    return OUTPUT_CACHE_DIR / f"{hashlib.sha1(str(path.resolve()).encode('utf-8')).hexdigest()[:16]}.pickle"
+
+def _stamp(path: Path, layout: dict) -> tuple:
+    st = path.stat()
+    return (LOADER_VERSION, st.st_mtime_ns, st.st_size, repr(sorted(layout.items())))
+
+def _load_cached(path: Path, layout: dict) -> pd.DataFrame | None:
+    try:
+        stamp, df = pickle.loads(_cache_file(path).read_bytes())
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+        return None
+    return df if stamp == _stamp(path, layout) else None
+
+def _store_cached(path: Path, layout: dict, df: pd.DataFrame):
+    try:
+        OUTPUT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _cache_file(path).write_bytes(pickle.dumps((_stamp(path, layout), df), protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+
+# ===================== まとめて読み込み =====================
+def output_files(paths=None) -> list[Path]:
+    """ファイル・ディレクトリの指定から出力ブックの一覧を作る（既定は output/）"""
+    files = []
+    for p in map(Path, paths or [OUTPUT_DIR]):
+        if p.is_dir():
+            files.extend(sorted(p.glob(OUTPUT_GLOB)))
+        elif p.suffix.lower() == ".xlsx" and p.exists():
+            files.append(p)
+    return files
+
+def _finish(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=KEY_COLS).set_index(KEY_COLS)
+    df = pd.concat(frames, ignore_index=True)
+    df["run_ts"] = pd.to_datetime(df["run_ts"])
+    df["win"] = df["win"].astype("int8")
+    for c in ("馬番", "人気順"):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype("Int64")
+    for c in ("オッズ", "差", "斤量"):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df.set_index(KEY_COLS).sort_index()
+
+def load_outputs(paths=None, workers: int | None = None, use_cache: bool = True,
+                 layout: OddsLayout | None = None) -> pd.DataFrame:
+    """
+    出力ブックをまとめて読み込み、(run_ts, win, 馬番) を index にした DataFrame を返す。
+    キャッシュに無いファイルだけをプロセス並列で読む。
+    """
+    files = output_files(paths)
+    lay = asdict(layout or discover_odds_layout(TEMPLATE_XLSX, sheet=ODDS_SHEET))
+    frames: dict[Path, pd.DataFrame] = {}
+    misses = []
+    for f in files:
+        df = _load_cached(f, lay) if use_cache else None
+        if df is None:
+            misses.append(f)
+        else:
+            frames[f] = df
+
+    workers = workers or min(len(misses), os.cpu_count() or 1)
+    if len(misses) <= 1 or workers <= 1:
+        results = [_safe_read(f, lay) for f in misses]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(_safe_read, misses, [lay] * len(misses), chunksize=max(1, len(misses) // (workers * 4))))
+    for f, df in zip(misses, results):
+        if df is None:
+            continue
+        frames[f] = df
+        if use_cache:
+            _store_cached(f, lay, df)
+    return _finish([frames[f] for f in files if f in frames])
+
+def _safe_read(path: Path, layout: dict) -> pd.DataFrame | None:
+    try:
+        return _read_output(str(path), layout)
+    except Exception as e:
+        print(f"[SKIP] {path.name}: {type(e).__name__}: {e}")
+        return None
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    paths = [a for a in sys.argv[1:] if not a.startswith("--")]
+    t0 = time.perf_counter()
+    df = load_outputs(paths or None, workers=int(opts["workers"]) if opts.get("workers") else None,
+                      use_cache="no-cache" not in opts)
+    runs = df.index.get_level_values("run_ts").nunique() if len(df) else 0
+    print(f"{runs} 回分 / {len(df)} 行を読み込み（{time.perf_counter() - t0:.2f} 秒）")
+
+    out = opts.get("out")
+    if out:
+        out = Path(out)
+        if out.suffix == ".csv":
+            df.to_csv(out, encoding="utf-8-sig")
+        elif out.suffix == ".parquet":
+            df.to_parquet(out)
+        else:
+            df.to_pickle(out)
+        print(f"保存: {out}")
+    else:
+        with pd.option_context("display.width", 200, "display.max_columns", 20):
+            print(df.head(20))
+
+if __name__ == "__main__":
+    main()
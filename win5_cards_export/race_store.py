@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+"""
+取得したレース情報を貯めておくローカルの SQLite ストア。
+
+win5_cards_export（出馬表・オッズ）と main_horse_decide（馬柱の過去走）が取得のたびに書き込み、
+results.py（結果・払戻）は終わった開催日をまとめて書き込む。分析はスクレイピングし直さずにここから引ける。
+
+    races      レース（race_id・開催日・場所・R・レース名・RaceData01/02）
+    entries    出走馬（race_id × 馬番: 馬名・性齢・斤量・騎手）
+    odds       単勝オッズのスナップショット（race_id × 馬番 × 取得時刻: オッズ・人気順）
+    past_runs  馬柱の過去走（race_id × 馬番 × n: n=1 が前走）。--enrich 時はその走の上がり順位・勝ち馬差・頭数も
+    horses     馬（horse_id: netkeiba の /horse/ リンクの ID）→ 馬名
+    jockeys    騎手（jockey_id: /jockey/ リンクの ID）→ 騎手名
+    horse_runs 馬ごとの出走履歴（horse_id × 出走日）。馬柱に出た過去走を重複なく積み上げる
+    results    レース結果（race_id × 馬番: 着順・タイム・着差・確定オッズ・人気・上がり3F・通過順・馬体重）
+    payouts    払戻（race_id × 券種 × 組番: 払戻金・人気）
+    win5_results WIN5 の結果（開催日: 払戻金・的中票数・キャリーオーバー）
+
+- WAL モード。1 レース分をまとめて 1 トランザクション（executemany）で書く
+- race_id・開催日・馬名・horse_id・騎手に索引を張っている（「この馬の過去走すべて」などは 1ms 未満）
+- race_id・horse_id・jockey_id は INTEGER（entities.py の整数キー）。結合・集計は名前ではなく ID で行い、
+  名前は horses / jockeys で引く。race_id は文字列で渡しても列の型で整数として比べる・書く
+- 馬柱の過去走は known_runs() で既知分を引き、新しい走だけをパースして horse_runs に足す（main_horse_decide）。
+  毎週出てくる馬ほど再パースが減り、馬柱の 5 走より深い履歴が horse_history() で引ける
+- 書き込みに失敗しても呼び出し側（xlsx 出力）は止めない（[WARN] を出すだけ）
+- バッチ（batch_export.py）の複数プロセスから同時に書いても、busy_timeout の範囲で順番に待つ
+
+    python race_store.py                    # 件数の一覧
+    python race_store.py --horse=ドウデュース  # 出走履歴（horse_runs）・出走の一覧
+    python race_store.py --jockey=武豊 --date=20250504
+"""
+import os
+import re
+import sys
+import sqlite3
+import datetime as dt
+import pandas as pd
+
+from pathlib import Path
+
+from entities import encode as _id
+
+# ===================== 定数 =====================
+STORE_DB = Path(os.environ.get(
+    "WIN5_STORE_DB",
+    str(Path(__file__).resolve().with_name("output") / "race_store.sqlite3"),
+))
+SCHEMA_VERSION = 5
+BUSY_TIMEOUT_MS = 10_000
+PAST_LABELS = ["前走", "2走", "3走", "4走"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS races (
+    race_id    TEXT PRIMARY KEY,
+    race_date  TEXT,
+    place      TEXT,
+    race_num   INTEGER,
+    name       TEXT,
+    data01     TEXT,
+    data02     TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    race_id    TEXT NOT NULL,
+    umaban     INTEGER NOT NULL,
+    horse_name TEXT,
+    sex_age    TEXT,
+    weight     REAL,
+    jockey     TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (race_id, umaban)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS odds (
+    race_id    TEXT NOT NULL,
+    umaban     INTEGER NOT NULL,
+    fetched_at TEXT NOT NULL,
+    odds       REAL,
+    popularity INTEGER,
+    PRIMARY KEY (race_id, umaban, fetched_at)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS past_runs (
+    race_id    TEXT NOT NULL,
+    umaban     INTEGER NOT NULL,
+    n          INTEGER NOT NULL,
+    horse_name TEXT,
+    race_name  TEXT,
+    place      TEXT,
+    course     TEXT,
+    finish     TEXT,
+    margin     TEXT,
+    passing    TEXT,
+    last3f     REAL,
+    fetched_at TEXT,
+    PRIMARY KEY (race_id, umaban, n)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_races_date        ON races (race_date);
+CREATE INDEX IF NOT EXISTS idx_entries_horse     ON entries (horse_name);
+CREATE INDEX IF NOT EXISTS idx_entries_jockey    ON entries (jockey);
+CREATE INDEX IF NOT EXISTS idx_odds_fetched      ON odds (race_id, fetched_at);
+CREATE INDEX IF NOT EXISTS idx_past_runs_horse   ON past_runs (horse_name);
+"""
+
+# user_version ごとの追加分（古いストアは connect() で順に当てる）
+MIGRATIONS = {
+    2: """
+ALTER TABLE entries   ADD COLUMN horse_id TEXT;
+ALTER TABLE past_runs ADD COLUMN horse_id TEXT;
+CREATE TABLE IF NOT EXISTS horses (
+    horse_id   TEXT PRIMARY KEY,
+    horse_name TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS horse_runs (
+    horse_id   TEXT NOT NULL,
+    run_date   TEXT NOT NULL,
+    race_name  TEXT,
+    place      TEXT,
+    course     TEXT,
+    finish     TEXT,
+    margin     TEXT,
+    passing    TEXT,
+    last3f     TEXT,
+    source_race_id TEXT,
+    first_seen TEXT,
+    PRIMARY KEY (horse_id, run_date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_entries_horse_id  ON entries (horse_id);
+CREATE INDEX IF NOT EXISTS idx_past_runs_horse_id ON past_runs (horse_id);
+CREATE INDEX IF NOT EXISTS idx_horses_name       ON horses (horse_name);
+""",
+    3: """
+CREATE TABLE IF NOT EXISTS results (
+    race_id    TEXT NOT NULL,
+    umaban     INTEGER NOT NULL,
+    finish     TEXT,
+    rank       INTEGER,
+    waku       INTEGER,
+    horse_name TEXT,
+    horse_id   TEXT,
+    sex_age    TEXT,
+    weight     REAL,
+    jockey     TEXT,
+    time       TEXT,
+    time_sec   REAL,
+    margin     TEXT,
+    popularity INTEGER,
+    odds       REAL,
+    last3f     REAL,
+    passing    TEXT,
+    trainer    TEXT,
+    body_weight TEXT,
+    fetched_at TEXT,
+    PRIMARY KEY (race_id, umaban)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS payouts (
+    race_id    TEXT NOT NULL,
+    bet_type   TEXT NOT NULL,
+    combo      TEXT NOT NULL,
+    payout     INTEGER,
+    popularity INTEGER,
+    fetched_at TEXT,
+    PRIMARY KEY (race_id, bet_type, combo)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS win5_results (
+    race_date  TEXT PRIMARY KEY,
+    race_ids   TEXT,
+    winners    TEXT,
+    payout     INTEGER,
+    tickets    INTEGER,
+    carryover  INTEGER,
+    sales      INTEGER,
+    fetched_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_results_horse_id  ON results (horse_id);
+CREATE INDEX IF NOT EXISTS idx_results_horse     ON results (horse_name);
+""",
+    4: """
+ALTER TABLE past_runs ADD COLUMN run_race_id TEXT;
+ALTER TABLE past_runs ADD COLUMN last3f_rank INTEGER;
+ALTER TABLE past_runs ADD COLUMN winner_gap  REAL;
+ALTER TABLE past_runs ADD COLUMN field_size  INTEGER;
+CREATE INDEX IF NOT EXISTS idx_past_runs_run_race ON past_runs (run_race_id);
+""",
+    # 整数キー: テーブルを作り直して race_id・horse_id を INTEGER にする（entity_id() は connect() で登録）
+    5: """
+CREATE TABLE races_v5 (
+    race_id    INTEGER PRIMARY KEY,
+    race_date  TEXT,
+    place      TEXT,
+    race_num   INTEGER,
+    name       TEXT,
+    data01     TEXT,
+    data02     TEXT,
+    updated_at TEXT
+);
+INSERT INTO races_v5 SELECT CAST(race_id AS INTEGER), race_date, place, race_num, name, data01, data02, updated_at
+FROM races;
+DROP TABLE races;
+ALTER TABLE races_v5 RENAME TO races;
+CREATE TABLE entries_v5 (
+    race_id    INTEGER NOT NULL,
+    umaban     INTEGER NOT NULL,
+    horse_name TEXT,
+    sex_age    TEXT,
+    weight     REAL,
+    jockey     TEXT,
+    updated_at TEXT,
+    horse_id   INTEGER,
+    jockey_id  INTEGER,
+    PRIMARY KEY (race_id, umaban)
+) WITHOUT ROWID;
+INSERT INTO entries_v5 SELECT CAST(race_id AS INTEGER), umaban, horse_name, sex_age, weight, jockey, updated_at,
+                              entity_id(horse_id), NULL
+FROM entries;
+DROP TABLE entries;
+ALTER TABLE entries_v5 RENAME TO entries;
+CREATE TABLE odds_v5 (
+    race_id    INTEGER NOT NULL,
+    umaban     INTEGER NOT NULL,
+    fetched_at TEXT NOT NULL,
+    odds       REAL,
+    popularity INTEGER,
+    PRIMARY KEY (race_id, umaban, fetched_at)
+) WITHOUT ROWID;
+INSERT INTO odds_v5 SELECT CAST(race_id AS INTEGER), umaban, fetched_at, odds, popularity FROM odds;
+DROP TABLE odds;
+ALTER TABLE odds_v5 RENAME TO odds;
+CREATE TABLE past_runs_v5 (
+    race_id    INTEGER NOT NULL,
+    umaban     INTEGER NOT NULL,
+    n          INTEGER NOT NULL,
+    horse_name TEXT,
+    race_name  TEXT,
+    place      TEXT,
+    course     TEXT,
+    finish     TEXT,
+    margin     TEXT,
+    passing    TEXT,
+    last3f     REAL,
+    fetched_at TEXT,
+    horse_id   INTEGER,
+    run_race_id INTEGER,
+    last3f_rank INTEGER,
+    winner_gap  REAL,
+    field_size  INTEGER,
+    PRIMARY KEY (race_id, umaban, n)
+) WITHOUT ROWID;
+INSERT INTO past_runs_v5 SELECT CAST(race_id AS INTEGER), umaban, n, horse_name, race_name, place, course, finish,
+                                margin, passing, last3f, fetched_at, entity_id(horse_id),
+                                CAST(run_race_id AS INTEGER), last3f_rank, winner_gap, field_size
+FROM past_runs;
+DROP TABLE past_runs;
+ALTER TABLE past_runs_v5 RENAME TO past_runs;
+CREATE TABLE horses_v5 (
+    horse_id   INTEGER PRIMARY KEY,
+    horse_name TEXT,
+    updated_at TEXT
+);
+INSERT OR REPLACE INTO horses_v5 SELECT entity_id(horse_id), horse_name, updated_at FROM horses
+WHERE entity_id(horse_id) IS NOT NULL;
+DROP TABLE horses;
+ALTER TABLE horses_v5 RENAME TO horses;
+CREATE TABLE horse_runs_v5 (
+    horse_id   INTEGER NOT NULL,
+    run_date   TEXT NOT NULL,
+    race_name  TEXT,
+    place      TEXT,
+    course     TEXT,
+    finish     TEXT,
+    margin     TEXT,
+    passing    TEXT,
+    last3f     TEXT,
+    source_race_id INTEGER,
+    first_seen TEXT,
+    PRIMARY KEY (horse_id, run_date)
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO horse_runs_v5 SELECT entity_id(horse_id), run_date, race_name, place, course, finish, margin,
+                                           passing, last3f, CAST(source_race_id AS INTEGER), first_seen
+FROM horse_runs WHERE entity_id(horse_id) IS NOT NULL;
+DROP TABLE horse_runs;
+ALTER TABLE horse_runs_v5 RENAME TO horse_runs;
+CREATE TABLE results_v5 (
+    race_id    INTEGER NOT NULL,
+    umaban     INTEGER NOT NULL,
+    finish     TEXT,
+    rank       INTEGER,
+    waku       INTEGER,
+    horse_name TEXT,
+    horse_id   INTEGER,
+    sex_age    TEXT,
+    weight     REAL,
+    jockey     TEXT,
+    time       TEXT,
+    time_sec   REAL,
+    margin     TEXT,
+    popularity INTEGER,
+    odds       REAL,
+    last3f     REAL,
+    passing    TEXT,
+    trainer    TEXT,
+    body_weight TEXT,
+    fetched_at TEXT,
+    jockey_id  INTEGER,
+    PRIMARY KEY (race_id, umaban)
+) WITHOUT ROWID;
+INSERT INTO results_v5 SELECT CAST(race_id AS INTEGER), umaban, finish, rank, waku, horse_name, entity_id(horse_id),
+                              sex_age, weight, jockey, time, time_sec, margin, popularity, odds, last3f, passing,
+                              trainer, body_weight, fetched_at, NULL
+FROM results;
+DROP TABLE results;
+ALTER TABLE results_v5 RENAME TO results;
+CREATE TABLE payouts_v5 (
+    race_id    INTEGER NOT NULL,
+    bet_type   TEXT NOT NULL,
+    combo      TEXT NOT NULL,
+    payout     INTEGER,
+    popularity INTEGER,
+    fetched_at TEXT,
+    PRIMARY KEY (race_id, bet_type, combo)
+) WITHOUT ROWID;
+INSERT INTO payouts_v5 SELECT CAST(race_id AS INTEGER), bet_type, combo, payout, popularity, fetched_at FROM payouts;
+DROP TABLE payouts;
+ALTER TABLE payouts_v5 RENAME TO payouts;
+CREATE TABLE IF NOT EXISTS jockeys (
+    jockey_id   INTEGER PRIMARY KEY,
+    jockey_name TEXT,
+    updated_at  TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_races_date         ON races (race_date);
+CREATE INDEX IF NOT EXISTS idx_entries_horse      ON entries (horse_name);
+CREATE INDEX IF NOT EXISTS idx_entries_jockey     ON entries (jockey);
+CREATE INDEX IF NOT EXISTS idx_entries_horse_id   ON entries (horse_id);
+CREATE INDEX IF NOT EXISTS idx_entries_jockey_id  ON entries (jockey_id);
+CREATE INDEX IF NOT EXISTS idx_odds_fetched       ON odds (race_id, fetched_at);
+CREATE INDEX IF NOT EXISTS idx_past_runs_horse    ON past_runs (horse_name);
+CREATE INDEX IF NOT EXISTS idx_past_runs_horse_id ON past_runs (horse_id);
+CREATE INDEX IF NOT EXISTS idx_past_runs_run_race ON past_runs (run_race_id);
+CREATE INDEX IF NOT EXISTS idx_horses_name        ON horses (horse_name);
+CREATE INDEX IF NOT EXISTS idx_results_horse_id   ON results (horse_id);
+CREATE INDEX IF NOT EXISTS idx_results_horse      ON results (horse_name);
+CREATE INDEX IF NOT EXISTS idx_results_jockey_id  ON results (jockey_id);
+CREATE INDEX IF NOT EXISTS idx_jockeys_name       ON jockeys (jockey_name);
+""",
+}
+
+# ===================== 接続 =====================
+_CONNS: dict[tuple[str, int], sqlite3.Connection] = {}
+
+def connect(path: Path = STORE_DB) -> sqlite3.Connection:
+    """ストアを開く（無ければ作る）。WAL・synchronous=NORMAL・busy_timeout を設定する"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("entity_id", 1, _id, deterministic=True)  # 移行（MIGRATIONS[5]）で ID 文字列を整数キーに
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        _migrate(conn)
+    return conn
+
+def _migrate(conn: sqlite3.Connection):
+    """スキーマを作る・上げる。複数プロセスが同時に開いても 1 回だけ当たるよう排他で版を見直す"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        scripts = ([SCHEMA] if version < 1 else []) + \
+                  [MIGRATIONS[v] for v in range(max(version, 1) + 1, SCHEMA_VERSION + 1)]
+        for script in scripts:
+            for stmt in filter(str.strip, script.split(";")):
+                conn.execute(stmt)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def store(path: Path = STORE_DB) -> sqlite3.Connection:
+    """プロセスごとに 1 本の接続を使い回す（fork したワーカーでは開き直す）"""
+    key = (str(Path(path).resolve()), os.getpid())
+    conn = _CONNS.get(key)
+    if conn is None:
+        conn = _CONNS[key] = connect(path)
+    return conn
+
+# ===================== 値の整形 =====================
+def _now() -> str:
+    return dt.datetime.now().isoformat(timespec="seconds")
+
+def _text(v) -> str | None:
+    if v is None or (isinstance(v, float) and v != v):
+        return None
+    s = str(v).strip()
+    return s or None
+
+def _num(v) -> float | None:
+    try:
+        x = float(str(v).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+    return x if x == x else None
+
+def _int(v) -> int | None:
+    m = re.search(r"\d+", str(v)) if v is not None else None
+    return int(m.group(0)) if m else None
+
+def _race_row(race_id: str, meta: dict) -> tuple:
+    return (race_id, _text(meta.get("race_date")), _text(meta.get("place")), _int(meta.get("race_num")),
+            _text(meta.get("race_name")), _text(meta.get("data01")), _text(meta.get("data02")), _now())
+
+_UPSERT_RACE = """
+INSERT INTO races (race_id, race_date, place, race_num, name, data01, data02, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (race_id) DO UPDATE SET
+    race_date = COALESCE(excluded.race_date, race_date),
+    place     = COALESCE(excluded.place, place),
+    race_num  = COALESCE(excluded.race_num, race_num),
+    name      = COALESCE(excluded.name, name),
+    data01    = COALESCE(excluded.data01, data01),
+    data02    = COALESCE(excluded.data02, data02),
+    updated_at = excluded.updated_at
+"""
+_UPSERT_ENTRY = """
+INSERT INTO entries (race_id, umaban, horse_name, sex_age, weight, jockey, updated_at, horse_id, jockey_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (race_id, umaban) DO UPDATE SET
+    horse_name = COALESCE(excluded.horse_name, horse_name),
+    horse_id   = COALESCE(excluded.horse_id, horse_id),
+    jockey_id  = COALESCE(excluded.jockey_id, jockey_id),
+    sex_age    = COALESCE(excluded.sex_age, sex_age),
+    weight     = COALESCE(excluded.weight, weight),
+    jockey     = COALESCE(excluded.jockey, jockey),
+    updated_at = excluded.updated_at
+"""
+
+_UPSERT_NAME = {
+    kind: f"""INSERT INTO {kind}s ({kind}_id, {kind}_name, updated_at) VALUES (?, ?, ?)
+              ON CONFLICT ({kind}_id) DO UPDATE SET {kind}_name = COALESCE(excluded.{kind}_name, {kind}_name),
+                                                   updated_at = excluded.updated_at"""
+    for kind in ("horse", "jockey")
+}
+
+def _save_names(conn: sqlite3.Connection, kind: str, pairs, now: str):
+    """ID → 名前の対応表（horses / jockeys）を最新の名前にする。ID の無い行は飛ばす"""
+    conn.executemany(_UPSERT_NAME[kind], [(k, _text(name), now) for k, name in dict(pairs).items() if k is not None])
+
+# ===================== 書き込み =====================
+def save_card(conn: sqlite3.Connection, race_id: str, meta: dict, df: pd.DataFrame,
+              fetched_at: str | None = None) -> int:
+    """出馬表 1 レース分（レース・出走馬・その時点のオッズ）を書く。書いた出走馬の数を返す"""
+    fetched_at = fetched_at or _now()
+    entries, odds = [], []
+    for rec in df.to_dict("records"):
+        umaban = _int(rec.get("馬番"))
+        if umaban is None:
+            continue
+        entries.append((race_id, umaban, _text(rec.get("馬名")), _text(rec.get("性齢")),
+                        _num(rec.get("斤量")), _text(rec.get("騎手名")), fetched_at, _id(rec.get("horse_id")),
+                        _id(rec.get("jockey_id"))))
+        if "オッズ" in rec:
+            odds.append((race_id, umaban, fetched_at, _num(rec.get("オッズ")), _int(rec.get("人気順"))))
+    with conn:
+        conn.execute(_UPSERT_RACE, _race_row(race_id, meta))
+        conn.executemany(_UPSERT_ENTRY, entries)
+        _save_names(conn, "horse", ((e[7], e[2]) for e in entries), fetched_at)
+        _save_names(conn, "jockey", ((e[8], e[5]) for e in entries), fetched_at)
+        conn.executemany("INSERT OR REPLACE INTO odds VALUES (?, ?, ?, ?, ?)", odds)
+    return len(entries)
+
+def save_odds(conn: sqlite3.Connection, race_id: str, df: pd.DataFrame, fetched_at: str | None = None) -> int:
+    """オッズのスナップショットだけを書く（--refresh 用）"""
+    fetched_at = fetched_at or _now()
+    rows = [(race_id, _int(r.get("馬番")), fetched_at, _num(r.get("オッズ")), _int(r.get("人気順")))
+            for r in df.to_dict("records") if _int(r.get("馬番")) is not None]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO odds VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+def save_past_runs(conn: sqlite3.Connection, race_id: str, meta: dict, df: pd.DataFrame,
+                   fetched_at: str | None = None) -> int:
+    """馬柱 1 レース分（extract_horse_table の横持ち DataFrame）を縦持ちにして書く。書いた過去走の数を返す"""
+    fetched_at = fetched_at or _now()
+    entries, runs = [], []
+    for rec in df.to_dict("records"):
+        umaban = _int(rec.get("馬番"))
+        if umaban is None:
+            continue
+        horse, horse_id = _text(rec.get("馬名")), _id(rec.get("horse_id"))
+        entries.append((race_id, umaban, horse, _text(rec.get("性齢")), None, _text(rec.get("騎手名")), fetched_at,
+                        horse_id, _id(rec.get("jockey_id"))))
+        for n, label in enumerate(PAST_LABELS, start=1):
+            name = _text(rec.get(f"{label}_レース名"))
+            if not name and not _text(rec.get(f"{label}_着順")):
+                continue  # 過去走なし（新馬など）
+            runs.append((race_id, umaban, n, horse, name, _text(rec.get(f"{label}_場所")),
+                         _text(rec.get(f"{label}_コース")), _text(rec.get(f"{label}_着順")),
+                         _text(rec.get(f"{label}_着差")), _text(rec.get(f"{label}_通過順")),
+                         _num(rec.get(f"{label}_３F")), fetched_at, horse_id, _id(rec.get(f"{label}_race_id")),
+                         _int(rec.get(f"{label}_上がり順位")), _num(rec.get(f"{label}_勝ち馬差")),
+                         _int(rec.get(f"{label}_頭数"))))
+    with conn:
+        conn.execute(_UPSERT_RACE, _race_row(race_id, meta))
+        conn.executemany(_UPSERT_ENTRY, entries)
+        _save_names(conn, "horse", ((e[7], e[2]) for e in entries), fetched_at)
+        _save_names(conn, "jockey", ((e[8], e[5]) for e in entries), fetched_at)
+        conn.execute("DELETE FROM past_runs WHERE race_id = ?", (race_id,))
+        conn.executemany(f"INSERT INTO past_runs VALUES ({', '.join('?' * 17)})", runs)
+    return len(runs)
+
+def save_horse_runs(conn: sqlite3.Connection, race_id: str, runs: list[tuple]) -> int:
+    """
+    新しくパースした過去走を馬ごとの履歴に足す。
+    runs = [(horse_id, 馬名, 出走日YYYYMMDD, レース名, 場所, コース, 着順, 着差, 通過順, ３F), ...]
+    既にある (horse_id, 出走日) は変えない。追加した数を返す
+    """
+    now = _now()
+    with conn:
+        _save_names(conn, "horse", ((r[0], r[1]) for r in runs), now)
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO horse_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(r[0], r[2], *r[3:10], race_id, now) for r in runs])
+        return conn.total_changes - before
+
+def _time_sec(v) -> float | None:
+    """走破タイム "1:33.5" / "59.8" → 秒"""
+    m = re.fullmatch(r"(?:(\d+):)?(\d+(?:\.\d+)?)", str(v or "").strip())
+    return int(m.group(1) or 0) * 60 + float(m.group(2)) if m else None
+
+def save_results(conn: sqlite3.Connection, race_id: str, meta: dict, df: pd.DataFrame,
+                 payouts: list[tuple], fetched_at: str | None = None) -> int:
+    """
+    レース結果 1 レース分を書く（取り直したら置き換える）。書いた着順の数を返す。
+    df は results.parse_result_table() の DataFrame、payouts = [(券種, 組番, 払戻金, 人気), ...]
+    """
+    fetched_at = fetched_at or _now()
+    rows = []
+    for rec in df.to_dict("records"):
+        umaban = _int(rec.get("馬番"))
+        if umaban is None:
+            continue
+        finish = _text(rec.get("着順"))
+        rows.append((race_id, umaban, finish, int(finish) if finish and finish.isdigit() else None,
+                     _int(rec.get("枠")), _text(rec.get("馬名")), _id(rec.get("horse_id")), _text(rec.get("性齢")),
+                     _num(rec.get("斤量")), _text(rec.get("騎手")), _text(rec.get("タイム")),
+                     _time_sec(rec.get("タイム")), _text(rec.get("着差")), _int(rec.get("人気")),
+                     _num(rec.get("単勝オッズ")), _num(rec.get("後3F")), _text(rec.get("通過")),
+                     _text(rec.get("厩舎")), _text(rec.get("馬体重")), fetched_at, _id(rec.get("jockey_id"))))
+    with conn:
+        conn.execute(_UPSERT_RACE, _race_row(race_id, meta))
+        conn.execute("DELETE FROM results WHERE race_id = ?", (race_id,))
+        conn.executemany(f"INSERT INTO results VALUES ({', '.join('?' * 21)})", rows)
+        _save_names(conn, "horse", ((r[6], r[5]) for r in rows), fetched_at)
+        _save_names(conn, "jockey", ((r[20], r[9]) for r in rows), fetched_at)
+        conn.execute("DELETE FROM payouts WHERE race_id = ?", (race_id,))
+        conn.executemany("INSERT OR REPLACE INTO payouts VALUES (?, ?, ?, ?, ?, ?)",
+                         [(race_id, t, c, p, n, fetched_at) for t, c, p, n in payouts])
+    return len(rows)
+
+def save_win5_result(conn: sqlite3.Connection, race_date: str, rec: dict, fetched_at: str | None = None) -> int:
+    """WIN5 の結果 1 日分（race_ids・winners はカンマ区切りで持つ）"""
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO win5_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (race_date, ",".join(rec.get("race_ids") or []), ",".join(map(str, rec.get("winners") or [])),
+             rec.get("payout"), rec.get("tickets"), rec.get("carryover"), rec.get("sales"), fetched_at or _now()))
+    return 1
+
+def write_store(kind: str, race_id: str, *args, path: Path = STORE_DB) -> int | None:
+    """
+    kind = "card" / "odds" / "past_runs" / "horse_runs" / "results" / "win5_result" の書き込みを、
+    失敗しても止めずに行う（各スクリプトから呼ぶ入口。win5_result の race_id は開催日）。
+    """
+    fn = {"card": save_card, "odds": save_odds, "past_runs": save_past_runs, "horse_runs": save_horse_runs,
+          "results": save_results, "win5_result": save_win5_result}[kind]
+    try:
+        return fn(store(path), race_id, *args)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"[WARN] レースストアへの書き込みに失敗: {race_id}: {type(e).__name__}: {e}")
+        return None
+
+# ===================== 参照 =====================
+RUN_FIELDS = ("race_name", "place", "course", "finish", "margin", "passing", "last3f")
+
+def known_runs(conn: sqlite3.Connection, horse_ids) -> dict[int, dict[str, tuple]]:
+    """{horse_id: {出走日: (レース名, 場所, コース, 着順, 着差, 通過順, ３F)}}（parse_past_cell と同じ並び）"""
+    ids = list(dict.fromkeys(h for h in map(_id, horse_ids) if h is not None))
+    out: dict[int, dict[str, tuple]] = {}
+    for i in range(0, len(ids), 500):  # SQLite の変数上限より小さく区切る
+        chunk = ids[i:i + 500]
+        rows = conn.execute(
+            f"SELECT horse_id, run_date, {', '.join(RUN_FIELDS)} FROM horse_runs "
+            f"WHERE horse_id IN ({', '.join('?' * len(chunk))})", chunk)
+        for r in rows:
+            out.setdefault(r[0], {})[r[1]] = tuple("" if v is None else v for v in r[2:])
+    return out
+
+def lookup_known_runs(horse_ids, path: Path = STORE_DB) -> dict[int, dict[str, tuple]]:
+    """known_runs() の失敗しない版（ストアが読めなければ空 = 全部パースする）"""
+    try:
+        return known_runs(store(path), horse_ids)
+    except (sqlite3.Error, OSError) as e:
+        print(f"[WARN] レースストアを読めません（過去走はすべてパース）: {type(e).__name__}: {e}")
+        return {}
+
+def horse_history(conn: sqlite3.Connection, horse_id: int) -> list[sqlite3.Row]:
+    """馬の出走履歴を新しい順にすべて返す（これまでの馬柱から積み上げた分）"""
+    return conn.execute(
+        "SELECT * FROM horse_runs WHERE horse_id = ? ORDER BY run_date DESC", (_id(horse_id),)).fetchall()
+
+def horse_ids_of(conn: sqlite3.Connection, horse_name: str) -> list[int]:
+    return [r[0] for r in conn.execute("SELECT horse_id FROM horses WHERE horse_name = ?", (horse_name,))]
+
+def jockey_ids_of(conn: sqlite3.Connection, jockey_name: str) -> list[int]:
+    return [r[0] for r in conn.execute("SELECT jockey_id FROM jockeys WHERE jockey_name = ?", (jockey_name,))]
+
+def past_runs_of(conn: sqlite3.Connection, horse_name: str) -> list[sqlite3.Row]:
+    """馬名で過去走を引く（出走した WIN5 レースの開催日の新しい順、同じレース内は前走から）"""
+    return conn.execute(
+        """SELECT r.race_date, p.race_id, p.umaban, p.n, p.race_name, p.place, p.course,
+                  p.finish, p.margin, p.passing, p.last3f
+           FROM past_runs p LEFT JOIN races r USING (race_id)
+           WHERE p.horse_name = ? ORDER BY r.race_date DESC, p.n""", (horse_name,)).fetchall()
+
+def entries_of_horse(conn: sqlite3.Connection, horse_name: str) -> list[sqlite3.Row]:
+    """馬名で出走を引く（馬名 → horse_id で引くので、表記が変わった回も同じ馬として出る）"""
+    return conn.execute(
+        """SELECT r.race_date, r.place, r.race_num, r.name, e.* FROM entries e LEFT JOIN races r USING (race_id)
+           WHERE e.horse_id IN (SELECT horse_id FROM horses WHERE horse_name = ?)
+              OR (e.horse_id IS NULL AND e.horse_name = ?)
+           ORDER BY r.race_date DESC""", (horse_name, horse_name)).fetchall()
+
+def entries_of_jockey(conn: sqlite3.Connection, jockey: str, race_date: str | None = None) -> list[sqlite3.Row]:
+    sql = """SELECT r.race_date, r.place, r.race_num, r.name, e.* FROM entries e LEFT JOIN races r USING (race_id)
+             WHERE (e.jockey_id IN (SELECT jockey_id FROM jockeys WHERE jockey_name = ?)
+                    OR (e.jockey_id IS NULL AND e.jockey = ?))"""
+    params = [jockey, jockey]
+    if race_date:
+        sql += " AND r.race_date = ?"
+        params.append(race_date)
+    return conn.execute(sql + " ORDER BY r.race_date DESC, r.race_num", params).fetchall()
+
+def results_of(conn: sqlite3.Connection, race_id: str) -> pd.DataFrame:
+    """レース結果（着順の順。取り消し・除外などは後ろ）。ID 列は Int64（float を経由すると英数字 ID の桁が落ちる）"""
+    df = pd.read_sql_query("SELECT * FROM results WHERE race_id = ? ORDER BY rank IS NULL, rank, umaban",
+                           conn, params=(race_id,), dtype_backend="numpy_nullable")
+    return df.astype({c: "Int64" for c in ("race_id", "horse_id", "jockey_id")})  # 全部 NULL の列も整数型に
+
+def payouts_of(conn: sqlite3.Connection, race_id: str) -> list[sqlite3.Row]:
+    return conn.execute("SELECT bet_type, combo, payout, popularity FROM payouts WHERE race_id = ?",
+                        (race_id,)).fetchall()
+
+def win5_result(conn: sqlite3.Connection, race_date: str) -> sqlite3.Row | None:
+    return conn.execute("SELECT * FROM win5_results WHERE race_date = ?", (race_date,)).fetchone()
+
+def races_on(conn: sqlite3.Connection, race_date: str) -> list[sqlite3.Row]:
+    return conn.execute("SELECT * FROM races WHERE race_date = ? ORDER BY place, race_num", (race_date,)).fetchall()
+
+def odds_history(conn: sqlite3.Connection, race_id: str) -> pd.DataFrame:
+    """オッズの推移（行 = 取得時刻、列 = 馬番）"""
+    df = pd.read_sql_query("SELECT umaban, fetched_at, odds FROM odds WHERE race_id = ?", conn, params=(race_id,))
+    if df.empty:
+        return df
+    return df.pivot(index="fetched_at", columns="umaban", values="odds").sort_index()
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    conn = connect(Path(opts["db"]) if opts.get("db") else STORE_DB)
+    if opts.get("horse"):
+        for hid in horse_ids_of(conn, opts["horse"]) or [h for h in [_id(opts["horse"])] if h is not None]:
+            for r in horse_history(conn, hid):
+                print(dict(r))
+        for r in entries_of_horse(conn, opts["horse"]):
+            print(dict(r))
+    elif opts.get("jockey"):
+        for r in entries_of_jockey(conn, opts["jockey"], opts.get("date")):
+            print(dict(r))
+    elif opts.get("date"):
+        for r in races_on(conn, opts["date"]):
+            print(dict(r))
+    else:
+        for t in ("races", "entries", "odds", "past_runs", "horses", "jockeys", "horse_runs", "results", "payouts",
+                  "win5_results"):
+            print(f"{t}: {conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0]} 件")
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+常駐レンダリングデーモン。
+
+headless Chrome を温めたまま unix ソケットで待ち受け、
+win5_cards_export.LazyBrowser からのレンダリング要求を処理する。
+
+    python render_daemon.py start     # 起動（フォアグラウンド）
+    python render_daemon.py status    # 稼働確認
+    python render_daemon.py stop      # 停止
+"""
+import os
+import sys
+import json
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+# ===================== 定数 =====================
+SOCKET_PATH = Path(os.environ.get(
+    "WIN5_RENDER_SOCK",
+    str(Path(tempfile.gettempdir()) / "win5_render_daemon.sock"),
+))
+POOL_SIZE     = int(os.environ.get("WIN5_RENDER_POOL", "2"))   # 温めておく Chrome の数
+MAX_RSS_MB    = int(os.environ.get("WIN5_RENDER_MAX_MB", "900"))  # 超えたら作り直す
+IDLE_TIMEOUT  = int(os.environ.get("WIN5_RENDER_IDLE", "1800"))  # 秒。無通信でこれを超えたら終了
+CONNECT_TIMEOUT = 1.0
+RECV_CHUNK    = 1 << 16
+
+# ===================== 通信ユーティリティ =====================
+def _recv_all(conn: socket.socket) -> bytes:
+    chunks = []
+    while True:
+        b = conn.recv(RECV_CHUNK)
+        if not b:
+            break
+        chunks.append(b)
+    return b"".join(chunks)
+
+def _call(payload: dict, timeout: float, path: Path = SOCKET_PATH) -> dict:
+    """1 リクエスト = 1 接続。送信後に書き込み側を閉じ、EOF まで応答を読む。"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(CONNECT_TIMEOUT)
+        s.connect(str(path))
+        s.settimeout(timeout)
+        s.sendall(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        s.shutdown(socket.SHUT_WR)
+        return json.loads(_recv_all(s).decode("utf-8"))
+
+# ===================== クライアント側 =====================
+def daemon_available(path: Path = SOCKET_PATH) -> bool:
+    """ソケットファイルが存在し、unix ソケットが使える環境なら True"""
+    return hasattr(socket, "AF_UNIX") and path.exists()
+
+def request_render(url: str, wait_css: str = None, hard_timeout: int = 25, wait_odds: bool = False,
+                   path: Path = SOCKET_PATH, timeout: float | None = None) -> str | None:
+    """デーモンにレンダリングを依頼する。接続できない・失敗した場合は None（呼び出し側でローカル起動）"""
+    if not daemon_available(path):
+        return None
+    payload = {"cmd": "render", "url": url, "wait_css": wait_css,
+               "hard_timeout": hard_timeout, "wait_odds": wait_odds}
+    try:
+        res = _call(payload, timeout=timeout or hard_timeout + 60, path=path)
+    except (OSError, ValueError):
+        return None
+    if not res.get("ok"):
+        return None
+    return res.get("html")
+
+# ===================== デーモン本体 =====================
+class RenderDaemon:
+    """LazyBrowser のプールを保持し、メモリ使用量で作り直し、アイドルで終了する。"""
+    def __init__(self, path: Path = SOCKET_PATH, pool_size: int = POOL_SIZE,
+                 max_rss_mb: int = MAX_RSS_MB, idle_timeout: int = IDLE_TIMEOUT):
+        self.path = Path(path)
+        self.pool_size = max(1, pool_size)
+        self.max_rss_mb = max_rss_mb
+        self.idle_timeout = idle_timeout
+        self._pool: queue.Queue = queue.Queue()
+        self._last_used = time.monotonic()
+        self._active = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.renders = 0
+        self.recycled = 0
+
+    def _new_browser(self):
+        # 循環 import を避けるため遅延 import（デーモン内ではデーモンを使わない）
+        from win5_cards_export import LazyBrowser
+        return LazyBrowser(use_daemon=False)
+
+    def _warm_up(self):
+        for _ in range(self.pool_size):
+            b = self._new_browser()
+            try:
+                b.driver  # Chrome 起動をここで済ませておく
+            except Exception as e:
+                print(f"[WARN] Chrome 起動失敗: {type(e).__name__}: {e}")
+            self._pool.put(b)
+
+    def _recycle_if_needed(self, browser):
+        mb = browser.memory_mb()
+        if mb <= self.max_rss_mb:
+            return browser
+        print(f"[INFO] Chrome 再起動（{mb:.0f}MB > {self.max_rss_mb}MB）")
+        browser.close()
+        self.recycled += 1
+        fresh = self._new_browser()
+        try:
+            fresh.driver
+        except Exception:
+            pass
+        return fresh
+
+    def _render(self, req: dict) -> dict:
+        browser = self._pool.get()
+        try:
+            html = browser.get_rendered_html(
+                req["url"],
+                wait_css=req.get("wait_css"),
+                hard_timeout=int(req.get("hard_timeout") or 25),
+                wait_odds=bool(req.get("wait_odds")),
+            )
+            self.renders += 1
+            return {"ok": True, "html": html}
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            self._pool.put(self._recycle_if_needed(browser))
+
+    def _status(self) -> dict:
+        return {"ok": True, "pid": os.getpid(), "pool": self.pool_size,
+                "renders": self.renders, "recycled": self.recycled,
+                "idle_sec": round(time.monotonic() - self._last_used, 1)}
+
+    def _handle(self, conn: socket.socket):
+        with self._lock:
+            self._active += 1
+        try:
+            with conn:
+                conn.settimeout(None)
+                try:
+                    req = json.loads(_recv_all(conn).decode("utf-8"))
+                except ValueError:
+                    req = {}
+                cmd = req.get("cmd")
+                if cmd == "render":
+                    res = self._render(req)
+                elif cmd == "status":
+                    res = self._status()
+                elif cmd == "shutdown":
+                    self._stop.set()
+                    res = {"ok": True}
+                else:
+                    res = {"ok": False, "error": f"unknown cmd: {cmd}"}
+                try:
+                    conn.sendall(json.dumps(res, ensure_ascii=False).encode("utf-8"))
+                except OSError:
+                    pass
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_used = time.monotonic()
+
+    def _idle(self) -> bool:
+        with self._lock:
+            return self._active == 0 and time.monotonic() - self._last_used > self.idle_timeout
+
+    def serve_forever(self):
+        if daemon_available(self.path):
+            try:
+                _call({"cmd": "status"}, timeout=CONNECT_TIMEOUT, path=self.path)
+                print(f"既に起動しています: {self.path}")
+                return
+            except OSError:
+                self.path.unlink(missing_ok=True)  # 前回の残骸
+
+        self._warm_up()
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        srv.listen(16)
+        srv.settimeout(1.0)
+        print(f"レンダリングデーモン起動: {self.path} (pid={os.getpid()}, pool={self.pool_size})")
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn, _ = srv.accept()
+                except socket.timeout:
+                    if self._idle():
+                        print("[INFO] アイドルのため終了します")
+                        break
+                    continue
+                with self._lock:
+                    self._last_used = time.monotonic()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            srv.close()
+            self.path.unlink(missing_ok=True)
+            while not self._pool.empty():
+                self._pool.get_nowait().close()
+            print("レンダリングデーモン停止")
+
+# ===================== メイン =====================
+def main():
+    if not hasattr(socket, "AF_UNIX"):
+        print("この環境では unix ソケットが使えません。")
+        sys.exit(2)
+
+    cmd = sys.argv[1] if len(sys.argv) >= 2 else "start"
+    if cmd == "start":
+        RenderDaemon().serve_forever()
+    elif cmd in ("status", "stop"):
+        if not daemon_available():
+            print("起動していません。")
+            sys.exit(1)
+        try:
+            res = _call({"cmd": "status" if cmd == "status" else "shutdown"}, timeout=5.0)
+        except OSError as e:
+            print(f"接続できません: {e}")
+            sys.exit(1)
+        print(json.dumps(res, ensure_ascii=False))
+    else:
+        print(f"不明なコマンド: {cmd}（start / status / stop）")
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
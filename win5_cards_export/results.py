@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+終わったレースの結果（着順・タイム・確定オッズ）と払戻、WIN5 の払戻・キャリーオーバーをレースストアに取り込む。
+
+    python results.py 20250504                    # その日の全レース（開催カレンダー jra.py から race_id を組み立てる）
+    python results.py 20250501-20250531           # 期間（開催の無い日は飛ばす）
+    python results.py 20250504 --win5-only        # WIN5 の 5 レースと WIN5 の払戻だけ
+    python results.py --race=202505021211,202505021212
+
+- 結果ページ（result.html）を共有フェッチ層（fetch_layer.py）でまとめて取得し、出馬表と同じく
+  pd.read_html（lxml）で着順表を読む。払戻表は券種ごとに組番・払戻金・人気を取り出す
+- 書き込み先はレースストア（race_store.py）の results / payouts / win5_results（race_id は出馬表と同じキー）
+- カレンダーに無い日はレース一覧（race_list_sub.html）を 1 ページ取って開催を覚える
+- まだ結果の出ていないレースは [SKIP]（後で同じコマンドを実行すれば取り直して上書き）
+- 馬柱の過去走の補強（main_horse_decide.py --enrich）からも使う: past_race_metrics() は過去走のレースを
+  重複なく集め、ストアに結果の無いレースだけ結果ページを 1 回ずつ取って、上がり順位・勝ち馬差・頭数を返す
+"""
+import re
+import sys
+import time
+import sqlite3
+import datetime as dt
+import pandas as pd
+
+from io import StringIO
+from bs4 import BeautifulSoup
+
+from fetch_layer import FetchLayer, MAX_CONCURRENCY
+from jra import RaceId, calendar, known_win5, sync
+from race_store import write_store, store as open_store, results_of, _time_sec
+from entities import id_column, row_ids, remember_names
+import win5_cards_export as cards
+
+# ===================== 定数 =====================
+WIN5_RESULT_URL = "https://race.netkeiba.com/top/win5.html?date={date}"  # 終わった日は払戻・キャリーオーバーが載る
+PAYOUT_TABLE_RE = re.compile(r"<table[^>]*Payout_Detail_Table.*?</table>", re.S)
+
+# 着順表の列（表示名の揺れを吸収する。上から順に、まだ使っていない列に当てる）
+RESULT_COLUMNS = {
+    "着順":       re.compile(r"^着\s*順$"),
+    "枠":         re.compile(r"^枠(\s*番)?$"),
+    "馬番":       re.compile(r"^馬\s*番$"),
+    "馬名":       re.compile(r"^馬\s*名$"),
+    "性齢":       re.compile(r"^性\s*齢$"),
+    "斤量":       re.compile(r"^斤\s*量$"),
+    "騎手":       re.compile(r"^騎\s*手"),
+    "タイム":     re.compile(r"^タイム$"),
+    "着差":       re.compile(r"^着\s*差$"),
+    "人気":       re.compile(r"^人\s*気$"),
+    "単勝オッズ": re.compile(r"(単勝|オッズ)"),
+    "後3F":       re.compile(r"(後\s*3F|上が?り)", re.I),
+    "通過":       re.compile(r"(通過|コーナー)"),
+    "厩舎":       re.compile(r"(厩舎|調教師)"),
+    "馬体重":     re.compile(r"^馬体重"),
+}
+
+# 払戻表の行（tr の class → 券種）
+BET_TYPES = {
+    "Tansho": "単勝", "Fukusho": "複勝", "Wakuren": "枠連", "Umaren": "馬連",
+    "Wide": "ワイド", "Umatan": "馬単", "Fuku3": "3連複", "Tan3": "3連単",
+}
+ORDERED_BETS = {"馬単", "3連単"}  # 組番を "→" でつなぐ券種
+SCRATCHED = {"取消", "除外"}      # 出走していない（頭数に入れない）
+
+WIN5_PATTERNS = {
+    "payout":    re.compile(r"払戻金?\s*[:：]?\s*([\d,]+)\s*円"),
+    "tickets":   re.compile(r"的中(?:票数)?\s*[:：]?\s*([\d,]+)\s*票"),
+    "carryover": re.compile(r"キャリーオーバー(?:発生)?\s*[:：]?\s*([\d,]+)\s*円"),
+    "sales":     re.compile(r"発売(?:票数|金額)?\s*[:：]?\s*([\d,]+)\s*(?:円|票)"),
+}
+
+# ===================== パース =====================
+def parse_result_table(html: str) -> pd.DataFrame:
+    """着順表を RESULT_COLUMNS の列名 + horse_id・jockey_id（整数キー）で返す（着順の無いページは ValueError）"""
+    bio = StringIO(html)
+    try:
+        tables = pd.read_html(bio, flavor="lxml", match="着")
+    except ValueError:
+        raise ValueError("結果の着順表が見つかりません（まだ確定していないレース？）")
+    for df in tables:
+        df = cards._normalize_columns(df)
+        mapping, used = {}, set()
+        for want, pat in RESULT_COLUMNS.items():
+            hit = next((c for c in df.columns if c not in used and pat.search(str(c).replace(" ", ""))), None)
+            if hit is not None:
+                mapping[hit] = want
+                used.add(hit)
+        if {"着順", "馬番", "馬名"} <= set(mapping.values()):
+            out = df[list(mapping)].rename(columns=mapping)
+            out = out[pd.to_numeric(out["馬番"], errors="coerce").notna()].reset_index(drop=True)
+            # ID は各行の /horse/・/jockey/ リンクから（read_html はリンクを捨てるので別に拾う）
+            for kind in ("horse", "jockey"):
+                out[f"{kind}_id"] = id_column(row_ids(kind, html), len(out))
+            remember_names("horse", out["horse_id"], out["馬名"])
+            if "騎手" in out.columns:
+                remember_names("jockey", out["jockey_id"], out["騎手"])
+            return out
+    raise ValueError("結果の着順表が見つかりません（まだ確定していないレース？）")
+
+def parse_payouts(html: str) -> list[tuple[str, str, int | None, int | None]]:
+    """払戻表を [(券種, 組番, 払戻金, 人気), ...] にする。同着で払戻が複数ある券種も 1 組ずつ"""
+    # ページ全体ではなく払戻表の部分だけを組み立てる（ページ全体の soup は払戻表の何倍も遅い）
+    soup = BeautifulSoup("".join(PAYOUT_TABLE_RE.findall(html)), "lxml")
+    out = []
+    for tr in soup.select("table.Payout_Detail_Table tr"):
+        bet = next((BET_TYPES[c] for c in tr.get("class") or [] if c in BET_TYPES), None)
+        if bet is None:
+            th = tr.find("th")
+            bet = th.get_text(strip=True) if th else None
+        res, pay, ninki = tr.select_one("td.Result"), tr.select_one("td.Payout"), tr.select_one("td.Ninki")
+        if not (bet and res and pay):
+            continue
+        nums = [int(x) for x in re.findall(r"\d+", res.get_text(" ", strip=True))]
+        pays = [int(x.replace(",", "")) for x in re.findall(r"([\d,]+)\s*円", pay.get_text(" ", strip=True))]
+        ninkis = [int(x) for x in re.findall(r"(\d+)\s*人気", ninki.get_text(" ", strip=True))] if ninki else []
+        if not pays or not nums:
+            continue
+        k = max(1, len(nums) // len(pays))  # 1 組あたりの馬番の数（単勝 1・馬連 2・3連単 3 …）
+        sep = "→" if bet in ORDERED_BETS else "-"
+        for i, p in enumerate(pays):
+            combo = nums[i * k:(i + 1) * k]
+            if combo:
+                out.append((bet, sep.join(map(str, combo)), p, ninkis[i] if i < len(ninkis) else None))
+    return out
+
+def parse_win5_result(html: str) -> dict:
+    """WIN5 ページ（終わった日）から払戻金・的中票数・キャリーオーバー・発売を拾う（無い項目は None）"""
+    text = BeautifulSoup(html, "lxml").get_text(" ", strip=True)
+    rec = {}
+    for key, pat in WIN5_PATTERNS.items():
+        m = pat.search(text)
+        rec[key] = int(m.group(1).replace(",", "")) if m else None
+    if rec["tickets"] is None and re.search(r"的中\s*(なし|無し|0\s*票)", text):
+        rec["tickets"], rec["payout"] = 0, 0
+    return rec
+
+# ===================== 取り込み =====================
+def ingest_results(layer: FetchLayer, race_ids: list[str], store: bool = True) -> tuple[dict[str, pd.DataFrame], list[str]]:
+    """race_ids の結果ページをまとめて取得して取り込む。({race_id: 着順表}, 失敗メッセージ) を返す"""
+    urls = {rid: RaceId.parse(rid).result_url for rid in race_ids}
+    got = layer.get_many(urls.values())
+    done, errors = {}, []
+    for rid, url in urls.items():
+        html = got[url]
+        layer.release(url)
+        try:
+            if isinstance(html, Exception):
+                raise html
+            df = parse_result_table(html)
+            payouts = parse_payouts(html)
+            race_date, name, d1, d2, place, rnum = cards._extract_race_meta(html, RaceId.parse(rid))
+            if store:
+                write_store("results", rid, {"race_date": race_date, "race_name": name, "data01": d1,
+                                             "data02": d2, "place": place, "race_num": rnum}, df, payouts)
+            done[rid] = df
+        except Exception as e:
+            msg = f"{rid}: {type(e).__name__}: {e}"
+            print("[SKIP]", msg)
+            errors.append(msg)
+    return done, errors
+
+def winners(results: dict[str, pd.DataFrame], race_ids: list[str]) -> list[int | None]:
+    """各レースの 1 着の馬番（同着は若い馬番。結果の無いレースは None）"""
+    out = []
+    for rid in race_ids:
+        df = results.get(rid)
+        first = df[df["着順"].astype(str).str.strip() == "1"] if df is not None else None
+        out.append(int(pd.to_numeric(first["馬番"]).min()) if first is not None and len(first) else None)
+    return out
+
+def day_race_ids(layer: FetchLayer, date: str) -> list[str]:
+    """その日の全レースの race_id。カレンダーに無ければレース一覧を取得して覚える"""
+    if not calendar().meetings_on(date):
+        sync([date], layer)
+    return [str(r) for r in calendar().race_ids_on(date)]
+
+def ingest_day(layer: FetchLayer, date: str, win5_only: bool = False, store: bool = True) -> tuple[int, list[str]]:
+    """1 日分（全レースまたは WIN5 の 5 レース）と WIN5 の払戻を取り込む。(取り込んだレース数, 失敗) を返す"""
+    day_ids = day_race_ids(layer, date)
+    win5_ids = known_win5(date)
+    if not win5_ids and day_ids:
+        try:
+            ids = cards._extract_ids_from_html(layer.get(WIN5_RESULT_URL.format(date=date)))[:5]
+        except Exception as e:
+            print(f"[WARN] {date}: WIN5 ページを取得できません: {type(e).__name__}: {e}")
+            ids = []
+        # WIN5 の無い日は別の日のページが返るので、その日の開催のレースだけの時に使う
+        meetings = {r[:10] for r in day_ids}
+        if len(ids) == 5 and all(r[:10] in meetings for r in ids):
+            win5_ids = ids
+    race_ids = win5_ids if win5_only else list(dict.fromkeys(day_ids + win5_ids))
+    if not race_ids:
+        print(f"[SKIP] {date}: 開催なし")
+        return 0, []
+    results, errors = ingest_results(layer, race_ids, store)
+
+    if len(win5_ids) == 5:
+        url = WIN5_RESULT_URL.format(date=date)
+        try:
+            rec = parse_win5_result(layer.get(url))
+            rec.update(race_ids=win5_ids, winners=[w or "" for w in winners(results, win5_ids)])
+            if store:
+                write_store("win5_result", date, rec)
+            pay = f"{rec['payout']:,} 円" if rec["payout"] is not None else "不明"
+            co = f"、キャリーオーバー {rec['carryover']:,} 円" if rec["carryover"] else ""
+            print(f"[INFO] {date} WIN5: {'-'.join(map(str, rec['winners']))} 払戻 {pay}{co}")
+        except Exception as e:
+            errors.append(f"{date} WIN5: {type(e).__name__}: {e}")
+            print("[SKIP]", errors[-1])
+        finally:
+            layer.release(url)
+    return len(results), errors
+
+# ===================== 過去走の補強 =====================
+def field_metrics(df: pd.DataFrame) -> dict[int, tuple[int | None, float | None, int]]:
+    """
+    1 レースの着順表（parse_result_table か race_store.results_of）から
+    {horse_id: (上がり3F の順位, 勝ち馬とのタイム差（秒）, 頭数)}。取消・除外は頭数に入れない
+    """
+    if "time_sec" in df.columns:  # ストアから読んだ着順表
+        finish = df["finish"].astype(str).str.strip()
+        t = pd.to_numeric(df["time_sec"], errors="coerce")
+        f3 = pd.to_numeric(df["last3f"], errors="coerce")
+    else:
+        finish = df["着順"].astype(str).str.strip()
+        t = pd.to_numeric(df["タイム"].map(_time_sec), errors="coerce")
+        f3 = pd.to_numeric(df["後3F"], errors="coerce") if "後3F" in df.columns else pd.Series(float("nan"), df.index)
+    ran = ~finish.isin(SCRATCHED)
+    f3_rank = f3.where(ran).rank(method="min")
+    gap = (t - t[pd.to_numeric(finish, errors="coerce") == 1].min()).round(1)
+    field = int(ran.sum())
+    return {int(h): (None if pd.isna(r) else int(r), None if pd.isna(g) else float(g), field)
+            for h, r, g in zip(df["horse_id"], f3_rank, gap) if pd.notna(h)}
+
+def _stored_metrics(race_ids: list[int]) -> dict[int, dict]:
+    """ストアに結果のあるレースの field_metrics（ストアが読めなければ空 = 全部取得する）"""
+    try:
+        conn = open_store()
+        return {rid: field_metrics(df) for rid in race_ids if len(df := results_of(conn, rid))}
+    except (sqlite3.Error, OSError) as e:
+        print(f"[WARN] レースストアを読めません（過去走のレースはすべて取得）: {type(e).__name__}: {e}")
+        return {}
+
+def past_race_metrics(layer: FetchLayer, race_ids, store: bool = True) -> tuple[dict[int, dict], int]:
+    """
+    過去走の race_id（重複してよい。JRA 以外は飛ばす）→ {race_id: field_metrics}。
+    ストアに結果のあるレースは取得せず、無いレースだけ結果ページを 1 回ずつ取る（取ったものはストアに書く）。
+    (metrics, 取得したレース数) を返す
+    """
+    ids = list(dict.fromkeys(int(r) for r in race_ids if r and RaceId.parse(r).is_jra))
+    out = _stored_metrics(ids) if store else {}
+    missing = [r for r in ids if r not in out]
+    done, _ = ingest_results(layer, missing, store)
+    out.update({rid: field_metrics(df) for rid, df in done.items()})
+    return out, len(missing)
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    store = "no-store" not in opts
+    t0 = time.perf_counter()
+    with FetchLayer(max_concurrency=int(opts.get("fetch") or MAX_CONCURRENCY)) as layer:
+        if opts.get("race"):
+            done, errors = ingest_results(layer, [r.strip() for r in opts["race"].split(",") if r.strip()], store)
+            n = len(done)
+        else:
+            from batch_export import parse_targets
+            try:
+                dates = [t.split(":", 1)[1] for t in parse_targets(args, None)]
+            except ValueError as e:
+                print(e)
+                sys.exit(2)
+            if not dates:
+                print("使い方: python results.py YYYYMMDD[-YYYYMMDD] ... [--win5-only] [--no-store] [--fetch=N] "
+                      "| --race=race_id,...")
+                sys.exit(2)
+            today = dt.datetime.now(dt.timezone(dt.timedelta(hours=9))).strftime("%Y%m%d")
+            n, errors = 0, []
+            for date in dates:
+                if date > today:
+                    print(f"[SKIP] {date}: まだ開催前です")
+                    continue
+                k, errs = ingest_day(layer, date, win5_only="win5-only" in opts, store=store)
+                n += k
+                errors += errs
+        fetched = layer.requests
+    print(f"結果の取り込み完了: {n} レース / 失敗 {len(errors)} / 取得 {fetched} ページ / "
+          f"{time.perf_counter() - t0:.1f} 秒")
+
+if __name__ == "__main__":
+    main()
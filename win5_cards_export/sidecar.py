@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+取得した DataFrame を Parquet のサイドカーとして書き出す（分析用、任意）。
+
+    {SIDECAR_DIR}/{kind}/race_date=YYYYMMDD/race_id=XXXXXXXXXXXX/{kind}-{取得時刻}.parquet
+
+- kind は "cards"（win5_cards_export の出馬表）/ "past_runs"（main_horse_decide の馬柱）
+- race_date / race_id は hive 形式のディレクトリ（ファイル内には持たない）。
+  read_sidecar("cards") で文字列の列として復元される
+- 文字列列は辞書エンコード（Arrow の dictionary 型）、数値にできる列は数値型で保存
+- 同じレースを何度取得しても上書きせず、fetched_at 列付きで 1 ファイルずつ増える
+
+pyarrow が無い環境では何もしない（[WARN] を 1 回だけ出す）。
+"""
+import os
+import re
+import datetime as dt
+import pandas as pd
+
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # 任意依存
+    pa = ds = pq = None
+
+# ===================== 定数 =====================
+SIDECAR_DIR = Path(os.environ.get(
+    "WIN5_SIDECAR_DIR",
+    str(Path(__file__).resolve().with_name("output") / "sidecar"),
+))
+COMPRESSION = "zstd"
+PARTITION_COLS = ("race_date", "race_id")
+
+_warned = False
+
+def available() -> bool:
+    return pa is not None
+
+# ===================== 型付け =====================
+def _typed_column(s: pd.Series) -> pd.Series:
+    """object 列は値を変えずに数値化できれば数値型に、できなければ文字列（辞書エンコード）にする"""
+    if s.dtype != object and not pd.api.types.is_string_dtype(s):
+        return s
+    nonnull = s.dropna()
+    if nonnull.empty:
+        return s.astype(object)  # 全部欠損は Arrow の null 型（読む時に他ファイルの型に合わせる）
+    num = pd.to_numeric(nonnull, errors="coerce")
+    # 先頭 0 付き（"01" など）は文字列のまま残す
+    if num.notna().all() and not nonnull.astype(str).str.match(r"^0\d").any():
+        full = pd.to_numeric(s, errors="coerce")
+        if (full.dropna() % 1 == 0).all():
+            return full.astype("Int32")
+        return full.astype("float64")
+    return s.astype("string").astype("category")
+
+def typed_frame(df: pd.DataFrame, meta: dict[str, object] | None = None) -> pd.DataFrame:
+    """DataFrame を Parquet 向けに型付けする（meta は全行共通の列として付ける）"""
+    out = pd.DataFrame({str(c): _typed_column(df[c]) for c in df.columns})
+    for k, v in (meta or {}).items():
+        col = pd.Series([v] * len(out), index=out.index)
+        out[k] = col if isinstance(v, (dt.datetime, int, float)) else _typed_column(col.astype(object))
+    return out
+
+# ===================== 書き出し =====================
+def _safe(part: str) -> str:
+    return re.sub(r"[^0-9A-Za-z_-]", "_", str(part)) or "unknown"
+
+def sidecar_path(kind: str, race_date: str | None, race_id: str, fetched_at: dt.datetime,
+                 root: Path = SIDECAR_DIR) -> Path:
+    return (Path(root) / kind / f"race_date={_safe(race_date or 'unknown')}" / f"race_id={_safe(race_id)}"
+            / f"{kind}-{fetched_at.strftime('%Y%m%d_%H%M%S_%f')}.parquet")
+
+def write_sidecar(kind: str, df: pd.DataFrame, race_id: str, race_date: str | None,
+                  meta: dict[str, object] | None = None, root: Path = SIDECAR_DIR,
+                  fetched_at: dt.datetime | None = None) -> Path | None:
+    """
+    1 レース分の DataFrame をサイドカーとして書く。書いたパスを返す（pyarrow が無ければ None）。
+    失敗しても呼び出し側の処理（xlsx 出力）は止めない。
+    """
+    global _warned
+    if pa is None:
+        if not _warned:
+            print("[WARN] pyarrow が無いためサイドカー出力をスキップします（pip install pyarrow）")
+            _warned = True
+        return None
+    fetched_at = fetched_at or dt.datetime.now()
+    path = sidecar_path(kind, race_date, race_id, fetched_at, root)
+    try:
+        frame = typed_frame(df.drop(columns=[c for c in PARTITION_COLS if c in df.columns]),
+                            {**(meta or {}), "fetched_at": fetched_at})
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        # 辞書のインデックス幅はファイルごとに変わらないよう int32 に揃える
+        table = table.cast(pa.schema([
+            f.with_type(pa.dictionary(pa.int32(), pa.string())) if pa.types.is_dictionary(f.type) else f
+            for f in table.schema
+        ], metadata=table.schema.metadata))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name("." + path.name + ".tmp")  # "." 始まりはデータセット走査で無視される
+        pq.write_table(table, tmp, compression=COMPRESSION, use_dictionary=True)
+        tmp.replace(path)
+        return path
+    except Exception as e:
+        print(f"[WARN] サイドカー出力に失敗: {race_id}: {type(e).__name__}: {e}")
+        return None
+
+def read_sidecar(kind: str, root: Path = SIDECAR_DIR, **filters) -> pd.DataFrame:
+    """kind のサイドカーをまとめて読む（filters は race_date="20250505" などの等価条件）"""
+    if pa is None:
+        raise RuntimeError("pyarrow が必要です")
+    # race_date / race_id は数字だけなので、型推論させず文字列として読む
+    part = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTITION_COLS]), flavor="hive")
+    dataset = ds.dataset(Path(root) / kind, format="parquet", partitioning=part)
+    # 欠損だけの列（null 型）や int32/int64 の違いはファイル間でまとめて昇格する
+    schema = pa.unify_schemas([f.physical_schema for f in dataset.get_fragments()] + [dataset.schema],
+                              promote_options="permissive")
+    dataset = ds.dataset(Path(root) / kind, format="parquet", partitioning=part, schema=schema)
+    expr = None
+    for k, v in filters.items():
+        cond = ds.field(k) == str(v)
+        expr = cond if expr is None else expr & cond
+    return dataset.to_table(filter=expr).to_pandas()
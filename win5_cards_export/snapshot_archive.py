@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+取得した生の HTML（レスポンスのバイト列）をすべて残しておく圧縮アーカイブ。
+
+後からパーサーを直して同じページで再実行したり、失敗したページを調べたりするためのもの
+（旧版の _dump_debug_html は失敗時だけ固定パスに書いていた）。
+
+    {SNAPSHOT_DIR}/{種類}-{YYYYMM}.bin   圧縮したページを追記していくデータファイル
+    {SNAPSHOT_DIR}/index.sqlite3         (url, 取得時刻) → データファイル・オフセット・長さ の索引
+    {SNAPSHOT_DIR}/dict-{id}.bin         種類ごとに学習した圧縮辞書
+
+- ページの種類（cards / past / results / win5 / odds / other）ごとに zstd の辞書を学習して圧縮する。
+  netkeiba のページは共通部分が多く、辞書ありで 10〜20 倍程度に縮む
+- 辞書が無い種類は、辞書なしで TRAIN_SAMPLES 件たまった時点で自動的に学習する（以降のページから使う）
+- 1 件ずつ索引のオフセットから読んで伸長するので、アーカイブ全体を展開せずにランダムに読める
+- 追記は索引の書き込みロック（BEGIN IMMEDIATE）の中で行うので、バッチの複数プロセスから同時に書いてよい
+- zstandard が無い環境では zlib のプリセット辞書（直近のサンプル 32KB）で代用する
+
+    python snapshot_archive.py                       # 種類ごとの件数・圧縮率
+    python snapshot_archive.py --train               # 全種類の辞書を学習し直す（--train=cards で 1 種類）
+    python snapshot_archive.py --list=202505021211   # URL に含む文字列で一覧
+    python snapshot_archive.py --url=<URL> [--at=2025-05-04T15:00] [--out=page.html]
+
+環境変数 WIN5_SNAPSHOTS=0 で保存しない。
+"""
+import os
+import sys
+import zlib
+import sqlite3
+import threading
+import datetime as dt
+
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:  # 任意依存
+    zstandard = None
+
+# ===================== 定数 =====================
+SNAPSHOT_DIR = Path(os.environ.get(
+    "WIN5_SNAPSHOT_DIR",
+    str(Path(__file__).resolve().with_name("output") / "snapshots"),
+))
+ENABLED       = os.environ.get("WIN5_SNAPSHOTS", "1") != "0"
+ZSTD_LEVEL    = 9
+TRAIN_SAMPLES = 32          # 辞書を学習するのに使うページ数
+DICT_SIZE     = 112 * 1024  # zstd 辞書の大きさ
+ZLIB_WINDOW   = 32 * 1024   # zlib のプリセット辞書の上限
+BUSY_TIMEOUT_MS = 10_000
+
+# URL に含まれる文字列 → ページの種類（上から順に判定）
+PAGE_KINDS = (
+    ("past", "shutuba_past"),
+    ("cards", "/race/shutuba"),
+    ("results", "/race/result"),
+    ("odds", "api_get_jra_odds"),
+    ("win5", "win5"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id         INTEGER PRIMARY KEY,
+    url        TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    fetched_at TEXT NOT NULL,
+    segment    TEXT NOT NULL,
+    offset     INTEGER NOT NULL,
+    length     INTEGER NOT NULL,
+    raw_len    INTEGER NOT NULL,
+    codec      TEXT NOT NULL,
+    dict_id    INTEGER NOT NULL DEFAULT 0,
+    rendered   INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS dicts (
+    dict_id    INTEGER PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    codec      TEXT NOT NULL,
+    samples    INTEGER,
+    size       INTEGER,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_snapshots_url  ON snapshots (url, fetched_at);
+CREATE INDEX IF NOT EXISTS idx_snapshots_kind ON snapshots (kind, dict_id);
+"""
+
+def page_kind(url: str) -> str:
+    for kind, needle in PAGE_KINDS:
+        if needle in url:
+            return kind
+    return "other"
+
+def _codec() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+# ===================== アーカイブ =====================
+class SnapshotArchive:
+    """1 ディレクトリ分のアーカイブ。put() で追記、get() / latest() で 1 件ずつ読む"""
+    def __init__(self, root: Path = SNAPSHOT_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.root / "index.sqlite3", timeout=BUSY_TIMEOUT_MS / 1000,
+                                    isolation_level=None)  # トランザクションは明示的に張る
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self.conn.executescript(SCHEMA)
+        self._dicts: dict[int, bytes] = {}
+        self._compressors: dict[int, object] = {}
+
+    def close(self):
+        self.conn.close()
+
+    # ---------- 辞書 ----------
+    def _dict_bytes(self, dict_id: int) -> bytes:
+        d = self._dicts.get(dict_id)
+        if d is None:
+            d = self._dicts[dict_id] = (self.root / f"dict-{dict_id}.bin").read_bytes()
+        return d
+
+    def current_dict(self, kind: str) -> int:
+        """kind で今使う辞書（無ければ 0 = 辞書なし）"""
+        row = self.conn.execute("SELECT MAX(dict_id) FROM dicts WHERE kind = ? AND codec = ?",
+                                (kind, _codec())).fetchone()
+        return row[0] or 0
+
+    def train(self, kind: str, samples: int = TRAIN_SAMPLES, if_missing: bool = False) -> int:
+        """kind の直近 samples 件から辞書を作り、以降の圧縮に使う。辞書 ID を返す（作れなければ 0）
+
+        if_missing=True（自動学習）では、学習中に他のプロセスが辞書を作っていればそちらを使う。
+        """
+        rows = self.conn.execute("SELECT id FROM snapshots WHERE kind = ? ORDER BY id DESC LIMIT ?",
+                                 (kind, samples)).fetchall()
+        data = [self.get(r["id"]) for r in rows]
+        data = [d for d in data if d]
+        if len(data) < 2:
+            return 0
+        try:
+            if zstandard is not None:
+                d = zstandard.train_dictionary(DICT_SIZE, data).as_bytes()
+            else:
+                # zlib は窓（32KB）に入る分だけ。新しいページほど後ろ（よく参照される側）に置く
+                d = b"".join(reversed(data))[-ZLIB_WINDOW:]
+        except Exception as e:
+            print(f"[WARN] 圧縮辞書の学習に失敗: {kind}: {type(e).__name__}: {e}")
+            return 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if if_missing and (dict_id := self.current_dict(kind)):
+                self.conn.execute("ROLLBACK")
+                return dict_id
+            cur = self.conn.execute(
+                "INSERT INTO dicts (kind, codec, samples, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, _codec(), len(data), len(d), dt.datetime.now().isoformat(timespec="seconds")))
+            dict_id = cur.lastrowid
+            tmp = self.root / f".dict-{dict_id}.tmp"
+            tmp.write_bytes(d)
+            tmp.replace(self.root / f"dict-{dict_id}.bin")
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self._dicts[dict_id] = d
+        return dict_id
+
+    # ---------- 圧縮・伸長 ----------
+    def _compress(self, raw: bytes, dict_id: int) -> bytes:
+        if zstandard is not None:
+            c = self._compressors.get(dict_id)
+            if c is None:
+                zd = zstandard.ZstdCompressionDict(self._dict_bytes(dict_id)) if dict_id else None
+                c = self._compressors[dict_id] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zd)
+            return c.compress(raw)
+        c = zlib.compressobj(9, zdict=self._dict_bytes(dict_id)) if dict_id else zlib.compressobj(9)
+        return c.compress(raw) + c.flush()
+
+    def _decompress(self, data: bytes, codec: str, dict_id: int) -> bytes:
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstd で圧縮されたスナップショットです（pip install zstandard）")
+            zd = zstandard.ZstdCompressionDict(self._dict_bytes(dict_id)) if dict_id else None
+            return zstandard.ZstdDecompressor(dict_data=zd).decompress(data)
+        d = zlib.decompressobj(zdict=self._dict_bytes(dict_id)) if dict_id else zlib.decompressobj()
+        return d.decompress(data) + d.flush()
+
+    # ---------- 書き込み ----------
+    def put(self, url: str, content: bytes, fetched_at: dt.datetime | None = None,
+            rendered: bool = False) -> int:
+        """1 ページ分を追記して索引に載せる。スナップショット ID を返す"""
+        kind = page_kind(url)
+        fetched_at = fetched_at or dt.datetime.now()
+        dict_id = self.current_dict(kind)
+        if not dict_id:
+            n = self.conn.execute("SELECT COUNT(*) FROM snapshots WHERE kind = ?", (kind,)).fetchone()[0]
+            if n >= TRAIN_SAMPLES:
+                dict_id = self.train(kind, if_missing=True)
+        data = self._compress(content, dict_id)
+        segment = f"{kind}-{fetched_at:%Y%m}.bin"
+
+        # 索引の書き込みロックを取ってから追記する（オフセットが他プロセスと重ならない）
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            with open(self.root / segment, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            cur = self.conn.execute(
+                """INSERT INTO snapshots (url, kind, fetched_at, segment, offset, length, raw_len, codec, dict_id, rendered)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (url, kind, fetched_at.isoformat(timespec="microseconds"), segment, offset, len(data),
+                 len(content), _codec(), dict_id, int(rendered)))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return cur.lastrowid
+
+    # ---------- 読み出し ----------
+    def get(self, snapshot_id: int) -> bytes:
+        row = self.conn.execute("SELECT * FROM snapshots WHERE id = ?", (snapshot_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"スナップショットがありません: {snapshot_id}")
+        with open(self.root / row["segment"], "rb") as f:
+            f.seek(row["offset"])
+            data = f.read(row["length"])
+        return self._decompress(data, row["codec"], row["dict_id"])
+
+    def find(self, url: str, like: bool = False) -> list[sqlite3.Row]:
+        """URL（like=True なら部分一致）のスナップショット一覧（取得時刻順）"""
+        if like:
+            return self.conn.execute("SELECT * FROM snapshots WHERE url LIKE ? ORDER BY fetched_at",
+                                     (f"%{url}%",)).fetchall()
+        return self.conn.execute("SELECT * FROM snapshots WHERE url = ? ORDER BY fetched_at", (url,)).fetchall()
+
+    def latest(self, url: str, at: dt.datetime | None = None) -> tuple[str, bytes] | None:
+        """url の at 時点（既定は最新）のスナップショットを (取得時刻, バイト列) で返す"""
+        sql, params = "SELECT id, fetched_at FROM snapshots WHERE url = ?", [url]
+        if at is not None:
+            sql += " AND fetched_at <= ?"
+            params.append(at.isoformat(timespec="microseconds"))
+        row = self.conn.execute(sql + " ORDER BY fetched_at DESC LIMIT 1", params).fetchone()
+        return (row["fetched_at"], self.get(row["id"])) if row else None
+
+    def stats(self) -> list[sqlite3.Row]:
+        return self.conn.execute(
+            """SELECT kind, COUNT(*) AS n, SUM(raw_len) AS raw, SUM(length) AS stored, MAX(dict_id) AS dict_id
+               FROM snapshots GROUP BY kind ORDER BY kind""").fetchall()
+
+# ===================== 各スクリプトからの入口 =====================
+_LOCAL = threading.local()
+
+def archive(root: Path = SNAPSHOT_DIR) -> SnapshotArchive:
+    """
+    プロセス・スレッドごとに 1 つ使い回す（sqlite3 の接続はスレッドをまたげない）。
+    スレッドローカルに持つので、終わったスレッドの接続を同じ ident の新しいスレッドが拾うことはない
+    """
+    archives = getattr(_LOCAL, "archives", None)
+    if archives is None:
+        archives = _LOCAL.archives = {}
+    key = (str(Path(root).resolve()), os.getpid())
+    a = archives.get(key)
+    if a is None:
+        a = archives[key] = SnapshotArchive(root)
+    return a
+
+def save_snapshot(url: str, content: bytes | str, rendered: bool = False) -> int | None:
+    """取得したページを保存する。失敗しても呼び出し側は止めない（WIN5_SNAPSHOTS=0 なら何もしない）"""
+    if not ENABLED:
+        return None
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    try:
+        return archive().put(url, content, rendered=rendered)
+    except (sqlite3.Error, OSError, RuntimeError) as e:
+        print(f"[WARN] スナップショットの保存に失敗: {url}: {type(e).__name__}: {e}")
+        return None
+
+def load_snapshot(url: str, at: dt.datetime | None = None) -> bytes | None:
+    """url の保存済みページ（at 時点、既定は最新）。無ければ None"""
+    hit = archive().latest(url, at)
+    return hit[1] if hit else None
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    a = SnapshotArchive(Path(opts["dir"]) if opts.get("dir") else SNAPSHOT_DIR)
+    if "train" in opts:
+        kinds = [opts["train"]] if opts["train"] else [r["kind"] for r in a.stats()]
+        for kind in kinds:
+            dict_id = a.train(kind)
+            print(f"{kind}: 辞書 {dict_id if dict_id else 'なし（サンプル不足）'}")
+    elif opts.get("list"):
+        for r in a.find(opts["list"], like=True):
+            print(f"{r['id']:>7}  {r['fetched_at']}  {r['raw_len']:>8} → {r['length']:>7}  {r['url']}")
+    elif opts.get("url"):
+        at = dt.datetime.fromisoformat(opts["at"]) if opts.get("at") else None
+        hit = a.latest(opts["url"], at)
+        if hit is None:
+            print(f"スナップショットがありません: {opts['url']}")
+            sys.exit(2)
+        if opts.get("out"):
+            Path(opts["out"]).write_bytes(hit[1])
+            print(f"{hit[0]} のスナップショットを保存: {opts['out']}")
+        else:
+            sys.stdout.buffer.write(hit[1])
+    else:
+        for r in a.stats():
+            ratio = r["raw"] / r["stored"] if r["stored"] else 0
+            print(f"{r['kind']:>6}: {r['n']:>6} 件  {r['raw'] / 1e6:8.1f}MB → {r['stored'] / 1e6:7.2f}MB"
+                  f"（{ratio:.1f} 倍、辞書 {r['dict_id'] or 'なし'}）")
+    a.close()
+
+if __name__ == "__main__":
+    main()
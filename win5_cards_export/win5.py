@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+WIN5 の買い目（フォーメーション）の組み合わせ数・購入額と、組み合わせの列挙。
+
+フォーメーションは 5 レースそれぞれで選んだ馬番の集合。組み合わせ数は各レースの頭数の積、
+購入額はそれに 1 組 100 円を掛けたもの。表現は 2 通り:
+
+- sel:  レースごとの馬番の配列 5 つ（selections() で出馬表の DataFrame から作る）
+- mask: (…, 5, MAX_HORSES) の bool 配列（馬番 n は列 n-1）。先頭の次元で複数の買い目をまとめて扱える
+
+組み合わせは Python のタプルを作らず、CHUNK 組ずつの (m, 5) の NumPy 配列で流す（iter_combinations）。
+全頭 × 5 レース（18^5 ≒ 189 万組）でもメモリは 1 チャンク分で済む。
+
+    python win5.py 1,3,5 2 1-4 7 全                     # 組み合わせ数と購入額
+    python win5.py 全 全 全 全 全 --fields=18,16,18,14,18
+    python win5.py 人気3 人気2 1 人気3 人気4 --book=output/Win5出馬表_20250504_093000.xlsx
+    python win5.py 全 全 全 全 全 --list | head        # 組み合わせを 1 行 1 組で書き出す
+"""
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# ===================== 定数 =====================
+LEGS = 5              # WIN5 の対象レース数
+MAX_HORSES = 18       # 1 レースの最大頭数（mask の幅）
+UNIT_STAKE = 100      # 1 組の購入額（円）
+CHUNK = 1 << 18       # iter_combinations が 1 回に返す組数（int8 × 5 列で約 1.3MB）
+ALL_SPECS = {"全", "all", "*"}
+TOP_RE = re.compile(r"(?:人気|top)(\d+)", re.I)
+
+# ===================== 買い目 =====================
+def _leg(numbers) -> np.ndarray:
+    """馬番の並び → 重複なし・昇順の int8 配列（範囲外は ValueError）"""
+    a = np.unique(np.asarray(list(numbers), dtype=np.int64))
+    if a.size and (a[0] < 1 or a[-1] > MAX_HORSES):
+        raise ValueError(f"馬番は 1〜{MAX_HORSES} です: {a.tolist()}")
+    return a.astype(np.int8)
+
+def formation(legs) -> list[np.ndarray]:
+    """レースごとの馬番の並び 5 つ → sel"""
+    legs = list(legs)
+    if len(legs) != LEGS:
+        raise ValueError(f"WIN5 は {LEGS} レース分の馬番が必要です（{len(legs)} レース分）")
+    return [_leg(x) for x in legs]
+
+def selections(frames: list[pd.DataFrame], picks=None) -> list[np.ndarray]:
+    """
+    出馬表の DataFrame 5 つ（_extract_table() の戻り値、WIN1〜5 の順）から sel を作る。
+    picks はレースごとに None（全頭）・int n（人気順の上位 n 頭）・馬番の並びのいずれか
+    """
+    picks = list(picks) if picks is not None else [None] * len(frames)
+    if len(frames) != LEGS or len(picks) != LEGS:
+        raise ValueError(f"WIN5 は {LEGS} レース分の出馬表と選択が必要です")
+    sel = []
+    for win, (df, pick) in enumerate(zip(frames, picks), start=1):
+        df = df.dropna(subset=["馬番"])
+        if pick is None:
+            nums = df["馬番"]
+        elif isinstance(pick, (int, np.integer)):
+            nums = df.sort_values("人気順", na_position="last")["馬番"].head(int(pick))
+        else:
+            running = set(df["馬番"].astype(int))
+            nums = [n for n in pick if int(n) in running]
+            if len(nums) < len(list(pick)):
+                print(f"[WARN] WIN{win}: 出走していない馬番を除外: {sorted(set(map(int, pick)) - running)}")
+        sel.append(_leg(int(n) for n in nums))
+    return sel
+
+def count(sel) -> int:
+    """組み合わせ数（各レースの頭数の積）"""
+    return int(np.prod([len(s) for s in sel], dtype=object))
+
+def stake(sel, unit: int = UNIT_STAKE) -> int:
+    """購入額（円）"""
+    return count(sel) * unit
+
+# ===================== mask 表現 =====================
+def to_mask(sel) -> np.ndarray:
+    """sel → (5, MAX_HORSES) の bool 配列"""
+    mask = np.zeros((LEGS, MAX_HORSES), dtype=bool)
+    for i, s in enumerate(sel):
+        mask[i, np.asarray(s, dtype=np.int64) - 1] = True
+    return mask
+
+def from_mask(mask: np.ndarray) -> list[np.ndarray]:
+    """(5, MAX_HORSES) の bool 配列 → sel"""
+    return [(np.flatnonzero(m) + 1).astype(np.int8) for m in np.asarray(mask, dtype=bool)]
+
+def counts(masks: np.ndarray) -> np.ndarray:
+    """(…, 5, MAX_HORSES) → 買い目ごとの組み合わせ数（int64。18^5 でも収まる）"""
+    return np.asarray(masks, dtype=bool).sum(axis=-1, dtype=np.int64).prod(axis=-1)
+
+def stakes(masks: np.ndarray, unit: int = UNIT_STAKE) -> np.ndarray:
+    return counts(masks) * unit
+
+# ===================== 列挙 =====================
+def _strides(sizes: np.ndarray) -> np.ndarray:
+    """通し番号 → 各レースの位置の桁の重み（最後のレースが最も速く回る）"""
+    return np.concatenate([np.cumprod(sizes[::-1])[::-1][1:], [1]]).astype(np.int64)
+
+def iter_combinations(sel, chunk: int = CHUNK, numbers: bool = True, start: int = 0, stop: int | None = None):
+    """
+    組み合わせを通し番号順に (m, 5) の int8 配列で返すジェネレータ（m ≤ chunk）。
+    numbers=True なら馬番、False なら各レースの sel 内の位置（0 始まり）。
+    start / stop で通し番号の範囲を切ると、複数プロセスで分けて流せる
+    """
+    legs = [np.asarray(s, dtype=np.int8) for s in sel]
+    sizes = np.array([len(s) for s in legs], dtype=np.int64)
+    total = count(legs)
+    stop = total if stop is None else min(stop, total)
+    strides = _strides(sizes)
+    for lo in range(start, stop, chunk):
+        k = np.arange(lo, min(lo + chunk, stop), dtype=np.int64)
+        out = np.empty((k.size, LEGS), dtype=np.int8)
+        for i in range(LEGS):
+            pos = (k // strides[i]) % sizes[i] if strides[i] > 1 else k % sizes[i]
+            out[:, i] = legs[i][pos] if numbers else pos
+        yield out
+
+def combination_index(sel, combos: np.ndarray) -> np.ndarray:
+    """
+    馬番の組 (m, 5) → iter_combinations の通し番号（int64。買い目に含まれない組は -1）。
+    着順（各レースの勝ち馬）が買い目の何番目に当たるかをまとめて引く用
+    """
+    combos = np.asarray(combos, dtype=np.int64).reshape(-1, LEGS)
+    sizes = np.array([len(s) for s in sel], dtype=np.int64)
+    strides = _strides(sizes)
+    flat = np.zeros(len(combos), dtype=np.int64)
+    hit = np.ones(len(combos), dtype=bool)
+    for i, s in enumerate(sel):
+        lookup = np.full(MAX_HORSES + 1, -1, dtype=np.int64)  # 馬番 → sel 内の位置
+        lookup[np.asarray(s, dtype=np.int64)] = np.arange(len(s))
+        pos = lookup[np.clip(combos[:, i], 0, MAX_HORSES)]
+        hit &= pos >= 0
+        flat += pos * strides[i]
+    return np.where(hit, flat, -1)
+
+# ===================== メイン =====================
+def _parse_spec(spec: str, field: int | None, frame: pd.DataFrame | None):
+    """コマンドラインの 1 レース分（"1,3,5" / "1-4" / "全" / "人気3"）→ selections() の pick か馬番の並び"""
+    spec = spec.strip()
+    m = TOP_RE.fullmatch(spec)
+    if m:
+        if frame is None:
+            raise ValueError(f"{spec}: 人気順の指定には --book が必要です")
+        return int(m.group(1))
+    if spec in ALL_SPECS:
+        return None if frame is not None else range(1, (field or MAX_HORSES) + 1)
+    nums = []
+    for part in spec.split(","):
+        a, _, b = part.partition("-")
+        nums.extend(range(int(a), int(b or a) + 1))
+    return nums
+
+def book_frames(path: str) -> list[pd.DataFrame]:
+    """出力ブックの最新回の WIN1〜5 の出馬表（馬番・人気順・オッズ・馬名。output_loader で読む）"""
+    from output_loader import load_outputs
+    df = load_outputs([path]).reset_index()
+    df = df[df["run_ts"] == df["run_ts"].max()]
+    frames = []
+    for w in range(1, LEGS + 1):
+        f = df[df["win"] == w]
+        if "人気順" not in f.columns:  # 人気順の列が無い古い出力はオッズの順（それも無ければ馬番順）
+            f = f.assign(人気順=f["オッズ"].rank(method="min") if "オッズ" in f.columns else f["馬番"])
+        frames.append(f[[c for c in ("馬番", "人気順", "オッズ", "馬名") if c in f.columns]].reset_index(drop=True))
+    return frames
+
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if len(args) != LEGS:
+        print("使い方: python win5.py <WIN1> … <WIN5> [--fields=18,16,…] [--book=出力ブック.xlsx] [--list]\n"
+              "        各レースは 1,3,5 / 1-4 / 全 / 人気3（--book の人気順）")
+        sys.exit(2)
+    fields = [int(x) for x in opts["fields"].split(",")] if opts.get("fields") else [None] * LEGS
+    frames = book_frames(opts["book"]) if opts.get("book") else None
+    picks = [_parse_spec(a, f, frames[i] if frames else None) for i, (a, f) in enumerate(zip(args, fields))]
+    sel = selections(frames, picks) if frames else formation(picks)
+
+    if "list" in opts:
+        for block in iter_combinations(sel):
+            sys.stdout.write("\n".join("-".join(map(str, row)) for row in block.tolist()) + "\n")
+        return
+    for i, s in enumerate(sel, start=1):
+        print(f"WIN{i}: {len(s)} 頭  {','.join(map(str, s.tolist()))}")
+    t0 = time.perf_counter()
+    n = sum(len(block) for block in iter_combinations(sel))
+    print(f"{count(sel):,} 組 / {stake(sel):,} 円（列挙 {n:,} 組 {time.perf_counter() - t0:.2f} 秒）")
+
+if __name__ == "__main__":
+    main()
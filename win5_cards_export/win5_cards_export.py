@@ -4,6 +4,9 @@ import re
 import sys
 import time
 import math
+import signal
+import subprocess
+import threading
 import datetime as dt
 import pandas as pd
 import requests
@@ -12,8 +15,6 @@ from io import StringIO
 from pathlib import Path
 from bs4 import BeautifulSoup
 from openpyxl import load_workbook
-from openpyxl.cell.cell import MergedCell
-from bs4 import UnicodeDammit
 from urllib.parse import urlparse, parse_qs, unquote
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -23,21 +24,32 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 
+import render_daemon
+from dataclasses import asdict
+from xlsx_template import (OddsLayout, WritePlan, discover_odds_layout, get_write_plan,
+                           apply_section, section_cells, load_template)
+from xlsx_patch import write_cells, patch_workbook, read_sheet_values, read_custom_props
+from formula_eval import formula_program
+from sidecar import write_sidecar
+from race_store import write_store
+from entities import id_column, row_ids, remember_names
+from snapshot_archive import save_snapshot
+from fetch_layer import build_session, decode_html_bytes
+from jra import RaceId, PLACE_RE, known_win5, race_date_of, remember_race, remember_win5
+
 # ===================== 定数 =====================
-HEADERS = {
-    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                   "AppleWebKit/537.36 (KHTML, like Gecko) "
-                   "Chrome/120.0.0.0 Safari/537.36"),
-    "Referer": "https://www.netkeiba.com/",
-    "Accept-Language": "ja,en;q=0.9",
-}
 idx = 1 #土曜日はidx=0、日曜日はidx=1
 PC_URL = f"https://race.netkeiba.com/top/win5.html?idx={idx}"
 SP_URL = "https://race.sp.netkeiba.com/?pid=win5&date={date}"  # YYYYMMDD
 RACE_ID_RE = re.compile(r"race_id=(\d{12})")
+# 出力ブックに race_id を残すユーザー定義プロパティ名（WIN 区画順のカンマ区切り）
+RACE_IDS_PROP = "win5_race_ids"
+RACE_DATE_PROP = "win5_race_date"   # retention.py が開催日ごとにまとめるのに使う
 
 # テンプレートファイル
 TEMPLATE_XLSX = Path(__file__).resolve().with_name("race_cards.xlsx")
+ODDS_SHEET = "オッズデータ入力"
+# 以下のレイアウトはテンプレートから自動検出できなかった時のフォールバック（通常は discover_odds_layout の結果を使う）
 # オッズデータ入力シートのWIN別セクション開始列（B=2, N=14, Z=26, AL=38, AX=50）
 WIN_SECTION_COLS = [2, 14, 26, 38, 50]
 # セクション内のデータ列オフセット（数式列の差・人気順はスキップ）
@@ -47,44 +59,69 @@ DATA_END_ROW   = 25
 TIME_ROW       = 4
 RACE_NAME_ROW  = 5
 COURSE_ROW     = 6
+# 1 ページのレンダリングに許す壁時計上限（秒）。超えたら Chrome ごと作り直す
+RENDER_DEADLINE_SEC = 90
 
 # ===================== 高速化：HTTPセッション =====================
-def build_session() -> requests.Session:
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
-
-    s = requests.Session()
-    s.headers.update(HEADERS)
-    retry = Retry(
-        total=3, backoff_factor=0.3,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=("GET",)
-    )
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
-    return s
-
 SESSION = build_session()
 
 # ===================== HTMLユーティリティ =====================
-def _decode_html_bytes(b: bytes, fallback: str = "utf-8") -> str:
-    dammit = UnicodeDammit(b, is_html=True)
-    if dammit.unicode_markup:
-        return dammit.unicode_markup
-    return b.decode(fallback, errors="replace")
-
 def _get_html(url: str, timeout: int = 15) -> str:
     r = SESSION.get(url, timeout=timeout)
     r.raise_for_status()
-    return _decode_html_bytes(r.content)
+    save_snapshot(url, r.content)
+    return decode_html_bytes(r.content)
 
 # ===================== Selenium（必要時のみ） =====================
+def _child_pids(pid: int) -> list[int]:
+    """/proc から pid の子孫プロセスを列挙する（Linux 以外は空）"""
+    out, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/task/{p}/children", encoding="ascii") as f:
+                kids = [int(x) for x in f.read().split()]
+        except OSError:
+            kids = []
+        out.extend(kids)
+        stack.extend(kids)
+    return out
+
+def _kill_process_tree(pid: int):
+    """pid とその子孫を強制終了する"""
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    # 親を殺すと子が init に付け替わって辿れなくなるので先に列挙する
+    for p in [*reversed(_child_pids(pid)), pid]:
+        try:
+            os.kill(p, signal.SIGKILL)
+        except OSError:
+            pass
+
+def _rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
 class LazyBrowser:
     """必要な時だけ起動し、プロセスは使い回す。"""
-    def __init__(self):
+    def __init__(self, use_daemon: bool = True, deadline: int = RENDER_DEADLINE_SEC):
         self._driver = None
-
-    def _new_driver(self):
+        self._service = None
+        self._lock = threading.Lock()
+        self._generation = 0  # kill() / close() のたびに進める。見切った起動スレッドの Chrome を後から載せない
+        self.use_daemon = use_daemon  # 常駐デーモンが居ればそちらに任せる
+        self.deadline = deadline
+        self.incidents: list[str] = []  # ハング・クラッシュで作り直した理由
+
+    def _new_driver(self, gen: int):
         os.environ["WDM_LOG"] = "0"
         os.environ["WDM_PRINT_FIRST_LINE"] = "False"
         options = webdriver.ChromeOptions()
@@ -105,18 +142,77 @@ class LazyBrowser:
             ChromeDriverManager().install(),
             log_output=open(os.devnull, "w", encoding="utf-8", errors="ignore")
         )
+        with self._lock:
+            if gen != self._generation:
+                raise RuntimeError("Chrome の起動中に強制終了されました")
+            self._service = service  # 起動途中で固まっても kill() で回収できるよう先に保持
         d = webdriver.Chrome(service=service, options=options)
         d.set_page_load_timeout(45)
         d.set_script_timeout(45)
-        return d
+        return d, service
 
     @property
     def driver(self):
-        if self._driver is None:
-            self._driver = self._new_driver()
-        return self._driver
+        with self._lock:
+            if self._driver is not None:
+                return self._driver
+            gen = self._generation
+        d, service = self._new_driver(gen)
+        with self._lock:
+            if gen == self._generation:
+                self._driver = d
+                return d
+        # 起動を待つ間に kill() / close() された（見切られたスレッド）: 載せずに自分で回収する
+        proc = getattr(service, "process", None)
+        if proc is not None:
+            _kill_process_tree(proc.pid)
+        raise RuntimeError("Chrome の起動中に強制終了されました")
+
+    def memory_mb(self) -> float:
+        """chromedriver 配下（Chrome 本体・レンダラ含む）の合計 RSS"""
+        proc = getattr(self._service, "process", None)
+        if self._driver is None or proc is None:
+            return 0.0
+        pid = proc.pid
+        return sum(_rss_mb(p) for p in [pid, *_child_pids(pid)])
 
     def get_rendered_html(self, url: str, wait_css: str = None, hard_timeout: int = 25, wait_odds: bool = False) -> str:
+        """監視付きでレンダリングする。期限超過・クラッシュ時は Chrome を作り直して 1 回だけ再試行"""
+        deadline = max(self.deadline, hard_timeout * 2 + 15)
+        if self.use_daemon and self._driver is None:
+            html = render_daemon.request_render(url, wait_css=wait_css, hard_timeout=hard_timeout,
+                                                wait_odds=wait_odds, timeout=deadline * 2 + 10)
+            if html is not None:
+                return html
+
+        for attempt in (1, 2):
+            ok, res = self._supervised(deadline, self._render, url, wait_css, hard_timeout, wait_odds)
+            if ok:
+                return res
+            reason = f"{url}: {res}"
+            self.incidents.append(reason)
+            print(f"[WARN] レンダリング異常（{attempt}回目）: {reason} → Chrome を強制終了")
+            self.kill()
+        raise TimeoutError(f"レンダリングできませんでした: {url}")
+
+    def _supervised(self, deadline: float, fn, *args) -> tuple[bool, str]:
+        """fn を別スレッドで実行し、壁時計 deadline 秒で見切る"""
+        box = {}
+        def run():
+            try:
+                box["html"] = fn(*args)
+            except Exception as e:
+                box["error"] = f"{type(e).__name__}: {e}"
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        t.join(deadline)
+        if t.is_alive():
+            return False, f"{deadline}秒以内に応答なし"
+        if "error" in box:
+            return False, box["error"]
+        return True, box["html"]
+
+    def _render(self, url: str, wait_css: str, hard_timeout: int, wait_odds: bool) -> str:
         d = self.driver
         try:
             try:
@@ -155,12 +251,32 @@ class LazyBrowser:
             return d.page_source
         except Exception:
             return d.page_source
+    def kill(self):
+        """chromedriver と配下の Chrome を強制終了して回収する（quit() が効かない時用）"""
+        with self._lock:
+            self._generation += 1
+            proc = getattr(self._service, "process", None)
+            self._driver = None
+            self._service = None
+        if proc is not None:
+            _kill_process_tree(proc.pid)
+            try:
+                proc.wait(timeout=5)  # ゾンビを残さない
+            except Exception:
+                pass
+
     def close(self):
-        try:
-            if self._driver:
-                self._driver.quit()
-        except Exception:
-            pass
+        with self._lock:
+            d = self._driver
+        if d:
+            ok, _ = self._supervised(15, d.quit)
+            if not ok:
+                self.kill()
+                return
+        with self._lock:
+            self._generation += 1
+            self._driver = None
+            self._service = None
 
 BROWSER = LazyBrowser()
 
@@ -280,8 +396,16 @@ def _extract_table(html: str) -> pd.DataFrame | None:
             # 性齢の正規化と分解（おまけ）
             out["性齢"] = out["性齢"].astype(str).str.replace(r"\s+", "", regex=True)
 
+            # 馬・騎手の整数キー（read_html はリンクを捨てるので、各行の /horse/・/jockey/ リンクから）
+            out = out.reset_index(drop=True)
+            out["horse_id"] = id_column(row_ids("horse", html), len(out))
+            out["jockey_id"] = id_column(row_ids("jockey", html), len(out))
+            remember_names("horse", out["horse_id"], out["馬名"])
+            remember_names("jockey", out["jockey_id"], out["騎手名"])
+
             # 見やすい並びにして返す（必要に応じて変更OK）
-            order = [c for c in [ "人気順", "馬番", "オッズ", "馬名", "性齢", "斤量", "騎手名"] if c in out.columns]
+            order = [c for c in [ "人気順", "馬番", "オッズ", "馬名", "性齢", "斤量", "騎手名", "horse_id", "jockey_id"]
+                     if c in out.columns]
             out = out[order]
 
             return out
@@ -303,7 +427,8 @@ def _extract_table(html: str) -> pd.DataFrame | None:
 #     data02 = re.sub(r"\s+", " ", data02.get_text(" ", strip=True)) if data02 else None
 #     return name, data01, data02
 
-def _extract_race_meta(html: str) -> tuple[str|None, str|None, str|None, str|None, str|None, str|None]:
+def _extract_race_meta(html: str, race_id: RaceId | None = None) -> tuple[str|None, str|None, str|None, str|None, str|None, str|None]:
+    """race_id を渡すと場名は race_id の場コードから、開催日はページに無ければカレンダーから"""
     soup = BeautifulSoup(html, "lxml")
     name = soup.select_one(".RaceName")
     data01 = soup.select_one(".RaceData01")
@@ -315,8 +440,7 @@ def _extract_race_meta(html: str) -> tuple[str|None, str|None, str|None, str|Non
     data01 = re.sub(r"\s+", " ", data01.get_text(" ", strip=True)) if data01 else None
     data02 = re.sub(r"\s+", " ", data02.get_text(" ", strip=True)) if data02 else None
     rnum  = rnum.get_text(strip=True) if rnum else None
-    place: str | None = None
-    PLACE_PATTERN = re.compile(r"(札幌|函館|福島|新潟|東京|中山|中京|京都|阪神|小倉)")
+    place: str | None = (race_id.venue_name or None) if race_id else None
 
     # rnum 正規化（"第10R" → "10R" など）
     if rnum:
@@ -324,8 +448,8 @@ def _extract_race_meta(html: str) -> tuple[str|None, str|None, str|None, str|Non
         if m:
             rnum = f"{int(m.group(1))}R"
 
-    if data02:
-        m = PLACE_PATTERN.search(data02)
+    if data02 and not place:
+        m = PLACE_RE.search(data02)
         if m:
             place = m.group(1)
 
@@ -360,13 +484,19 @@ def _extract_race_meta(html: str) -> tuple[str|None, str|None, str|None, str|Non
                 race_date = m.group(1)
                 break
 
+    # 3) それでも無ければカレンダー（以前に見た同じ開催の日付）
+    if not race_date and race_id:
+        race_date = race_date_of(race_id) or None
+
     return race_date, name, data01, data02, place, rnum
 
-def fetch_shutsuba_with_meta(url: str, timeout_sec: int = 15) -> tuple[pd.DataFrame, tuple[str,str,str]]:
-    # まず静的HTML
-    html = _get_html(url, timeout=timeout_sec)
+def fetch_shutsuba_with_meta(url: str, timeout_sec: int = 15,
+                             html: str | None = None) -> tuple[pd.DataFrame, tuple[str,str,str]]:
+    # まず静的HTML（取得済みの html があればそれを使う）
+    html = html or _get_html(url, timeout=timeout_sec)
+    rid = RaceId.from_url(url)
     df = _extract_table(html)
-    race_date, name, d1, d2, place, rnum = _extract_race_meta(html)
+    race_date, name, d1, d2, place, rnum = _extract_race_meta(html, rid)
     if df is not None and name and d1 and d2:
         return df, (race_date, name, d1, d2, place, rnum)
 
@@ -377,8 +507,9 @@ def fetch_shutsuba_with_meta(url: str, timeout_sec: int = 15) -> tuple[pd.DataFr
         hard_timeout=30,
         wait_odds=True
     )
+    save_snapshot(url, html2, rendered=True)
     df2 = _extract_table(html2)
-    race_date2, name2, d12, d22, place2, rnum2  = _extract_race_meta(html2)
+    race_date2, name2, d12, d22, place2, rnum2  = _extract_race_meta(html2, rid)
     if df2 is not None and name2 and d12 and d22:
         return df2, (race_date2, name2, d12, d22, place2, rnum2)
 
@@ -402,6 +533,13 @@ def pick_win5_ids(target_url: str | None = None) -> list[str]:
     jst = dt.timezone(dt.timedelta(hours=9))
     today = dt.datetime.now(jst).strftime("%Y%m%d")
     url = target_url or PC_URL
+    date = re.search(r"date=(\d{8})", url)
+    date = date.group(1) if date else None
+
+    # 日付指定でカレンダーに WIN5 があれば取得しない
+    ids = known_win5(date)
+    if ids:
+        return ids
 
     try:
         ids = _extract_ids_from_html(_get_html(url))
@@ -410,9 +548,7 @@ def pick_win5_ids(target_url: str | None = None) -> list[str]:
     except Exception:
         pass
 
-    date = re.search(r"date=(\d{8})", url)
-    date = date.group(1) if date else today
-
+    date = date or today
     try:
         ids = _extract_ids_from_html(_get_html(SP_URL.format(date=date)))
         return ids[:5] if len(ids) >= 5 else ids
@@ -459,40 +595,137 @@ def _parse_course_label(d1, d2) -> str:
     return f"{age}{cls}{dist}{course}".strip()
 
 # ===================== テンプレートへの書き込み =====================
-def write_race_to_odds_sheet(ws, win_idx: int, df: pd.DataFrame, race_title: str, race_time: str, course_label: str):
-    """オッズデータ入力シートの指定WIN区画にデータを書き込む"""
-    sec = WIN_SECTION_COLS[win_idx]
-
-    ws.cell(row=TIME_ROW,      column=sec).value = race_time
-    ws.cell(row=RACE_NAME_ROW, column=sec).value = race_title
-    ws.cell(row=COURSE_ROW,    column=sec).value = course_label
-
-    # 既存データをクリア（数式・結合セルはスキップ）
-    for row in range(DATA_START_ROW, DATA_END_ROW + 1):
-        for off in DATA_COL_OFFSETS.values():
-            cell = ws.cell(row=row, column=sec + off)
-            if isinstance(cell, MergedCell):
-                continue
-            if isinstance(cell.value, str) and cell.value.startswith("="):
-                continue
-            cell.value = None
-
-    # データを書き込む
-    for r_off, row_vals in enumerate(df.itertuples(index=False)):
-        r = DATA_START_ROW + r_off
-        if r > DATA_END_ROW:
-            break
-        for col_name, value in zip(df.columns, row_vals):
-            if col_name not in DATA_COL_OFFSETS:
-                continue
-            if isinstance(value, float) and math.isnan(value):
-                value = None
-            cell = ws.cell(row=r, column=sec + DATA_COL_OFFSETS[col_name])
-            if isinstance(cell, MergedCell):
-                continue
-            if isinstance(cell.value, str) and cell.value.startswith("="):
-                continue
-            cell.value = value
+DEFAULT_LAYOUT = OddsLayout(
+    section_cols=WIN_SECTION_COLS,
+    col_offsets=DATA_COL_OFFSETS,
+    start_row=DATA_START_ROW,
+    end_row=DATA_END_ROW,
+    meta_rows={"time": TIME_ROW, "name": RACE_NAME_ROW, "course": COURSE_ROW},
+)
+
+def odds_layout(ws=None) -> OddsLayout:
+    """テンプレートからレイアウトを検出する（ハッシュ単位でキャッシュ、失敗時は固定値）"""
+    try:
+        return discover_odds_layout(TEMPLATE_XLSX, ws, sheet=ODDS_SHEET)
+    except (ValueError, KeyError) as e:
+        print(f"[WARN] テンプレートのレイアウト検出に失敗したため固定値を使います: {e}")
+        return DEFAULT_LAYOUT
+
+def odds_write_plan(ws=None) -> WritePlan:
+    """オッズデータ入力シートの write plan（テンプレートのハッシュ単位でキャッシュ）"""
+    return get_write_plan(TEMPLATE_XLSX, ws, sheet=ODDS_SHEET, **asdict(odds_layout(ws)))
+
+def write_race_to_odds_sheet(ws, win_idx: int, df: pd.DataFrame, race_title: str, race_time: str, course_label: str,
+                             plan: WritePlan | None = None) -> dict[tuple[int, int], object]:
+    """オッズデータ入力シートの指定WIN区画にデータを書き込む（数式・結合セルは write plan で除外済み）"""
+    plan = plan or odds_write_plan(ws)
+    return apply_section(ws, plan, win_idx, df,
+                  {"time": race_time, "name": race_title, "course": course_label})
+
+def formula_values(sheet: str, cells: dict[tuple[int, int], object]) -> dict[tuple[int, int], object]:
+    """書き込んだセルから数式（人気順・差・平均）を計算する。失敗しても出力は続ける（Excel が開いた時に再計算）"""
+    try:
+        return formula_program(TEMPLATE_XLSX, sheet).evaluate(cells)
+    except Exception as e:
+        print(f"[WARN] 数式の事前計算に失敗: {type(e).__name__}: {e}")
+        return {}
+
+# ===================== オッズ差分更新（--refresh） =====================
+def _to_float(v) -> float | None:
+    try:
+        x = float(str(v).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+    return x if math.isfinite(x) and x > 0 else None
+
+def fetch_odds(race_id: str) -> pd.DataFrame:
+    """単勝オッズと人気を 馬番/オッズ/人気順 の DataFrame で返す（API → 出馬表ページの順に試す）"""
+    try:
+        r = SESSION.get(RaceId.parse(race_id).odds_url, timeout=10)
+        r.raise_for_status()
+        save_snapshot(r.url, r.content)
+        odds = ((r.json().get("data") or {}).get("odds") or {}).get("1") or {}
+        rows = []
+        for umaban, v in odds.items():
+            v = v if isinstance(v, list) else [v]
+            ninki = v[2] if len(v) > 2 else None
+            rows.append({"馬番": int(umaban), "オッズ": _to_float(v[0]),
+                         "人気順": int(ninki) if str(ninki).isdigit() else None})
+        if rows:
+            return pd.DataFrame(rows)
+    except (requests.RequestException, ValueError, AttributeError) as e:
+        print(f"[WARN] {race_id}: オッズ API 失敗（出馬表ページで取得）: {type(e).__name__}: {e}")
+    df, _ = fetch_shutsuba_with_meta(RaceId.parse(race_id).shutuba_url)
+    return df[[c for c in ("馬番", "オッズ", "人気順") if c in df.columns]]
+
+def _section_frame(plan: WritePlan, win_idx: int, values: dict[tuple[int, int], object]) -> pd.DataFrame:
+    """出力ブックの 1 区画を write plan の列で DataFrame に戻す（馬番の無い行は除く）"""
+    sec = plan.sections[win_idx]
+    cols = {name: [None] * plan.capacity for name in sec.fields}
+    for name, cells in sec.fields.items():
+        for slot, row, col in cells:
+            cols[name][slot] = values.get((row, col))
+    df = pd.DataFrame(cols, dtype=object)
+    if "馬番" not in df.columns:
+        return df.iloc[0:0]
+    df = df[df["馬番"].notna()].reset_index(drop=True)
+    df["馬番"] = df["馬番"].astype(int)
+    return df
+
+def _reorder_with_odds(df: pd.DataFrame, odds: pd.DataFrame) -> pd.DataFrame:
+    """最新オッズを 馬番 で当て、main と同じく 人気順→馬番 で並べ直す"""
+    new = df.copy()
+    by_num = odds.dropna(subset=["馬番"]).astype({"馬番": int}).set_index("馬番")
+    nums = new["馬番"].astype(int)
+    new["オッズ"] = nums.map(by_num["オッズ"]).where(nums.isin(by_num.index), new["オッズ"])
+    ninki = nums.map(by_num["人気順"]) if "人気順" in by_num.columns else pd.Series(index=new.index, dtype=float)
+    # 人気が取れない時はオッズから付ける（同オッズは同順位）
+    new["人気順"] = ninki.fillna(pd.to_numeric(new["オッズ"], errors="coerce").rank(method="min"))
+    return new.sort_values(["人気順", "馬番"], na_position="last", ignore_index=True, kind="mergesort")
+
+def refresh_odds(xlsx_path: Path, store: bool = True) -> int:
+    """
+    既存の出力ブックのオッズだけを取り直して上書きする。
+    変化の無いレースは書き込まず、変わったセル（オッズ・並び替わった行）だけを XML パッチで書く。
+    store=True なら取り直したオッズをレースストア（race_store.py）にスナップショットとして残す。
+    戻り値は更新したレース数。
+    """
+    race_ids = read_custom_props(xlsx_path).get(RACE_IDS_PROP, "").split(",")
+    if not any(race_ids):
+        raise ValueError(f"race_id が記録されていない出力です（{RACE_IDS_PROP} プロパティなし）: {xlsx_path}")
+
+    plan = odds_write_plan()  # キャッシュ済みならテンプレートは読まない
+    values = read_sheet_values(xlsx_path, plan.sheet)
+    changed: dict[tuple[int, int], object] = {}
+    updated = 0
+    for idx_r, rid in enumerate(race_ids[:len(plan.sections)]):
+        old = _section_frame(plan, idx_r, values)
+        if not rid or old.empty:
+            continue
+        try:
+            odds = fetch_odds(rid)
+            new = _reorder_with_odds(old, odds)
+        except Exception as e:
+            print(f"[SKIP] {rid}: {type(e).__name__}: {e}")
+            continue
+        if store:
+            write_store("odds", rid, odds)
+        new = new[list(old.columns)]
+        if new.astype(object).where(new.notna(), None).values.tolist() == \
+           old.astype(object).where(old.notna(), None).values.tolist():
+            print(f"[INFO] WIN{idx_r+1} ({rid}) 変化なし")
+            continue
+        cells = section_cells(plan, idx_r, new, {})
+        diff = {rc: v for rc, v in cells.items() if values.get(rc) != v}
+        changed.update(diff)
+        updated += 1
+        print(f"[INFO] WIN{idx_r+1} ({rid}) {len(diff)} セル更新")
+
+    if changed:
+        values.update(changed)
+        cached = formula_values(plan.sheet, values)
+        patch_workbook(xlsx_path, xlsx_path, {plan.sheet: changed}, cached={plan.sheet: cached})
+    return updated
 
 def safe_sheet_name(name: str, used: set[str]) -> str:
     base = re.sub(r"[\\/*?:\[\]]", "_", name).strip() or "sheet"
@@ -514,38 +747,46 @@ def get_output_dir() -> Path:
     out.mkdir(parents=True, exist_ok=True)
     return out
 
-# ===================== メイン =====================
-def main():
-    url_arg = sys.argv[1] if len(sys.argv) >= 2 else None
-    race_ids = pick_win5_ids(url_arg)
-    if not race_ids:
-        print("対象の race_id を取得できませんでした。")
-        sys.exit(2)
-
-    if not TEMPLATE_XLSX.exists():
-        print(f"テンプレートが見つかりません: {TEMPLATE_XLSX}")
-        sys.exit(3)
-
-    nowstamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    outdir = get_output_dir()
-    out_xlsx = outdir / f"Win5出馬表_{nowstamp}.xlsx"
-    print(f"出力開始: {out_xlsx}")
-
-    wb = load_workbook(TEMPLATE_XLSX)
-    ws_odds = wb["オッズデータ入力"]
+# ===================== 出力ブック作成 =====================
+def export_cards(race_ids: list[str], out_xlsx: Path, fast: bool = False, sidecar: bool = False,
+                 pages: dict[str, str] | None = None, store: bool = True) -> list[str]:
+    """
+    race_ids（WIN 区画順）の出馬表を out_xlsx に書き出す。失敗したレースのメッセージを返す。
+    pages = {race_id: 出馬表 HTML} を渡すとそのページは取得しない（batch_export.py の先読み分）。
+    store=True なら取得した出馬表・オッズをレースストア（race_store.py）にも書く。
+    """
+    if fast:
+        wb, ws_odds = None, None
+        plan = odds_write_plan()  # キャッシュが無い時だけテンプレートを読む
+    else:
+        wb = load_template(TEMPLATE_XLSX)  # 解析済みスナップショットのコピー
+        ws_odds = wb[ODDS_SHEET]
+        plan = odds_write_plan(ws_odds)  # 書き込み前にコンパイル（キャッシュがあれば読むだけ）
+    cells: dict[tuple[int, int], object] = {}  # 書き込んだセル（数式の計算に使う）
 
     errors = []
     written = 0
+    race_dates = []
 
     for idx_r, rid in enumerate(race_ids):
-        if idx_r >= len(WIN_SECTION_COLS):
+        if idx_r >= len(plan.sections):
             break
-        url = f"https://race.netkeiba.com/race/shutuba.html?race_id={rid}"
         try:
-            df, meta = fetch_shutsuba_with_meta(url)
+            url = RaceId.parse(rid).shutuba_url
+            df, meta = fetch_shutsuba_with_meta(url, html=(pages or {}).get(rid))
             race_date, name, d1, d2, place, rnum = meta
             if not (name and d1 and d2):
                 raise ValueError("race meta not found")
+            if race_date:
+                race_dates.append(race_date)
+                remember_race(race_date, rid)
+            if sidecar:
+                write_sidecar("cards", df, rid, race_date,
+                              {"win": idx_r + 1, "race_name": name, "race_data01": d1, "race_data02": d2,
+                               "place": place, "race_num": rnum})
+            if store:
+                write_store("card", rid, {"race_date": race_date, "race_name": name, "data01": d1, "data02": d2,
+                                          "place": place, "race_num": rnum}, df)
 
             race_title   = f"{place}{rnum}_{name}" if place and rnum else name
             race_time    = _parse_race_time(d1)
@@ -555,7 +796,11 @@ def main():
                 df = df.sort_values(keys, na_position="last", ignore_index=True, kind="mergesort")
 
             print(f"第{written+1}レース [{race_title}] 書き込み中…")
-            write_race_to_odds_sheet(ws_odds, idx_r, df, race_title, race_time, course_label)
+            if fast:
+                cells.update(section_cells(plan, idx_r, df,
+                                           {"time": race_time, "name": race_title, "course": course_label}))
+            else:
+                cells.update(write_race_to_odds_sheet(ws_odds, idx_r, df, race_title, race_time, course_label, plan))
             print(f"第{written+1}レース [{race_title}] 書き込み完了")
             written += 1
         except Exception as e:
@@ -563,7 +808,59 @@ def main():
             print("[SKIP]", msg)
             errors.append(msg)
 
-    wb.save(out_xlsx)
+    if len(race_dates) == len(race_ids) and len(set(race_dates)) == 1:
+        remember_win5(race_dates[0], race_ids)  # 出馬表の開催日が揃った時だけ（カレンダー用）
+    cached = formula_values(plan.sheet, cells)
+    props = {RACE_IDS_PROP: ",".join(race_ids[:len(plan.sections)])}  # --refresh 用
+    if race_dates:
+        props[RACE_DATE_PROP] = race_dates[0]
+    if fast:
+        # テンプレートの <v> は古い計算結果（NOW() など計算しないセルも）なので、通常の出力と同じく消す
+        write_cells(TEMPLATE_XLSX, out_xlsx, plan.sheet, cells, cached=cached, props=props, clear_cached=True)
+    else:
+        wb.save(out_xlsx)
+        patch_workbook(out_xlsx, out_xlsx, {}, cached={plan.sheet: cached}, props=props)
+    return errors
+
+# ===================== メイン =====================
+def main():
+    # --fast: openpyxl を使わずテンプレート zip のシート XML だけを書き換えて出力
+    # --refresh <xlsx>: 既存の出力ブックのオッズだけを取り直して上書き
+    # --sidecar: 取得した出馬表を Parquet（sidecar.py）にも保存
+    # --no-store: レースストア（race_store.py の SQLite）に書かない
+    flags = {a for a in sys.argv[1:] if a.startswith("--")}
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    fast = "--fast" in flags
+    sidecar = "--sidecar" in flags
+    store = "--no-store" not in flags
+    if "--refresh" in flags:
+        if not args or not Path(args[0]).exists():
+            print("使い方: python win5_cards_export.py --refresh <出力xlsx>")
+            sys.exit(2)
+        try:
+            n = refresh_odds(Path(args[0]), store=store)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+        BROWSER.close()
+        print(f"オッズ更新完了: {args[0]}（{n} レース更新）")
+        return
+    url_arg = args[0] if args else None
+    race_ids = pick_win5_ids(url_arg)
+    if not race_ids:
+        print("対象の race_id を取得できませんでした。")
+        sys.exit(2)
+
+    if not TEMPLATE_XLSX.exists():
+        print(f"テンプレートが見つかりません: {TEMPLATE_XLSX}")
+        sys.exit(3)
+
+    nowstamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    outdir = get_output_dir()
+    out_xlsx = outdir / f"Win5出馬表_{nowstamp}.xlsx"
+    print(f"出力開始: {out_xlsx}")
+
+    export_cards(race_ids, out_xlsx, fast=fast, sidecar=sidecar, store=store)
     BROWSER.close()
     print(f"出力完了: {out_xlsx}")
 
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+単勝オッズから WIN5 の買い目の的中確率・期待払戻を計算して並べる。
+
+- 確率: 各レースの単勝オッズの逆数を合計 1 に正規化（控除分の上乗せを除く）。method="power" は
+  q^k の k をレースごとに合わせる補正で、人気薄の過大評価（favourite-longshot bias）を削る
+- 的中確率: 買い目（レースごとの馬番の集合）の的中確率は各レースの確率の和の積（閉じた式）
+- 期待払戻: 払戻 = (発売額 × 払戻率 + キャリーオーバー) ÷ 的中票数。的中票数は発売票数 × 世間の支持
+  （単勝オッズを正規化した確率の積）で見積もる。期待払戻も各レースの p/q の和の積で閉じる
+  （払戻上限と自分の票の分は入れない。入れる時は expected_payout_exact() で組み合わせごとに足す）
+
+買い目は win5.py の mask（(…, 5, MAX_HORSES) の bool 配列）で渡し、先頭の次元でまとめて計算する。
+
+    python win5_ev.py --book=output/Win5出馬表_20250504_093000.xlsx                  # 人気上位の組み合わせを並べる
+    python win5_ev.py --book=… --sales=6000000 --carry=120000000 --method=power --budget=20000 --top=30
+"""
+import sys
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from win5 import LEGS, MAX_HORSES, UNIT_STAKE, counts, from_mask, iter_combinations, book_frames
+
+# ===================== 定数 =====================
+RETURN_RATE = 0.70          # WIN5 の払戻率
+MAX_PAYOUT = 600_000_000    # 1 票あたりの払戻上限（円、キャリーオーバー込み）
+DEFAULT_SALES = 5_000_000   # 発売票数の見積もり（ストアに過去の WIN5 が無い時）
+SALES_HISTORY = 8           # 発売票数は直近この回数分の中央値で見積もる
+METHODS = ("normalize", "power")
+MAX_PICK = 6                # candidates() が各レースで試す人気上位の頭数
+
+# ===================== 確率 =====================
+def odds_matrix(frames: list[pd.DataFrame]) -> np.ndarray:
+    """出馬表の DataFrame 5 つ（_extract_table() の戻り値）→ (5, MAX_HORSES) の単勝オッズ（いない馬番は NaN）"""
+    odds = np.full((LEGS, MAX_HORSES), np.nan)
+    for i, df in enumerate(frames):
+        df = df.dropna(subset=["馬番"])
+        nums = df["馬番"].astype(int).to_numpy()
+        ok = (nums >= 1) & (nums <= MAX_HORSES)
+        odds[i, nums[ok] - 1] = pd.to_numeric(df["オッズ"], errors="coerce").to_numpy(dtype=float)[ok]
+    return odds
+
+def _inverse(odds: np.ndarray) -> np.ndarray:
+    odds = np.asarray(odds, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(np.isfinite(odds) & (odds > 0), 1.0 / odds, 0.0)
+
+def _power_exponent(q: np.ndarray, iters: int = 60) -> np.ndarray:
+    """sum(q^k) = 1 になる k をレースごとに二分法で（(…, 5) の配列でまとめて）"""
+    lo = np.full(q.shape[:-1], 0.2)
+    hi = np.full(q.shape[:-1], 5.0)
+    live = q > 0
+    for _ in range(iters):
+        k = (lo + hi) / 2
+        s = np.where(live, q ** k[..., None], 0.0).sum(axis=-1)
+        over = s > 1  # 合計が 1 を超える間は k を上げる（q < 1 なので q^k は k で減る）
+        lo, hi = np.where(over, k, lo), np.where(over, hi, k)
+    return (lo + hi) / 2
+
+def implied_probs(odds: np.ndarray, method: str = "normalize") -> np.ndarray:
+    """
+    単勝オッズ (…, 5, MAX_HORSES) → 勝つ確率（レースごとに合計 1、いない馬は 0）。
+    method="normalize" は 1/オッズ の比例配分、"power" は (1/オッズ)^k（人気薄ほど強く削る）
+    """
+    if method not in METHODS:
+        raise ValueError(f"method は {METHODS} のいずれかです: {method!r}")
+    q = _inverse(odds)
+    if method == "power":
+        k = _power_exponent(q)
+        q = np.where(q > 0, q ** k[..., None], 0.0)
+    total = q.sum(axis=-1, keepdims=True)
+    return np.divide(q, total, out=np.zeros_like(q), where=total > 0)
+
+# ===================== 的中確率・期待払戻 =====================
+def hit_probs(masks: np.ndarray, p: np.ndarray) -> np.ndarray:
+    """買い目 (…, 5, MAX_HORSES) の的中確率（各レースで選んだ馬の確率の和の積）"""
+    return np.einsum("...lh,lh->...l", np.asarray(masks, dtype=float), p).prod(axis=-1)
+
+def pool(sales: int, carryover: int = 0) -> float:
+    """払戻に回る額（円）。sales は発売票数（1 票 100 円）"""
+    return sales * UNIT_STAKE * RETURN_RATE + carryover
+
+def expected_payouts(masks: np.ndarray, p: np.ndarray, q: np.ndarray, sales: int, carryover: int = 0) -> np.ndarray:
+    """
+    買い目ごとの期待払戻（円）。組み合わせ c の払戻は pool / (sales × q_c) なので
+    Σ_c p_c × 払戻 = pool / sales × Π_レース Σ_選んだ馬 p / q（払戻上限・自分の票は入れない近似）
+    """
+    ratio = np.divide(p, q, out=np.zeros_like(p, dtype=float), where=q > 0)
+    per_leg = np.einsum("...lh,lh->...l", np.asarray(masks, dtype=float), ratio)
+    return pool(sales, carryover) / sales * per_leg.prod(axis=-1)
+
+def expected_payout_exact(mask: np.ndarray, p: np.ndarray, q: np.ndarray, sales: int, carryover: int = 0) -> float:
+    """
+    1 つの買い目の期待払戻（円）を組み合わせごとに足す。的中票数に自分の 1 票を足し、
+    払戻は 10 円未満切り捨て・MAX_PAYOUT で頭打ち（iter_combinations でチャンクごとに）
+    """
+    sel = from_mask(mask)
+    ps = [p[i, s - 1] for i, s in enumerate(sel)]
+    qs = [q[i, s - 1] for i, s in enumerate(sel)]
+    total, money = 0.0, pool(sales, carryover)
+    for pos in iter_combinations(sel, numbers=False):
+        pos = pos.astype(np.intp)
+        pc = np.prod([ps[i][pos[:, i]] for i in range(LEGS)], axis=0)
+        qc = np.prod([qs[i][pos[:, i]] for i in range(LEGS)], axis=0)
+        pay = np.minimum(np.floor(money / (sales * qc + 1) / 10) * 10, MAX_PAYOUT)
+        total += float(pc @ pay)
+    return total
+
+def evaluate(masks: np.ndarray, p: np.ndarray, q: np.ndarray | None = None,
+             sales: int = DEFAULT_SALES, carryover: int = 0) -> pd.DataFrame:
+    """
+    買い目 (n, 5, MAX_HORSES) をまとめて評価する。q（世間の支持）を省くと p と同じとみなす。
+    列: 組数・購入額・的中確率・期待払戻・期待値（期待払戻 ÷ 購入額）・期待収支
+    """
+    masks = np.asarray(masks, dtype=bool).reshape(-1, LEGS, MAX_HORSES)
+    q = p if q is None else q
+    n = counts(masks)
+    cost = n * UNIT_STAKE
+    ret = expected_payouts(masks, p, q, sales, carryover)
+    return pd.DataFrame({
+        "組数": n, "購入額": cost, "的中確率": hit_probs(masks, p), "期待払戻": ret,
+        "期待値": np.divide(ret, cost, out=np.zeros_like(ret), where=cost > 0), "期待収支": ret - cost,
+    })
+
+# ===================== 候補の生成と順位付け =====================
+def candidates(p: np.ndarray, max_pick: int = MAX_PICK, budget: int | None = None) -> np.ndarray:
+    """
+    各レースで確率の高い順に 1〜max_pick 頭を選ぶ全組み合わせの買い目 (K, 5, MAX_HORSES)。
+    budget（円）を渡すとそれを超える買い目を除く。max_pick=6 なら最大 6^5 = 7,776 通り
+    """
+    order = np.argsort(-p, axis=-1, kind="stable")
+    field = (p > 0).sum(axis=-1)
+    sizes = np.maximum(np.minimum(field, max_pick), 1)
+    # prefix[l, j] = レース l の上位 j+1 頭の mask
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(MAX_HORSES)[None, :].repeat(LEGS, 0), axis=-1)
+    prefix = rank[:, None, :] <= np.arange(max_pick)[None, :, None]
+    grid = np.indices(tuple(sizes)).reshape(LEGS, -1).T
+    masks = prefix[np.arange(LEGS), grid]
+    if budget is not None:
+        masks = masks[counts(masks) * UNIT_STAKE <= budget]
+    return masks
+
+def rank(masks: np.ndarray, p: np.ndarray, q: np.ndarray | None = None, by: str = "期待値", top: int = 20,
+         sales: int = DEFAULT_SALES, carryover: int = 0) -> pd.DataFrame:
+    """evaluate() して by の大きい順に top 件（買い目は WIN1〜5 の馬番の列で付ける）"""
+    res = evaluate(masks, p, q, sales, carryover)
+    best = np.argsort(-res[by].to_numpy(), kind="stable")[:top]
+    return with_legs(res.iloc[best].reset_index(drop=True), masks[best])
+
+def with_legs(res: pd.DataFrame, masks: np.ndarray) -> pd.DataFrame:
+    """評価結果の先頭に WIN1〜5 の馬番（"3,7,12"）の列を付ける（res と masks は同じ並び）"""
+    for i in range(LEGS):
+        res.insert(i, f"WIN{i + 1}", [",".join(map(str, np.flatnonzero(m[i]) + 1)) for m in masks])
+    return res
+
+def recent_sales(conn: sqlite3.Connection, n: int = SALES_HISTORY) -> int:
+    """ストアの直近 n 回の WIN5 の発売票数の中央値（無ければ DEFAULT_SALES）"""
+    rows = conn.execute("SELECT sales FROM win5_results WHERE sales > 0 ORDER BY race_date DESC LIMIT ?", (n,)).fetchall()
+    return int(np.median([r[0] for r in rows])) if rows else DEFAULT_SALES
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    if not opts.get("book"):
+        print("使い方: python win5_ev.py --book=出力ブック.xlsx [--sales=発売票数] [--carry=円] "
+              "[--method=normalize|power] [--max=6] [--budget=円] [--by=期待値|的中確率|期待収支] [--top=20]")
+        sys.exit(2)
+    frames = book_frames(opts["book"])
+    odds = odds_matrix(frames)
+    if "sales" in opts:
+        sales = int(opts["sales"])
+    else:
+        try:
+            from race_store import store
+            sales = recent_sales(store())
+        except (sqlite3.Error, OSError) as e:
+            print(f"[WARN] 発売票数をストアから見積もれません（{DEFAULT_SALES:,} 票）: {type(e).__name__}: {e}")
+            sales = DEFAULT_SALES
+    carry = int(opts.get("carry") or 0)
+    p = implied_probs(odds, opts.get("method") or "normalize")
+    q = implied_probs(odds)
+
+    t0 = time.perf_counter()
+    masks = candidates(p, int(opts.get("max") or MAX_PICK), int(opts["budget"]) if opts.get("budget") else None)
+    res = rank(masks, p, q, by=opts.get("by") or "期待値", top=int(opts.get("top") or 20), sales=sales, carryover=carry)
+    sec = time.perf_counter() - t0
+    print(f"発売 {sales:,} 票 / キャリーオーバー {carry:,} 円 / 候補 {len(masks):,} 通り（{sec:.3f} 秒）")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(res.to_string(formatters={"的中確率": "{:.4%}".format, "期待払戻": "{:,.0f}".format,
+                                        "期待値": "{:.3f}".format, "期待収支": "{:,.0f}".format}))
+
+if __name__ == "__main__":
+    main()
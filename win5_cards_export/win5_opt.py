@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+予算内で的中確率（または期待払戻・期待値）が最大になる WIN5 の買い目を探す。
+
+目的はどれもレースごとの項の積（的中確率 = Π Σp、期待払戻 ∝ Π Σp/q、期待値 ∝ Π Σ(p/q) / n）で、
+購入額も頭数の積なので、対数を取ると「レースごとに頭数 n を 1 つ選ぶ」ナップサックになる。
+頭数を決めれば、各レースはその目的の馬ごとの値（p または p/q）の上位 n 頭を選ぶのが最善（入れ替えると下がる）。
+なので 1 位は頭数の組だけを探せば決まる。
+
+- exact:  頭数の組をレースごとに NumPy でまとめて広げ、予算を超えるもの・上界が暫定 K 位に届かないものを
+          その場で捨てる（分枝限定法）。候補が FRONTIER_LIMIT を超えたら greedy に切り替える
+- greedy: 1 頭ずつから始めて「目的の増え方 ÷ 購入額の増え方」が最大のレースに 1 頭足していく。
+          近傍（各レース ±NEIGHBOR 頭）から頭数の組を取り、ラグランジュ緩和の上界で最適との差を返す
+
+2 位以下は上位 n 頭とは限らない（1 頭入れ替えた同じ購入額の買い目の方が良いことがある）。頭数の組ごとに、
+各レースの選び方を「選んだ馬を 1 つ下の順位の馬に入れ替える」で広げて良い順に出し（Lawler 式の best-first）、
+5 レース分を足し合わせたものを、頭数の組の 1 位の値の順にまとめて上から K 件取る。
+
+    python win5_opt.py --book=output/Win5出馬表_20250504_093000.xlsx --budget=20000
+    python win5_opt.py --book=… --budget=100000 --objective=期待払戻 --method=power --carry=300000000 --top=10
+"""
+import sys
+import time
+import heapq
+import numpy as np
+import pandas as pd
+
+from win5 import LEGS, MAX_HORSES, UNIT_STAKE, book_frames
+from win5_ev import DEFAULT_SALES, evaluate, implied_probs, odds_matrix, with_legs
+
+# ===================== 定数 =====================
+OBJECTIVES = ("的中確率", "期待払戻", "期待値")
+FRONTIER_LIMIT = 2_000_000   # exact で一度に持つ頭数の組の上限（超えたら greedy）
+NEIGHBOR = 2                 # greedy で探す近傍（各レースの頭数 ±NEIGHBOR）
+TOP_K = 10
+
+# ===================== レースごとの項 =====================
+def _scores(p: np.ndarray, q: np.ndarray | None, objective: str) -> np.ndarray:
+    """馬ごとの値（的中確率は p、期待払戻・期待値は p/q）"""
+    if objective not in OBJECTIVES:
+        raise ValueError(f"objective は {OBJECTIVES} のいずれかです: {objective!r}")
+    if objective == "的中確率":
+        return np.asarray(p, dtype=float)
+    q = p if q is None else q
+    return np.divide(p, q, out=np.zeros_like(p, dtype=float), where=q > 0)
+
+def _leg_terms(score: np.ndarray, objective: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (順位, 項)。順位はレースごとの値の高い順の馬番の位置、項 F[l, n-1] は上位 n 頭を選んだ時の
+    目的の対数（選べない頭数は -inf）
+    """
+    order = np.argsort(-score, axis=-1, kind="stable")
+    top = np.take_along_axis(score, order, axis=-1)
+    with np.errstate(divide="ignore"):
+        F = np.log(np.cumsum(top, axis=-1))
+    if objective == "期待値":
+        F = F - np.log(np.arange(1, MAX_HORSES + 1))
+    F[top <= 0] = -np.inf  # 値 0 の馬（いない馬番）は足さない
+    return order, F
+
+# ===================== greedy（限界効率） =====================
+def _greedy(F: np.ndarray, tickets: int) -> np.ndarray:
+    """目的の対数の増え方 ÷ 購入額の対数の増え方が最大のレースに 1 頭ずつ足す"""
+    n = np.ones(LEGS, dtype=np.int64)
+    while True:
+        nxt = np.minimum(n, MAX_HORSES - 1)
+        gain = F[np.arange(LEGS), nxt] - F[np.arange(LEGS), n - 1]
+        gain = np.where((n < MAX_HORSES) & np.isfinite(gain), gain, -np.inf) / np.log((n + 1) / n)
+        ok = np.prod(n) // n * (n + 1) <= tickets
+        gain = np.where(ok, gain, -np.inf)
+        best = int(np.argmax(gain))
+        if not gain[best] > 0:
+            return n
+        n[best] += 1
+
+def _neighbors(n: np.ndarray, F: np.ndarray, tickets: int) -> np.ndarray:
+    """n の各レース ±NEIGHBOR 頭の組のうち予算内で選べるもの (m, 5)"""
+    steps = np.arange(-NEIGHBOR, NEIGHBOR + 1)
+    grid = np.stack(np.meshgrid(*[n[l] + steps for l in range(LEGS)], indexing="ij"), -1).reshape(-1, LEGS)
+    grid = grid[((grid >= 1) & (grid <= MAX_HORSES)).all(axis=1)]
+    grid = grid[np.prod(grid, axis=1) <= tickets]
+    return grid[np.isfinite(_values(F, grid))]
+
+def _values(F: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    return F[np.arange(LEGS), sizes - 1].sum(axis=-1)
+
+def lagrange_bound(F: np.ndarray, tickets: int, grid: int = 200) -> float:
+    """
+    目的の対数の上界。どの λ ≥ 0 でも λ log(予算) + Σ_l max_n (F_l(n) − λ log n) は最適値以上なので、
+    λ を並べて一番小さいものを取る（greedy が最適からどれだけ離れうるかの目安）
+    """
+    lam = np.concatenate([[0.0], np.geomspace(1e-3, 50, grid)])
+    logn = np.log(np.arange(1, MAX_HORSES + 1))
+    inner = (F[None, :, :] - lam[:, None, None] * logn[None, None, :]).max(axis=-1).sum(axis=-1)
+    return float((lam * np.log(tickets) + inner).min())
+
+# ===================== exact（分枝限定） =====================
+def _exact(F: np.ndarray, tickets: int, floor: float) -> tuple[np.ndarray, int] | None:
+    """
+    頭数の組をレースごとに広げる。予算を超える組、残りのレースを予算いっぱいまで取っても floor（暫定 K 位）に
+    届かない組は捨てる。残った頭数の組（1 位の値の大きい順）と調べた組数を返す（候補が多すぎたら None）
+    """
+    # best[l, c] = レース l で頭数 c 以下から選ぶ時の項の最大（残りのレースの上界に使う）
+    best = np.maximum.accumulate(F, axis=-1)
+    sizes = np.zeros((1, 0), dtype=np.int64)
+    value = np.zeros(1)
+    cost = np.ones(1, dtype=np.int64)
+    nodes = 0
+    for l in range(LEGS):
+        n = np.arange(1, MAX_HORSES + 1)
+        value = (value[:, None] + F[l][None, :]).ravel()
+        cost = (cost[:, None] * n[None, :]).ravel()
+        sizes = np.concatenate([np.repeat(sizes, MAX_HORSES, axis=0), np.tile(n, len(sizes))[:, None]], axis=1)
+        keep = np.isfinite(value) & (cost <= tickets) & (value + 1e-12 >= floor if l == LEGS - 1 else True)
+        nodes += int(keep.sum())
+        if l < LEGS - 1:
+            room = np.minimum(tickets // np.maximum(cost, 1), MAX_HORSES)  # 残りの各レースで取れる頭数の上限
+            bound = value + sum(best[j][np.maximum(room, 1) - 1] for j in range(l + 1, LEGS))
+            keep &= bound >= floor
+        sizes, value, cost = sizes[keep], value[keep], cost[keep]
+        if len(sizes) * MAX_HORSES > FRONTIER_LIMIT:
+            return None
+    return sizes[np.argsort(-value, kind="stable")], nodes
+
+# ===================== K 位まで（入れ替えの best-first） =====================
+class _Subsets:
+    """
+    1 レースで n 頭を選ぶ選び方を、目的の対数の大きい順に出す。選んだ馬（値の順位の位置）の 1 つを
+    すぐ下の順位の選ばれていない馬に入れ替えると合計は下がらないので、上位 n 頭から入れ替えで広げる
+    """
+    def __init__(self, top: np.ndarray, n: int, objective: str):
+        self.top, self.n = top, n
+        self.penalty = np.log(n) if objective == "期待値" else 0.0
+        first = tuple(range(n))
+        self._heap = [(-self._value(first), first)]
+        self._seen = {first}
+        self.items: list[tuple[float, tuple]] = []
+
+    def _value(self, picks: tuple) -> float:
+        return float(np.log(self.top[list(picks)].sum()) - self.penalty)
+
+    def get(self, k: int) -> tuple[float, tuple] | None:
+        """k 番目（0 始まり）の選び方（値, 順位の位置のタプル）。無ければ None"""
+        while len(self.items) <= k and self._heap:
+            v, picks = heapq.heappop(self._heap)
+            self.items.append((-v, picks))
+            chosen = set(picks)
+            for i, pos in enumerate(picks):
+                nxt = pos + 1
+                if nxt < len(self.top) and nxt not in chosen:
+                    cand = tuple(sorted(picks[:i] + (nxt,) + picks[i + 1:]))
+                    if cand not in self._seen:
+                        self._seen.add(cand)
+                        heapq.heappush(self._heap, (-self._value(cand), cand))
+        return self.items[k] if k < len(self.items) else None
+
+class _Combos:
+    """頭数の組 1 つについて、5 レースの選び方の組を合計の大きい順に出す（各レースの何番目かを 1 つずつ進める）"""
+    def __init__(self, legs: list[_Subsets]):
+        self.legs = legs
+        first = (0,) * LEGS
+        self._heap = [(-self._value(first), first)]
+        self._seen = {first}
+
+    def _value(self, idx: tuple) -> float:
+        return sum(leg.get(i)[0] for leg, i in zip(self.legs, idx))
+
+    def peek(self) -> float | None:
+        return -self._heap[0][0] if self._heap else None
+
+    def pop(self) -> tuple[float, tuple]:
+        v, idx = heapq.heappop(self._heap)
+        for l in range(LEGS):
+            cand = idx[:l] + (idx[l] + 1,) + idx[l + 1:]
+            if cand not in self._seen and self.legs[l].get(cand[l]) is not None:
+                self._seen.add(cand)
+                heapq.heappush(self._heap, (-self._value(cand), cand))
+        return -v, tuple(leg.get(i)[1] for leg, i in zip(self.legs, idx))
+
+def _k_best(score: np.ndarray, objective: str, order: np.ndarray, sizes: np.ndarray,
+            top: int) -> tuple[np.ndarray, int]:
+    """
+    頭数の組 sizes（1 位の値の大きい順）から、買い目を目的の大きい順に top 件 (K, 5, MAX_HORSES)。
+    頭数の組の 2 位以下はその組の 1 位より下なので、1 位を出した組の次の組だけを候補に足していく
+    """
+    ranked = np.take_along_axis(score, order, axis=-1)
+    tops = [ranked[l][ranked[l] > 0] for l in range(LEGS)]
+    subsets: dict[tuple[int, int], _Subsets] = {}  # (レース, 頭数) ごとに頭数の組をまたいで使い回す
+
+    def combos(i: int) -> _Combos:
+        legs = []
+        for l, n in enumerate(sizes[i].tolist()):
+            if (l, n) not in subsets:
+                subsets[l, n] = _Subsets(tops[l], n, objective)
+            legs.append(subsets[l, n])
+        return _Combos(legs)
+
+    live: dict[int, _Combos] = {}
+    heap, picked = [], []
+    if len(sizes):
+        live[0] = combos(0)
+        heap.append((-live[0].peek(), 0))
+    while heap and len(picked) < top:
+        _, i = heapq.heappop(heap)
+        opened = i + 1 not in live
+        picked.append(live[i].pop()[1])
+        if live[i].peek() is not None:
+            heapq.heappush(heap, (-live[i].peek(), i))
+        if opened and i + 1 < len(sizes):  # 組 i の 1 位を出したら次の組を候補に入れる
+            live[i + 1] = combos(i + 1)
+            heapq.heappush(heap, (-live[i + 1].peek(), i + 1))
+    masks = np.zeros((len(picked), LEGS, MAX_HORSES), dtype=bool)
+    for k, picks in enumerate(picked):
+        for l, pos in enumerate(picks):
+            masks[k, l, order[l][list(pos)]] = True
+    return masks, sum(len(s._seen) for s in subsets.values())
+
+# ===================== 入口 =====================
+def optimize(p: np.ndarray, budget: int, q: np.ndarray | None = None, objective: str = "的中確率",
+             top: int = TOP_K, method: str = "auto", sales: int = DEFAULT_SALES,
+             carryover: int = 0) -> tuple[pd.DataFrame, dict]:
+    """
+    予算 budget（円）内で objective が大きい順に top 件の買い目を探す（予算内の買い目が top 件より少なければその数）。
+    p は (5, MAX_HORSES) の勝つ確率、q は世間の支持（期待払戻・期待値で使う。省くと p）。
+    method は "auto"（exact、多すぎたら greedy）/ "exact" / "greedy"。
+    戻り値は (win5_ev.evaluate() の列に WIN1〜5 の馬番を付けた DataFrame, 探し方の情報)
+    """
+    tickets = int(budget) // UNIT_STAKE
+    if tickets < 1:
+        raise ValueError(f"予算が 1 組（{UNIT_STAKE} 円）に足りません: {budget}")
+    p = np.asarray(p, dtype=float)
+    score = _scores(p, q, objective)
+    order, F = _leg_terms(score, objective)
+    if not np.isfinite(F[:, 0]).all():
+        raise ValueError("確率が 0 のレースがあります（オッズが入っていない？）")
+
+    greedy = _greedy(F, tickets)
+    near = _neighbors(greedy, F, tickets)
+    near_values = np.sort(_values(F, near))[::-1]
+    # 近傍の頭数の組の 1 位だけで top 件あれば、K 位の買い目は少なくともそれ以上
+    floor = near_values[top - 1] if len(near_values) >= top else -np.inf
+    info = {"method": "greedy", "nodes": len(near), "bound": lagrange_bound(F, tickets)}
+
+    found = _exact(F, tickets, floor) if method in ("auto", "exact") else None
+    if found is not None:
+        sizes, info["nodes"] = found
+        info.update(method="exact", gap=0.0)
+    else:
+        if method == "exact":
+            print(f"[WARN] 候補が FRONTIER_LIMIT（{FRONTIER_LIMIT:,}）を超えたので greedy で探します")
+        sizes = near[np.argsort(-_values(F, near), kind="stable")]
+        info["gap"] = info["bound"] - float(_values(F, sizes[:1])[0])  # 対数の差（exp(gap) 倍より良い解は無い）
+
+    masks, info["swaps"] = _k_best(score, objective, order, sizes, top)
+    return with_legs(evaluate(masks, p, q, sales, carryover), masks), info
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    if not (opts.get("book") and opts.get("budget")):
+        print("使い方: python win5_opt.py --book=出力ブック.xlsx --budget=円 [--objective=的中確率|期待払戻|期待値] "
+              "[--method=normalize|power] [--search=auto|exact|greedy] [--sales=発売票数] [--carry=円] [--top=10]")
+        sys.exit(2)
+    odds = odds_matrix(book_frames(opts["book"]))
+    p = implied_probs(odds, opts.get("method") or "normalize")
+    q = implied_probs(odds)
+    t0 = time.perf_counter()
+    res, info = optimize(p, int(opts["budget"]), q, objective=opts.get("objective") or "的中確率",
+                         top=int(opts.get("top") or TOP_K), method=opts.get("search") or "auto",
+                         sales=int(opts.get("sales") or DEFAULT_SALES), carryover=int(opts.get("carry") or 0))
+    print(f"{info['method']}: {info['nodes']:,} 組を評価（{time.perf_counter() - t0:.3f} 秒）"
+          f"  最適との差 ≤ {np.expm1(max(info['gap'], 0)):.1%}")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(res.to_string(formatters={"的中確率": "{:.4%}".format, "期待払戻": "{:,.0f}".format,
+                                        "期待値": "{:.3f}".format, "期待収支": "{:,.0f}".format}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+WIN5 の結果をモンテカルロで引いて、買い目の払戻の分布・収支の分位点・破産確率を見積もる。
+
+閉じた式（win5_ev.py）の期待払戻は平均しか出さない。払戻は勝った組み合わせがどれだけ買われていたかで
+大きく変わるので、結果を 1 日ずつ引いて払戻まで計算する:
+
+1. 各レースの勝ち馬を p（勝つ確率）から引く（numpy.random.Generator、BATCH 日分ずつまとめて）
+2. 勝った組み合わせの的中票数 = Poisson(発売票数 × 世間の支持 q の積 × 揺らぎ)。揺らぎは対数正規
+   （POPULARITY_SIGMA。WIN5 の売れ方は単勝の支持の積からずれる）。払戻は票数に反比例するので、
+   揺らぎは逆数の平均が 1 になるように取る（p == q で全組み合わせを買うと回収率は RETURN_RATE）
+3. 払戻 = (発売額 × 払戻率 + キャリーオーバー) ÷ (的中票数 + 自分の 1 票)、10 円未満切り捨て・上限 MAX_PAYOUT
+
+サンプルと買い目の両方を NumPy の配列でまとめて計算し、的中したサンプルの払戻だけを残す（メモリは BATCH 分）。
+
+    python win5_sim.py 5,8,9,14 3,4,9 2,7,10,15 11 3,7 --book=output/Win5出馬表_20250504_093000.xlsx
+    python win5_sim.py --book=… --budget=20000 --top=3 --method=power --n=5000000 --seed=1 --bankroll=200000
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from dataclasses import dataclass
+from win5 import LEGS, MAX_HORSES, UNIT_STAKE, book_frames, counts, selections, to_mask, formation, _parse_spec
+from win5_ev import DEFAULT_SALES, MAX_PAYOUT, RETURN_RATE, implied_probs, odds_matrix, pool, with_legs
+
+# ===================== 定数 =====================
+SAMPLES = 1_000_000          # 引く日数（既定）
+BATCH = 1 << 20              # 1 回にまとめて引く日数
+POPULARITY_SIGMA = 0.5       # 的中票数の揺らぎ（対数正規の σ）
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+SEED = 0
+RUIN_DAYS = 52               # 破産確率を見る日数（毎週買って 1 年）
+RUIN_PATHS = 100_000
+CHECK_FIELD = 10             # check_market() の頭数（10^5 組。既定の発売票数なら 1 組あたり約 50 票）
+CHECK_TOLERANCE = 0.02       # check_market() で RETURN_RATE からのずれを許す幅
+
+# ===================== 1 日分を引く =====================
+def _cdf(p: np.ndarray) -> np.ndarray:
+    cdf = np.cumsum(np.asarray(p, dtype=float), axis=-1)
+    if not (cdf[:, -1] > 0).all():
+        raise ValueError("確率が 0 のレースがあります（オッズが入っていない？）")
+    return cdf / cdf[:, -1:]
+
+def sample_winners(rng: np.random.Generator, cdf: np.ndarray, n: int) -> np.ndarray:
+    """各レースの勝ち馬を n 日分引く → (n, 5) の位置（馬番 - 1）"""
+    u = rng.random((LEGS, n))
+    return np.stack([np.minimum(np.searchsorted(cdf[l], u[l], side="right"), MAX_HORSES - 1)
+                     for l in range(LEGS)], axis=1)
+
+def sample_payouts(rng: np.random.Generator, winners: np.ndarray, q: np.ndarray, sales: int,
+                   carryover: int = 0, sigma: float = POPULARITY_SIGMA) -> np.ndarray:
+    """勝った組み合わせ (n, 5) → 1 票あたりの払戻（円）。的中票数は世間の支持の積から引く"""
+    share = np.prod(q[np.arange(LEGS), winners], axis=1)
+    if sigma > 0:
+        # E[1/揺らぎ] = 1（平均 1 にすると払戻の期待値が e^{σ²} 倍に膨らむ）
+        share = share * rng.lognormal(sigma * sigma / 2, sigma, len(share))
+    tickets = rng.poisson(sales * share)
+    return np.minimum(np.floor(pool(sales, carryover) / (tickets + 1) / 10) * 10, MAX_PAYOUT)
+
+def _hits(masks: np.ndarray, winners: np.ndarray) -> np.ndarray:
+    """(F, 5, MAX_HORSES) × (n, 5) → (F, n) の的中"""
+    hit = masks[:, 0, winners[:, 0]]
+    for l in range(1, LEGS):
+        hit &= masks[:, l, winners[:, l]]
+    return hit
+
+# ===================== シミュレーション =====================
+@dataclass
+class Outcomes:
+    """simulate() の結果。payouts[f] は買い目 f が的中した日の払戻だけ（外れの日は 0 円）"""
+    n: int
+    stakes: np.ndarray
+    payouts: list[np.ndarray]
+
+    def hit_rate(self) -> np.ndarray:
+        return np.array([len(x) for x in self.payouts]) / self.n
+
+    def mean_payout(self) -> np.ndarray:
+        return np.array([x.sum() for x in self.payouts]) / self.n
+
+    def profit_percentiles(self, pcts=PERCENTILES) -> np.ndarray:
+        """1 日の収支（払戻 − 購入額）の分位点 (F, len(pcts))。外れの n − 的中 日は払戻 0 として並べる"""
+        out = np.empty((len(self.payouts), len(pcts)))
+        rank = np.floor(np.asarray(pcts) / 100 * (self.n - 1)).astype(np.int64)
+        for f, x in enumerate(self.payouts):
+            x = np.sort(np.concatenate([x, [0.0]]))  # 的中が 0 件でも引けるように
+            misses = self.n - (len(x) - 1)
+            out[f] = np.where(rank < misses, 0.0, x[np.clip(rank - misses + 1, 0, len(x) - 1)]) - self.stakes[f]
+        return out
+
+    def summary(self, pcts=PERCENTILES) -> pd.DataFrame:
+        mean = self.mean_payout()
+        res = pd.DataFrame({
+            "購入額": self.stakes, "的中率": self.hit_rate(), "平均払戻": mean,
+            "回収率": np.divide(mean, self.stakes, out=np.zeros_like(mean), where=self.stakes > 0),
+            "的中時の払戻中央値": [float(np.median(x)) if len(x) else np.nan for x in self.payouts],
+        })
+        for k, col in zip(pcts, self.profit_percentiles(pcts).T):
+            res[f"収支p{k}"] = col
+        return res
+
+def simulate(masks: np.ndarray, p: np.ndarray, q: np.ndarray | None = None, n: int = SAMPLES,
+             sales: int = DEFAULT_SALES, carryover: int = 0, seed: int | None = SEED,
+             batch: int = BATCH, sigma: float = POPULARITY_SIGMA) -> Outcomes:
+    """
+    買い目 (F, 5, MAX_HORSES) をまとめて n 日分シミュレーションする。p は勝つ確率、q は世間の支持（省くと p）。
+    同じ seed・batch なら同じ結果になる
+    """
+    masks = np.asarray(masks, dtype=bool).reshape(-1, LEGS, MAX_HORSES)
+    q = p if q is None else q
+    rng, cdf = np.random.default_rng(seed), _cdf(p)
+    batch = max(1, min(batch, (BATCH * 8) // len(masks)))  # (F, batch) の的中表を BATCH × 8 バイト程度に
+    found: list[list[np.ndarray]] = [[] for _ in masks]
+    for lo in range(0, n, batch):
+        winners = sample_winners(rng, cdf, min(batch, n - lo))
+        hit = _hits(masks, winners)
+        day = hit.any(axis=0)
+        pay = np.zeros(len(winners))
+        pay[day] = sample_payouts(rng, winners[day], q, sales, carryover, sigma)
+        for f in range(len(masks)):
+            found[f].append(pay[hit[f]])
+    return Outcomes(n, counts(masks) * UNIT_STAKE, [np.concatenate(x) for x in found])
+
+def risk_of_ruin(mask: np.ndarray, p: np.ndarray, bankroll: int, q: np.ndarray | None = None,
+                 days: int = RUIN_DAYS, paths: int = RUIN_PATHS, sales: int = DEFAULT_SALES,
+                 carryover: int = 0, seed: int | None = SEED, sigma: float = POPULARITY_SIGMA) -> tuple[float, np.ndarray]:
+    """
+    同じ買い目を days 日続けて買う時、途中で資金が購入額を割る（次を買えなくなる）確率と、
+    最後の資金の分位点（PERCENTILES）。paths 通りの日々の並びを BATCH 日分ずつまとめて引く
+    """
+    mask = np.asarray(mask, dtype=bool).reshape(1, LEGS, MAX_HORSES)
+    q = p if q is None else q
+    rng, cdf = np.random.default_rng(seed), _cdf(p)
+    cost = float(counts(mask)[0] * UNIT_STAKE)
+    step = max(1, BATCH // days)
+    ruined, final = 0, []
+    for lo in range(0, paths, step):
+        m = min(step, paths - lo)
+        winners = sample_winners(rng, cdf, m * days)
+        hit = _hits(mask, winners)[0]
+        pay = np.zeros(m * days)
+        pay[hit] = sample_payouts(rng, winners[hit], q, sales, carryover, sigma)
+        bank = bankroll + np.cumsum((pay - cost).reshape(m, days), axis=1)
+        before = np.concatenate([np.full((m, 1), float(bankroll)), bank[:, :-1]], axis=1)  # その日を買う前の資金
+        short = before < cost
+        broke = short.any(axis=1)
+        ruined += int(broke.sum())
+        stop = before[np.arange(m), short.argmax(axis=1)]  # 買えなくなった日の資金（そこで止める）
+        final.append(np.where(broke, stop, bank[:, -1]))
+    return ruined / paths, np.percentile(np.concatenate(final), PERCENTILES)
+
+def check_market(field: int = CHECK_FIELD, n: int = SAMPLES, sales: int = DEFAULT_SALES,
+                 seed: int | None = SEED, sigma: float = POPULARITY_SIGMA) -> float:
+    """
+    全頭が同じ確率（p == q）の 5 レースで全組み合わせを買った時の回収率。払戻は的中票数から配るので
+    RETURN_RATE に戻るはず（1 組あたりの票数が十分多い時。少ないと自分の 1 票の分だけ下がる）。
+    外れたら [WARN] を出して回収率を返す
+    """
+    p = np.zeros((LEGS, MAX_HORSES))
+    p[:, :field] = 1 / field
+    out = simulate((p > 0)[None], p, p, n=n, sales=sales, seed=seed, sigma=sigma)
+    rate = float(out.mean_payout()[0] / out.stakes[0])
+    if abs(rate - RETURN_RATE) > CHECK_TOLERANCE:
+        print(f"[WARN] 全組み合わせの回収率 {rate:.3f} が払戻率 {RETURN_RATE:.2f} から外れています（σ={sigma}）")
+    return rate
+
+# ===================== メイン =====================
+def main():
+    opts = dict(a[2:].split("=", 1) if "=" in a else (a[2:], "") for a in sys.argv[1:] if a.startswith("--"))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if "check" in opts:
+        sigma = float(opts["sigma"]) if opts.get("sigma") else POPULARITY_SIGMA
+        print(f"全組み合わせの回収率: {check_market(sigma=sigma):.4f}（払戻率 {RETURN_RATE:.2f}、σ={sigma}）")
+        return
+    if not opts.get("book") or not (len(args) == LEGS or opts.get("budget")):
+        print("使い方: python win5_sim.py <WIN1> … <WIN5> --book=出力ブック.xlsx | --book=… --budget=円 [--top=3]\n"
+              "        [--method=normalize|power] [--n=日数] [--seed=0] [--sales=発売票数] [--carry=円] "
+              "[--bankroll=円 --days=52]\n"
+              "        python win5_sim.py --check [--sigma=0.5]   # 全組み合わせを買って回収率が払戻率に戻るか")
+        sys.exit(2)
+    frames = book_frames(opts["book"])
+    odds = odds_matrix(frames)
+    p = implied_probs(odds, opts.get("method") or "normalize")
+    q = implied_probs(odds)
+    sales, carry = int(opts.get("sales") or DEFAULT_SALES), int(opts.get("carry") or 0)
+    if len(args) == LEGS:
+        picks = [_parse_spec(a, None, frames[i]) for i, a in enumerate(args)]
+        masks = to_mask(selections(frames, picks))[None]
+    else:
+        from win5_opt import optimize
+        res, _ = optimize(p, int(opts["budget"]), q, top=int(opts.get("top") or 3), sales=sales, carryover=carry)
+        masks = np.stack([to_mask(formation([[int(x) for x in res.at[i, f"WIN{l + 1}"].split(",")]
+                                              for l in range(LEGS)])) for i in range(len(res))])
+
+    n = int(opts.get("n") or SAMPLES)
+    seed = int(opts["seed"]) if opts.get("seed") else SEED
+    t0 = time.perf_counter()
+    out = simulate(masks, p, q, n=n, sales=sales, carryover=carry, seed=seed)
+    sec = time.perf_counter() - t0
+    print(f"{n:,} 日 × {len(masks)} 通り（{sec:.2f} 秒、{n / sec / 1e6:.1f} 百万日/秒）  発売 {sales:,} 票 / キャリーオーバー {carry:,} 円")
+    with pd.option_context("display.width", 250, "display.max_columns", None):
+        fmt = {c: "{:,.0f}".format for c in ["平均払戻", "的中時の払戻中央値", *[f"収支p{k}" for k in PERCENTILES]]}
+        print(with_legs(out.summary(), masks).to_string(formatters={**fmt, "的中率": "{:.4%}".format, "回収率": "{:.3f}".format}))
+
+    if opts.get("bankroll"):
+        days = int(opts.get("days") or RUIN_DAYS)
+        for i, m in enumerate(masks):
+            ruin, final = risk_of_ruin(m, p, int(opts["bankroll"]), q, days=days, sales=sales, carryover=carry, seed=seed)
+            print(f"[{i}] 資金 {int(opts['bankroll']):,} 円で {days} 日: 破産確率 {ruin:.2%}  最終資金 "
+                  + " / ".join(f"p{k} {v:,.0f}" for k, v in zip(PERCENTILES, final)))
+
+if __name__ == "__main__":
+    main()
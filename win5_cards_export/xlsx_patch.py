@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+openpyxl を通さずに xlsx（zip）内のシート XML だけを書き換える高速ライター。
+
+テンプレートの zip をエントリごとにコピーし、対象シートの XML のうち
+値を入れる <row> だけを組み立て直す。それ以外（数式・スタイル・結合・条件付き書式・
+sharedStrings・calcChain）はバイト単位でそのまま。文字列は inlineStr で書くので
+sharedStrings.xml も触らない。workbook.xml の calcPr に fullCalcOnLoad="1" を立て、
+開いた時に Excel が再計算するようにする。
+数式セルには fill_cached_values() で計算済みの値（<v>）も入れられる。
+シート名の変更（renames）は workbook.xml / docProps/app.xml の該当箇所だけを書き換える。
+"""
+import re
+import math
+import numbers
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+import pandas as pd
+
+from collections import defaultdict
+from pathlib import Path
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.formula.translate import Translator
+
+# ===================== 定数 =====================
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL  = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG  = "http://schemas.openxmlformats.org/package/2006/relationships"
+NS_CT   = "http://schemas.openxmlformats.org/package/2006/content-types"
+NS_CUSTOM = "http://schemas.openxmlformats.org/officeDocument/2006/custom-properties"
+NS_VT   = "http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes"
+CUSTOM_PART = "docProps/custom.xml"
+CUSTOM_REL  = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/custom-properties"
+CUSTOM_CT   = "application/vnd.openxmlformats-officedocument.custom-properties+xml"
+CUSTOM_FMTID = "{D5CDD505-2E9C-101B-9397-08002B2CF9AE}"
+
+ROW_RE   = re.compile(rb'<row\b[^>]*?\br="(\d+)"[^>]*?(?:/>|>.*?</row>)', re.S)
+CELL_RE  = re.compile(rb'<c\b[^>]*?\br="([A-Z]+)(\d+)"[^>]*?(?:/>|>.*?</c>)', re.S)
+STYLE_RE = re.compile(rb'\bs="(\d+)"')
+CALCPR_RE = re.compile(rb'<calcPr\b[^>]*?/?>')
+F_RE     = re.compile(rb'<f\b[^>]*?(?:/>|>.*?</f>)', re.S)
+T_ATTR_RE = re.compile(rb'\s+t="[^"]*"')
+SHEET_TAG_RE = re.compile(rb'<sheet\b[^>]*?/>')
+NAME_ATTR_RE = re.compile(rb'\bname="([^"]*)"')
+DEFINED_NAME_RE = re.compile(rb'(<definedName\b[^>]*>)(.*?)(</definedName>)', re.S)
+SHEET_REF_RE = re.compile(r"'((?:[^']|'')+)'!|(?<![\w.'])([^\W\d][\w.]*)!")
+TITLES_RE = re.compile(rb'<TitlesOfParts>.*?</TitlesOfParts>', re.S)
+LPSTR_RE  = re.compile(rb'<vt:lpstr>(.*?)</vt:lpstr>', re.S)
+# XML 1.0 で使えない制御文字
+ILLEGAL_XML_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# ===================== シートの場所 =====================
+def sheet_part(zf: zipfile.ZipFile, sheet_name: str) -> str:
+    """シート名から zip 内のシート XML のパス（例: xl/worksheets/sheet2.xml）を返す"""
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    rid = None
+    for sh in wb.iter(f"{{{NS_MAIN}}}sheet"):
+        if sh.get("name") == sheet_name:
+            rid = sh.get(f"{{{NS_REL}}}id")
+            break
+    if rid is None:
+        raise KeyError(f"シートが見つかりません: {sheet_name}")
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{{{NS_PKG}}}Relationship"):
+        if rel.get("Id") == rid:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target.lstrip("/")
+            return posixpath.normpath(posixpath.join("xl", target))
+    raise KeyError(f"シートのリレーションが見つかりません: {sheet_name} ({rid})")
+
+def sheet_names(zf: zipfile.ZipFile) -> list[str]:
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    return [sh.get("name") for sh in wb.iter(f"{{{NS_MAIN}}}sheet")]
+
+class CellError(str):
+    """数式の計算結果がエラー値（#DIV/0! など）であることを表す"""
+
+# ===================== セル XML =====================
+def _xml_escape(s: str) -> str:
+    s = ILLEGAL_XML_RE.sub("", s)
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _xml_unescape(s: str) -> str:
+    return (s.replace("&lt;", "<").replace("&gt;", ">").replace("&quot;", '"')
+             .replace("&apos;", "'").replace("&amp;", "&"))
+
+def cell_xml(ref: str, style: bytes | None, value) -> bytes:
+    """値 1 つ分の <c> 要素（style は既存セルの s 属性をそのまま引き継ぐ）"""
+    s_attr = b' s="' + style + b'"' if style else b""
+    head = b'<c r="' + ref.encode("ascii") + b'"' + s_attr
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return head + b"/>"  # None / NaN / pd.NA（Int64・Float64 列の欠損）/ NaT は空セル
+    if isinstance(value, bool):
+        return head + b' t="b"><v>' + (b"1" if value else b"0") + b"</v></c>"
+    if isinstance(value, numbers.Integral):
+        return head + b"><v>" + str(int(value)).encode("ascii") + b"</v></c>"
+    if isinstance(value, numbers.Real):
+        v = float(value)
+        if not math.isfinite(v):
+            return head + b"/>"
+        return head + b"><v>" + repr(v).encode("ascii") + b"</v></c>"
+    text = _xml_escape(str(value)).encode("utf-8")
+    return head + b' t="inlineStr"><is><t xml:space="preserve">' + text + b"</t></is></c>"
+
+def _patch_row(row_xml: bytes, r: int, cols: dict[int, object]) -> bytes:
+    """1 行分の <row> を書き換える。既存セルは s 属性だけ残して差し替え、無いセルは列順に挿入"""
+    if row_xml.endswith(b"/>"):
+        open_tag, body, close_tag = row_xml[:-2] + b">", b"", b"</row>"
+    else:
+        gt = row_xml.index(b">") + 1
+        open_tag, body, close_tag = row_xml[:gt], row_xml[gt:-len(b"</row>")], b"</row>"
+
+    pending = sorted(cols)
+    out, pos = [], 0
+    for m in CELL_RE.finditer(body):
+        col = column_index_from_string(m.group(1).decode("ascii"))
+        while pending and pending[0] < col:
+            c = pending.pop(0)
+            out.append(body[pos:m.start()])
+            pos = m.start()
+            out.append(cell_xml(f"{get_column_letter(c)}{r}", None, cols[c]))
+        out.append(body[pos:m.start()])
+        pos = m.end()
+        if pending and pending[0] == col:
+            pending.pop(0)
+            sm = STYLE_RE.search(m.group(0), 0, m.group(0).index(b">"))
+            out.append(cell_xml(f"{m.group(1).decode('ascii')}{r}", sm.group(1) if sm else None, cols[col]))
+        else:
+            out.append(m.group(0))
+    out.append(body[pos:])
+    for c in pending:
+        out.append(cell_xml(f"{get_column_letter(c)}{r}", None, cols[c]))
+    return open_tag + b"".join(out) + close_tag
+
+def patch_sheet_xml(xml: bytes, cells: dict[tuple[int, int], object]) -> bytes:
+    """シート XML に (行, 列) → 値 を反映する。触らない行は元のバイト列をそのまま使う"""
+    by_row: dict[int, dict[int, object]] = defaultdict(dict)
+    for (r, c), v in cells.items():
+        by_row[r][c] = v
+    if not by_row:
+        return xml
+
+    empty = re.search(rb"<sheetData\s*/>", xml)
+    if empty:
+        rows = b"".join(_patch_row(f'<row r="{r}"/>'.encode("ascii"), r, by_row[r]) for r in sorted(by_row))
+        return xml[:empty.start()] + b"<sheetData>" + rows + b"</sheetData>" + xml[empty.end():]
+
+    start = xml.index(b">", xml.index(b"<sheetData")) + 1
+    end = xml.index(b"</sheetData>", start)
+    pending = sorted(by_row)
+    out, pos = [xml[:start]], start
+    for m in ROW_RE.finditer(xml, start, end):
+        r = int(m.group(1))
+        while pending and pending[0] < r:
+            p = pending.pop(0)
+            out.append(xml[pos:m.start()])
+            pos = m.start()
+            out.append(_patch_row(f'<row r="{p}"/>'.encode("ascii"), p, by_row[p]))
+        out.append(xml[pos:m.start()])
+        pos = m.end()
+        if pending and pending[0] == r:
+            pending.pop(0)
+            out.append(_patch_row(m.group(0), r, by_row[r]))
+        else:
+            out.append(m.group(0))
+    out.append(xml[pos:end])
+    for p in pending:
+        out.append(_patch_row(f'<row r="{p}"/>'.encode("ascii"), p, by_row[p]))
+    out.append(xml[end:])
+    return b"".join(out)
+
+# ===================== 数式のキャッシュ値 =====================
+def _cached_cell(cell: bytes, value) -> bytes:
+    """数式セル 1 つの <f> をそのまま残し、t 属性と <v> を計算結果で置き換える"""
+    f = F_RE.search(cell)
+    if f is None:
+        return cell
+    gt = cell.index(b">")
+    head = T_ATTR_RE.sub(b"", cell[:gt].rstrip(b"/"))
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return cell
+    if isinstance(value, CellError):
+        t, v = b' t="e"', _xml_escape(str(value)).encode("utf-8")
+    elif isinstance(value, bool):
+        t, v = b' t="b"', b"1" if value else b"0"
+    elif isinstance(value, numbers.Real):
+        x = float(value)
+        if not math.isfinite(x):
+            return cell
+        t, v = b"", (str(int(x)) if x.is_integer() and abs(x) < 1e15 else repr(x)).encode("ascii")
+    else:
+        t, v = b' t="str"', _xml_escape(str(value)).encode("utf-8")
+    return head + t + b">" + f.group(0) + b"<v>" + v + b"</v></c>"
+
+def _uncached_cell(cell: bytes) -> bytes:
+    """数式セル 1 つの <f> だけを残し、t 属性と <v>（テンプレートの古いキャッシュ値）を消す"""
+    f = F_RE.search(cell)
+    if f is None:
+        return cell
+    head = T_ATTR_RE.sub(b"", cell[:cell.index(b">")].rstrip(b"/"))
+    return head + b">" + f.group(0) + b"</c>"
+
+def fill_cached_values(xml: bytes, values: dict[tuple[int, int], object], clear: bool = False) -> bytes:
+    """
+    シート XML の数式セルに計算済みの値（キャッシュ値）を入れる。数式でないセルは触らない。
+    clear=True なら値の無い（計算しなかった NOW() など・結果が空の）数式セルの <v> を消す（openpyxl で保存した時と同じ）
+    """
+    by_row: dict[int, dict[int, object]] = defaultdict(dict)
+    for (r, c), v in values.items():
+        by_row[r][c] = v
+    if not by_row and not clear:
+        return xml
+
+    def row_sub(m: re.Match) -> bytes:
+        cols = by_row.get(int(m.group(1)))
+        if not cols and not clear:
+            return m.group(0)
+        cols = cols or {}
+        def cell_sub(cm: re.Match) -> bytes:
+            col = column_index_from_string(cm.group(1).decode("ascii"))
+            v = cols.get(col)
+            if clear and (v is None or (pd.api.types.is_scalar(v) and pd.isna(v))):
+                return _uncached_cell(cm.group(0))
+            if col not in cols:
+                return cm.group(0)
+            return _cached_cell(cm.group(0), v)
+        return CELL_RE.sub(cell_sub, m.group(0))
+
+    start = xml.find(b"<sheetData")
+    if start < 0:
+        return xml
+    return xml[:start] + ROW_RE.sub(row_sub, xml[start:])
+
+# ===================== 値の読み出し =====================
+def _shared_strings(zf: zipfile.ZipFile) -> list[str]:
+    try:
+        root = ET.fromstring(zf.read("xl/sharedStrings.xml"))
+    except KeyError:
+        return []
+    return ["".join(t.text or "" for t in si.iter(f"{{{NS_MAIN}}}t")) for si in root.iter(f"{{{NS_MAIN}}}si")]
+
+def read_sheet_values(path, sheet_name: str) -> dict[tuple[int, int], object]:
+    """
+    シートの値セルを {(行, 列): 値} で返す（数式セルは含めない）。
+    load_workbook より桁違いに軽く、出力ブックの差分更新で現在値を読むのに使う。
+    """
+    with zipfile.ZipFile(path) as zf:
+        xml = zf.read(sheet_part(zf, sheet_name))
+        shared = None
+        out = {}
+        for c in ET.fromstring(xml).iter(f"{{{NS_MAIN}}}c"):
+            if c.find(f"{{{NS_MAIN}}}f") is not None:
+                continue
+            m = re.fullmatch(r"([A-Z]+)(\d+)", c.get("r", ""))
+            if not m:
+                continue
+            rc = (int(m.group(2)), column_index_from_string(m.group(1)))
+            t = c.get("t", "n")
+            if t == "inlineStr":
+                out[rc] = "".join(x.text or "" for x in c.iter(f"{{{NS_MAIN}}}t"))
+                continue
+            v = c.find(f"{{{NS_MAIN}}}v")
+            if v is None or v.text is None:
+                continue
+            if t == "s":
+                if shared is None:
+                    shared = _shared_strings(zf)
+                out[rc] = shared[int(v.text)]
+            elif t == "b":
+                out[rc] = v.text == "1"
+            elif t in ("str", "e"):
+                out[rc] = v.text
+            else:
+                x = float(v.text)
+                out[rc] = int(x) if x.is_integer() and re.fullmatch(r"-?\d+", v.text) else x
+    return out
+
+def read_sheet_formulas(path, sheet_name: str) -> dict[tuple[int, int], str]:
+    """
+    シートの数式セルを {(行, 列): 式} で返す。共有数式は openpyxl の読み込みと同じくセルごとの式に展開し、
+    <f> の属性（t・ref・si・ca）は見ない（openpyxl で保存すると共有数式は展開され ca は落ちるため）
+    """
+    with zipfile.ZipFile(path) as zf:
+        xml = zf.read(sheet_part(zf, sheet_name))
+    out, shared = {}, {}
+    for c in ET.fromstring(xml).iter(f"{{{NS_MAIN}}}c"):
+        f = c.find(f"{{{NS_MAIN}}}f")
+        m = re.fullmatch(r"([A-Z]+)(\d+)", c.get("r", ""))
+        if f is None or not m:
+            continue
+        text = f.text or ""
+        if f.get("t") == "shared":
+            si = f.get("si")
+            if text:
+                shared[si] = Translator("=" + text, origin=m.group(0))
+            elif si in shared:
+                text = shared[si].translate_formula(m.group(0))[1:]
+        out[(int(m.group(2)), column_index_from_string(m.group(1)))] = text
+    return out
+
+# ===================== ユーザー定義プロパティ =====================
+def read_custom_props(path) -> dict[str, str]:
+    """docProps/custom.xml のユーザー定義プロパティ（文字列）を返す。無ければ空"""
+    with zipfile.ZipFile(path) as zf:
+        return _custom_props(zf)
+
+def _custom_props(zf: zipfile.ZipFile) -> dict[str, str]:
+    try:
+        root = ET.fromstring(zf.read(CUSTOM_PART))
+    except KeyError:
+        return {}
+    return {p.get("name"): "".join(p.itertext()) for p in root.iter(f"{{{NS_CUSTOM}}}property")}
+
+def _custom_props_xml(props: dict[str, str]) -> bytes:
+    items = "".join(
+        f'<property fmtid="{CUSTOM_FMTID}" pid="{pid}" name="{_xml_escape(k)}">'
+        f"<vt:lpwstr>{_xml_escape(str(v))}</vt:lpwstr></property>"
+        for pid, (k, v) in enumerate(props.items(), start=2)
+    )
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Properties xmlns="{NS_CUSTOM}" xmlns:vt="{NS_VT}">{items}</Properties>').encode("utf-8")
+
+def _props_parts(zin: zipfile.ZipFile, props: dict[str, str]) -> dict[str, bytes]:
+    """custom.xml と、それを参照する [Content_Types].xml / _rels/.rels の差し替え分"""
+    parts = {CUSTOM_PART: _custom_props_xml({**_custom_props(zin), **props})}
+    ct = zin.read("[Content_Types].xml")
+    if b"/" + CUSTOM_PART.encode("ascii") not in ct:
+        i = ct.rindex(b"</Types>")
+        parts["[Content_Types].xml"] = (ct[:i] + f'<Override PartName="/{CUSTOM_PART}" ContentType="{CUSTOM_CT}"/>'.encode("ascii")
+                                        + ct[i:])
+    rels = zin.read("_rels/.rels")
+    if CUSTOM_REL.encode("ascii") not in rels:
+        ids = {int(x) for x in re.findall(rb'Id="rId(\d+)"', rels)}
+        rid = f"rId{max(ids, default=0) + 1}"
+        i = rels.rindex(b"</Relationships>")
+        parts["_rels/.rels"] = (rels[:i] + f'<Relationship Id="{rid}" Type="{CUSTOM_REL}" Target="{CUSTOM_PART}"/>'.encode("ascii")
+                                + rels[i:])
+    return parts
+
+# ===================== workbook.xml =====================
+def mark_full_calc(workbook_xml: bytes) -> bytes:
+    """calcPr に fullCalcOnLoad="1" を立てる（calcChain はそのまま、開いた時に全再計算）"""
+    m = CALCPR_RE.search(workbook_xml)
+    if m:
+        tag = m.group(0)
+        if b"fullCalcOnLoad=" in tag:
+            new = re.sub(rb'fullCalcOnLoad="[^"]*"', b'fullCalcOnLoad="1"', tag)
+        else:
+            i = len(b"<calcPr")
+            new = tag[:i] + b' fullCalcOnLoad="1"' + tag[i:]
+        return workbook_xml[:m.start()] + new + workbook_xml[m.end():]
+    # calcPr が無ければ definedNames / sheets の直後に入れる（スキーマ上の順序を守る）
+    for anchor in (b"</definedNames>", b"</externalReferences>", b"</sheets>"):
+        i = workbook_xml.find(anchor)
+        if i >= 0:
+            i += len(anchor)
+            return workbook_xml[:i] + b'<calcPr fullCalcOnLoad="1"/>' + workbook_xml[i:]
+    return workbook_xml
+
+# ===================== シート名の変更 =====================
+def _quote_sheet(name: str) -> str:
+    return "'" + name.replace("'", "''") + "'"
+
+def rename_sheets_xml(workbook_xml: bytes, renames: dict[str, str]) -> bytes:
+    """workbook.xml の <sheet name> と、定義名（フィルター範囲など）の 'シート名'! 参照を付け替える"""
+    def sheet_sub(m: re.Match) -> bytes:
+        tag = m.group(0)
+        nm = NAME_ATTR_RE.search(tag)
+        old = _xml_unescape(nm.group(1).decode("utf-8")) if nm else None
+        if old not in renames:
+            return tag
+        new = _xml_escape(renames[old]).replace('"', "&quot;").encode("utf-8")
+        return tag[:nm.start(1)] + new + tag[nm.end(1):]
+
+    def ref_sub(m: re.Match) -> str:
+        old = m.group(1).replace("''", "'") if m.group(1) is not None else m.group(2)
+        return _quote_sheet(renames[old]) + "!" if old in renames else m.group(0)
+
+    def name_sub(m: re.Match) -> bytes:
+        text = SHEET_REF_RE.sub(ref_sub, _xml_unescape(m.group(2).decode("utf-8")))
+        return m.group(1) + _xml_escape(text).encode("utf-8") + m.group(3)
+
+    return DEFINED_NAME_RE.sub(name_sub, SHEET_TAG_RE.sub(sheet_sub, workbook_xml))
+
+def rename_app_titles(app_xml: bytes, renames: dict[str, str]) -> bytes:
+    """docProps/app.xml の TitlesOfParts（シート名の一覧）を付け替える"""
+    def lpstr_sub(m: re.Match) -> bytes:
+        old = _xml_unescape(m.group(1).decode("utf-8"))
+        if old not in renames:
+            return m.group(0)
+        return b"<vt:lpstr>" + _xml_escape(renames[old]).encode("utf-8") + b"</vt:lpstr>"
+    return TITLES_RE.sub(lambda m: LPSTR_RE.sub(lpstr_sub, m.group(0)), app_xml)
+
+# ===================== 書き出し =====================
+def patch_workbook(src, dst, sheets: dict[str, dict[tuple[int, int], object]],
+                   full_calc: bool = True, extra: dict[str, bytes] | None = None,
+                   cached: dict[str, dict[tuple[int, int], object]] | None = None,
+                   props: dict[str, str] | None = None, renames: dict[str, str] | None = None,
+                   clear_cached: bool = False):
+    """
+    src（テンプレート）を dst にコピーしながら、sheets = {シート名: {(行, 列): 値}} を反映する。
+    cached = {シート名: {(行, 列): 計算結果}} で数式セルにキャッシュ値を入れる。
+    clear_cached=True なら cached のシートで計算結果の無い数式セルのキャッシュ値を消す。
+    props = {名前: 文字列} はユーザー定義プロパティ（docProps/custom.xml）に追記する。
+    renames = {旧シート名: 新シート名} でシート名を変える（sheets / cached は旧名で指定）。
+    extra = {zip 内パス: バイト列} で任意のエントリを差し替えられる。
+    src と dst は同じファイルでもよい（一時ファイル経由で置き換える）。
+    """
+    src, dst = Path(src), Path(dst)
+    extra = dict(extra or {})
+    with zipfile.ZipFile(src) as zin:
+        parts = {sheet_part(zin, name): cells for name, cells in sheets.items()}
+        cached_parts = {sheet_part(zin, name): vals for name, vals in (cached or {}).items()}
+        if props:
+            extra = {**_props_parts(zin, props), **extra}
+        tmp = dst.with_name(dst.name + ".tmp")
+        with zipfile.ZipFile(tmp, "w") as zout:
+            for info in zin.infolist():
+                if info.filename in extra:
+                    data = extra.pop(info.filename)
+                else:
+                    data = zin.read(info)
+                    if info.filename in parts:
+                        data = patch_sheet_xml(data, parts[info.filename])
+                    if info.filename in cached_parts:
+                        data = fill_cached_values(data, cached_parts[info.filename], clear=clear_cached)
+                    if info.filename == "xl/workbook.xml":
+                        if renames:
+                            data = rename_sheets_xml(data, renames)
+                        if full_calc:
+                            data = mark_full_calc(data)
+                    elif renames and info.filename == "docProps/app.xml":
+                        data = rename_app_titles(data, renames)
+                zout.writestr(info, data)
+            for name, data in extra.items():
+                zout.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+    tmp.replace(dst)
+
+def write_cells(template, out_path, sheet_name: str, cells: dict[tuple[int, int], object],
+                full_calc: bool = True, cached: dict[tuple[int, int], object] | None = None,
+                props: dict[str, str] | None = None, clear_cached: bool = False):
+    """1 シート分のセルを書き込んだコピーを作る（patch_workbook の簡易版）"""
+    patch_workbook(template, out_path, {sheet_name: cells}, full_calc=full_calc,
+                   cached={sheet_name: cached or {}} if cached or clear_cached else None, props=props,
+                   clear_cached=clear_cached)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+テンプレート xlsx の共通処理。
+
+- template_hash()      : テンプレートの内容ハッシュ
+- load_template()      : 読み込み済みテンプレートのスナップショットから独立したコピーを返す
+- discover_odds_layout(): ヘッダー行・区画見出しからオッズシートのレイアウトを自動検出
+- compile_write_plan() : 書き込み可能セル（結合セル・計算式を除く）の一覧をコンパイル
+- get_write_plan()     : テンプレートのハッシュ単位でキャッシュした write plan を返す
+- section_cells()      : write plan に従った 1 区画分の {(行, 列): 値}（xlsx_patch 用）
+- apply_section()      : write plan に従って 1 区画をクリア＆書き込み
+"""
+import re
+import json
+import pickle
+import hashlib
+import openpyxl
+import unicodedata
+import pandas as pd
+
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from openpyxl import load_workbook
+from openpyxl.cell.cell import MergedCell
+
+# ===================== 定数 =====================
+CACHE_DIR = Path(__file__).resolve().with_name(".cache")
+PLAN_VERSION = 1
+LAYOUT_VERSION = 1
+
+# ヘッダー見出し → DataFrame の列名（ここに無い見出し＝差・人気順などの数式列は書き込まない）
+HEADER_FIELDS = {"馬番": "馬番", "オッズ": "オッズ", "馬名等": "馬名", "馬名": "馬名",
+                 "性齢": "性齢", "斤量": "斤量", "騎手名": "騎手名", "騎手": "騎手名"}
+# 区画見出し（WIN１〜WIN5）とヘッダー行の間にある結合行に、上から順に書くもの
+META_KEYS = ("time", "name", "course")
+SECTION_MARK_RE = re.compile(r"^WIN\s*([1-9])$")
+ABS_RANGE_RE = re.compile(r"\$?[A-Z]{1,3}\$(\d+)\s*:\s*\$?[A-Z]{1,3}\$(\d+)")
+
+_HASHES: dict[tuple, str] = {}
+_PLANS: dict[str, "WritePlan"] = {}
+_LAYOUTS: dict[str, "OddsLayout"] = {}
+_SNAPSHOTS: dict[str, bytes] = {}
+
+# ===================== テンプレートハッシュ =====================
+def template_hash(path) -> str:
+    """テンプレートの内容ハッシュ（同一プロセス内では mtime・サイズが同じなら再計算しない）"""
+    p = Path(path).resolve()
+    st = p.stat()
+    key = (str(p), st.st_mtime_ns, st.st_size)
+    h = _HASHES.get(key)
+    if h is None:
+        h = hashlib.sha256(p.read_bytes()).hexdigest()[:16]
+        _HASHES[key] = h
+    return h
+
+# ===================== テンプレートキャッシュ =====================
+def _snapshot(template_path) -> bytes:
+    """テンプレートの pickle スナップショット（メモリ → .cache/ → load_workbook の順）"""
+    key = f"{template_hash(template_path)}_{openpyxl.__version__}"
+    snap = _SNAPSHOTS.get(key)
+    if snap is not None:
+        return snap
+
+    # .cache/ は自分で書いたファイルだけを読む前提（外から持ち込んだ pickle は置かないこと）
+    cache_file = CACHE_DIR / f"workbook_{key}.pickle"
+    try:
+        snap = cache_file.read_bytes()
+    except OSError:
+        snap = pickle.dumps(load_workbook(template_path), protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = cache_file.with_suffix(".tmp")
+            tmp.write_bytes(snap)
+            tmp.replace(cache_file)
+        except OSError:
+            pass
+    _SNAPSHOTS[key] = snap
+    return snap
+
+def load_template(template_path):
+    """
+    テンプレートを読み込んだ状態の Workbook を返す（呼ぶたびに独立したコピー）。
+    pickle.loads は load_workbook の 1/10 程度の時間で済み、
+    常駐プロセスでは 2 回目以降ディスクも読まない。
+    """
+    try:
+        return pickle.loads(_snapshot(template_path))
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        # 壊れた・互換性の無いキャッシュは捨てて読み直す
+        for f in CACHE_DIR.glob(f"workbook_{template_hash(template_path)}_*.pickle"):
+            f.unlink(missing_ok=True)
+        _SNAPSHOTS.clear()
+        return pickle.loads(_snapshot(template_path))
+
+# ===================== レイアウト自動検出 =====================
+@dataclass
+class OddsLayout:
+    section_cols: list[int]       # WIN1〜 の区画開始列
+    col_offsets: dict[str, int]   # 列名 → 区画内オフセット（書き込む列のみ）
+    start_row: int                # データ開始行
+    end_row: int                  # データ終了行
+    meta_rows: dict[str, int]     # "time"/"name"/"course" → 行
+
+def _norm(v) -> str:
+    return unicodedata.normalize("NFKC", str(v)).strip() if v is not None else ""
+
+def _merged_top_left(ws) -> dict[tuple[int, int], tuple[int, int]]:
+    """結合範囲の左上セル (行, 列) → (最終行, 最終列)"""
+    return {(r.min_row, r.min_col): (r.max_row, r.max_col) for r in ws.merged_cells.ranges}
+
+def _find_header_row(ws, max_scan: int = 40) -> int:
+    best, best_cnt = 0, 0
+    for row in ws.iter_rows(min_row=1, max_row=min(ws.max_row, max_scan)):
+        cnt = sum(1 for c in row if _norm(c.value) in ("馬番", "オッズ"))
+        if cnt > best_cnt:
+            best, best_cnt = row[0].row, cnt
+    if not best:
+        raise ValueError("ヘッダー行（馬番/オッズ）が見つかりません")
+    return best
+
+def _find_sections(ws, header_row: int) -> tuple[list[int], int]:
+    """区画見出し WIN1〜 の列（WIN 番号順）と見出し行を返す"""
+    marks = {}
+    mark_row = 0
+    for row in ws.iter_rows(min_row=1, max_row=header_row - 1):
+        for c in row:
+            m = SECTION_MARK_RE.match(_norm(c.value))
+            if m:
+                marks[int(m.group(1))] = c.column
+                mark_row = c.row
+    if not marks:
+        raise ValueError("区画見出し（WIN1〜）が見つかりません")
+    return [marks[k] for k in sorted(marks)], mark_row
+
+def _section_offsets(ws, sec: int, span: int, top_row: int, header_row: int) -> dict[str, int]:
+    """区画内の見出し（ヘッダー行＋その上の縦結合見出し）から列オフセットを拾う"""
+    offsets = {}
+    for off in range(span):
+        for r in range(header_row, top_row - 1, -1):
+            name = HEADER_FIELDS.get(_norm(ws.cell(row=r, column=sec + off).value))
+            if name and name not in offsets:
+                offsets[name] = off
+                break
+    return offsets
+
+def _data_end_row(ws, sec: int, span: int, start_row: int) -> int:
+    """区画内の数式が参照する絶対範囲（例: E$8:E$25）からデータ終了行を求める"""
+    for r in range(start_row, min(ws.max_row, start_row + 60) + 1):
+        for off in range(span):
+            v = ws.cell(row=r, column=sec + off).value
+            if isinstance(v, str) and v.startswith("="):
+                m = ABS_RANGE_RE.search(v)
+                if m and int(m.group(1)) == start_row:
+                    return int(m.group(2))
+    # 数式が無ければ 1 列目に数式・値が続く限りをデータ行とみなす
+    r = start_row
+    while ws.cell(row=r + 1, column=sec).value is not None:
+        r += 1
+    return r
+
+def _meta_rows(ws, sec: int, mark_row: int, header_row: int) -> dict[str, int]:
+    merged = _merged_top_left(ws)
+    rows = []
+    for r in range(mark_row + 1, header_row):
+        cell = ws.cell(row=r, column=sec)
+        if isinstance(cell, MergedCell):
+            continue
+        # 区画幅に横結合された行（発走時刻・レース名・コース）だけを対象にする
+        end = merged.get((r, sec))
+        if end and end[0] == r and end[1] > sec:
+            rows.append(r)
+    if len(rows) < len(META_KEYS):
+        raise ValueError(f"メタ情報行が足りません: {rows}")
+    return dict(zip(META_KEYS, rows))
+
+def detect_odds_layout(ws) -> OddsLayout:
+    """オッズデータ入力シートからレイアウトを検出する（失敗時は ValueError）"""
+    header_row = _find_header_row(ws)
+    section_cols, mark_row = _find_sections(ws, header_row)
+    span = (section_cols[1] - section_cols[0]) if len(section_cols) > 1 else ws.max_column - section_cols[0] + 1
+
+    offsets = _section_offsets(ws, section_cols[0], span, mark_row + 1, header_row)
+    if not {"馬番", "オッズ", "馬名"} <= offsets.keys():
+        raise ValueError(f"必須見出しが足りません: {offsets}")
+    for sec in section_cols[1:]:
+        other = _section_offsets(ws, sec, span, mark_row + 1, header_row)
+        if other != offsets:
+            raise ValueError(f"区画ごとに見出しの並びが違います: 列{sec} {other}")
+
+    start_row = header_row + 1
+    end_row = _data_end_row(ws, section_cols[0], span, start_row)
+    meta_rows = _meta_rows(ws, section_cols[0], mark_row, header_row)
+    return OddsLayout(section_cols=section_cols, col_offsets=offsets,
+                      start_row=start_row, end_row=end_row, meta_rows=meta_rows)
+
+def discover_odds_layout(template_path, ws=None, sheet: str = "オッズデータ入力") -> OddsLayout:
+    """
+    テンプレートの内容ハッシュ単位でキャッシュしたレイアウトを返す。
+    メモリ → .cache/ の JSON → テンプレートを読んで検出 の順に探す。
+    ws を渡す場合は読み込み直後（まだ何も書いていない）のシートであること。
+    """
+    thash = template_hash(template_path)
+    key = f"{thash}_{sheet}"
+    layout = _LAYOUTS.get(key)
+    if layout is not None:
+        return layout
+
+    cache_file = CACHE_DIR / f"layout_{thash}.json"
+    try:
+        d = json.loads(cache_file.read_text(encoding="utf-8"))
+        if d.pop("version", None) != LAYOUT_VERSION or d.pop("sheet", None) != sheet:
+            raise ValueError("layout cache mismatch")
+        layout = OddsLayout(**d)
+    except (OSError, ValueError, TypeError):
+        if ws is None:
+            ws = load_workbook(template_path)[sheet]
+        layout = detect_odds_layout(ws)
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_file.write_text(json.dumps({"version": LAYOUT_VERSION, "sheet": sheet, **asdict(layout)},
+                                             ensure_ascii=False), encoding="utf-8")
+        except OSError:
+            pass
+    _LAYOUTS[key] = layout
+    return layout
+
+# ===================== write plan =====================
+@dataclass
+class SectionPlan:
+    col: int                                       # 区画の開始列
+    meta: dict[str, tuple[int, int]]               # "time"/"name"/"course" → (行, 列)
+    fields: dict[str, list[tuple[int, int, int]]]  # 列名 → [(データ行番号, 行, 列), ...]
+
+@dataclass
+class WritePlan:
+    template_hash: str
+    sheet: str
+    capacity: int               # 1 区画に書ける最大行数
+    sections: list[SectionPlan]
+
+    def to_json(self) -> str:
+        return json.dumps({"version": PLAN_VERSION, **asdict(self)}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text: str) -> "WritePlan":
+        d = json.loads(text)
+        if d.pop("version", None) != PLAN_VERSION:
+            raise ValueError("write plan version mismatch")
+        d["sections"] = [
+            SectionPlan(
+                col=s["col"],
+                meta={k: tuple(v) for k, v in s["meta"].items()},
+                fields={k: [tuple(x) for x in v] for k, v in s["fields"].items()},
+            )
+            for s in d["sections"]
+        ]
+        return cls(**d)
+
+def _writable(ws, row: int, col: int) -> bool:
+    cell = ws.cell(row=row, column=col)
+    if isinstance(cell, MergedCell):
+        return False
+    if isinstance(cell.value, str) and cell.value.startswith("="):
+        return False
+    return True
+
+def compile_write_plan(ws, section_cols: list[int], col_offsets: dict[str, int],
+                       start_row: int, end_row: int, meta_rows: dict[str, int],
+                       thash: str = "") -> WritePlan:
+    """テンプレート（読み込み直後・未書き込み）のシートから write plan を作る"""
+    sections = []
+    for sec in section_cols:
+        meta = {k: (r, sec) for k, r in meta_rows.items() if _writable(ws, r, sec)}
+        fields = {}
+        for name, off in col_offsets.items():
+            col = sec + off
+            fields[name] = [
+                (slot, row, col)
+                for slot, row in enumerate(range(start_row, end_row + 1))
+                if _writable(ws, row, col)
+            ]
+        sections.append(SectionPlan(col=sec, meta=meta, fields=fields))
+    return WritePlan(template_hash=thash, sheet=ws.title,
+                     capacity=end_row - start_row + 1, sections=sections)
+
+def _plan_key(thash: str, sheet: str, layout: dict) -> str:
+    sig = hashlib.sha1(json.dumps([sheet, layout], sort_keys=True, ensure_ascii=False)
+                       .encode("utf-8")).hexdigest()[:12]
+    return f"{thash}_{sig}"
+
+def get_write_plan(template_path, ws=None, *, section_cols: list[int], col_offsets: dict[str, int],
+                   start_row: int, end_row: int, meta_rows: dict[str, int],
+                   sheet: str = "オッズデータ入力") -> WritePlan:
+    """
+    テンプレートのハッシュ＋レイアウト単位でキャッシュした write plan を返す。
+    メモリ → .cache/ の JSON → ws（無ければテンプレートを読む）からコンパイル の順に探す。
+    ws はテンプレートを読み込んだ直後（まだ何も書いていない）のシートを渡すこと。
+    """
+    thash = template_hash(template_path)
+    sheet = ws.title if ws is not None else sheet
+    layout = {"section_cols": section_cols, "col_offsets": col_offsets,
+              "rows": [start_row, end_row], "meta_rows": meta_rows}
+    key = _plan_key(thash, sheet, layout)
+    plan = _PLANS.get(key)
+    if plan is not None:
+        return plan
+
+    cache_file = CACHE_DIR / f"plan_{key}.json"
+    try:
+        plan = WritePlan.from_json(cache_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError, KeyError, TypeError):
+        if ws is None:
+            ws = load_workbook(template_path)[sheet]
+        plan = compile_write_plan(ws, section_cols, col_offsets, start_row, end_row, meta_rows, thash)
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_file.write_text(plan.to_json(), encoding="utf-8")
+        except OSError:
+            pass  # キャッシュは書けなくても動く
+    _PLANS[key] = plan
+    return plan
+
+# ===================== 書き込み =====================
+def column_values(df, name: str, capacity: int) -> list:
+    """DataFrame の 1 列を capacity 行ぶんの Python 値リストにする（欠損・不足分は None）"""
+    if name not in df.columns:
+        return [None] * capacity
+    # v != v は NaN 判定（pandas の where/astype より 1 桁速い）
+    vals = [None if (v is pd.NA or v != v) else v for v in df[name].tolist()[:capacity]]
+    return vals + [None] * (capacity - len(vals))
+
+def section_cells(plan: WritePlan, win_idx: int, df, meta: dict[str, object]) -> dict[tuple[int, int], object]:
+    """write plan の 1 区画分を {(行, 列): 値} にする（データの無い行は None＝クリア）"""
+    sec = plan.sections[win_idx]
+    out = {}
+    for key, value in meta.items():
+        rc = sec.meta.get(key)
+        if rc:
+            out[rc] = value
+    for name, cells in sec.fields.items():
+        vals = column_values(df, name, plan.capacity)
+        for slot, row, col in cells:
+            out[(row, col)] = vals[slot]
+    return out
+
+def apply_section(ws, plan: WritePlan, win_idx: int, df, meta: dict[str, object]) -> dict[tuple[int, int], object]:
+    """write plan の 1 区画をクリアしつつ書き込む（各セルへ 1 回だけ代入）。書いたセルを返す"""
+    cells = section_cells(plan, win_idx, df, meta)
+    for (row, col), value in cells.items():
+        ws.cell(row=row, column=col).value = value
+    return cells